@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gami import (PERSONAS_CONFIG, CoachAgent, PrefetchScheduler, apply_coach_summary, coach_chat_window,
+                  estimate_tokens, new_coach_chat, schedule_coach_summary)
+from stub_openai import serve
+
+QUESTIONS = ["Which health plan fits my budget?", "What if my income drops next quarter?",
+             "Should I raise the excess to lower the premium?", "How does cashless cover work with my GP?",
+             "Is critical illness cover worth adding later?", "How much should I keep in my emergency fund?"]
+REPORT_TURNS = (1, 10, 50)
+
+
+def prompt_tokens(messages):
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coach chat prompt size per turn, windowed vs full history")
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub server latency in seconds")
+    parser.add_argument("--think-seconds", type=float, default=0.5, help="pause between a reply and the next question")
+    args = parser.parse_args()
+
+    server, state = serve(latency=args.latency)
+    client = openai.OpenAI(api_key="sk-bench", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", max_retries=0)
+    agent = CoachAgent(client)
+    scheduler = PrefetchScheduler(ThreadPoolExecutor(max_workers=1))
+    persona = PERSONAS_CONFIG["tom_carter"]
+    progress = {'total_points': 450, 'level': 1, 'completed_quests': ['q1', 'q2', 'q3'], 'current_goal': None,
+                'achievements': [], 'unlocked_products': ["Premium Financial Calculator"]}
+    chat = new_coach_chat()
+    rows = []
+    for turn in range(1, args.turns + 1):
+        question = f"{QUESTIONS[turn % len(QUESTIONS)]} (turn {turn})"
+        apply_coach_summary(chat, scheduler)
+        windowed = prompt_tokens(agent.build_messages(question, progress, persona, history=coach_chat_window(chat)))
+        full = prompt_tokens(agent.build_messages(question, progress, persona, history=chat['turns']))
+        answer = "".join(agent.stream_answer(question, progress, persona, history=coach_chat_window(chat)))
+        chat['turns'] += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': answer}]
+        schedule_coach_summary(agent, chat, scheduler)
+        rows.append((turn, windowed, full, chat['folded'], bool(chat['summary'])))
+        time.sleep(args.think_seconds)
+
+    print(f"{'turn':>5}{'windowed':>10}{'full history':>14}{'folded':>8}{'summary':>9}")
+    for turn, windowed, full, folded, summarised in rows:
+        if turn in REPORT_TURNS or turn == args.turns:
+            print(f"{turn:>5}{windowed:>10}{full:>14}{folded:>8}{'yes' if summarised else 'no':>9}")
+    print(f"max windowed prompt {max(r[1] for r in rows)} tokens; stub saw {state.snapshot()['requests']} requests "
+          f"({state.snapshot()['requests'] - args.turns} summary folds)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
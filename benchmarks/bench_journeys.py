@@ -0,0 +1,197 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai import serve
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gami.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_journeys.json")
+STEPS = ["start", "api_key", "persona", "goals", "select_goal", "quests", "open_quest", "complete", "quiz", "nudge", "coach"]
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+class Journey:
+    # One scripted user session; every rerun is timed under the name of the step that triggered it. Needs Streamlit
+    # 1.59+: older AppTest passes the selectbox label rather than the value through format_func when picking a persona
+    def __init__(self, index, timeout):
+        from streamlit.testing.v1 import AppTest
+        self.index = index
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.timings = {step: [] for step in STEPS}
+
+    def timed(self, step, action):
+        started = time.perf_counter()
+        action()
+        self.timings[step].append(time.perf_counter() - started)
+        if self.at.exception:
+            raise RuntimeError(f"journey {self.index} failed at {step}: {self.at.exception[0].message}")
+
+    def button(self, predicate):
+        return next((b for b in self.at.button if predicate(b)), None)
+
+    def open_cards(self, quests):
+        for quest in quests:
+            self.at.session_state[f"card_{quest['id']}"] = True
+
+    def run(self, quests_to_complete):
+        at = self.at
+        self.timed("start", at.run)
+        self.timed("api_key", lambda: at.text_input[0].input("sk-bench").run())
+        personas = at.sidebar.selectbox[0].options
+        at.sidebar.selectbox[0].select_index(self.index % len(personas))
+        # Vary the age so sessions do not all share one prompt and the response cache stays honest
+        at.sidebar.number_input[0].set_value(22 + self.index % 40)
+        self.timed("persona", lambda: self.button(lambda b: b.label == "Start Your Journey").click().run())
+        self.timed("goals", lambda: self.button(lambda b: "Generate Personalized Goals" in b.label).click().run())
+        self.timed("select_goal", lambda: self.button(lambda b: (b.key or "").startswith("select_")).click().run())
+        self.timed("quests", lambda: self.button(lambda b: "Generate Quests for This Goal" in b.label).click().run())
+        completed = 0
+        for quest in list(at.session_state.generated_quests):
+            if completed >= quests_to_complete:
+                break
+            self.open_cards([quest])
+            self.timed("open_quest", at.run)
+            self.open_cards([quest])
+            button = self.button(lambda b: b.key in (f"complete_{quest['id']}", f"submit_{quest['id']}"))
+            if button is None:
+                continue
+            self.timed("quiz" if button.key.startswith("submit_") else "complete", lambda: button.click().run())
+            completed += 1
+        self.timed("nudge", lambda: self.button(lambda b: "Next Best Action" in b.label).click().run())
+        question = next(t for t in at.text_input if "AI Coach" in t.label)
+        self.timed("coach", lambda: question.input("Which health plan fits my budget?").run())
+        self.timed("coach", lambda: self.button(lambda b: b.label == "Ask Coach").click().run())
+        usage = dict(at.session_state["llm_usage"]) if "llm_usage" in at.session_state else {}
+        return {'timings': self.timings, 'completed': completed, 'usage': usage}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def warm_up(timeout):
+    # One untimed start page loads the app's imports, so per-session memory is growth beyond this point only
+    from streamlit.testing.v1 import AppTest
+    AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+
+
+def run_journey(index, timeout, quests):
+    rss_before = peak_rss_mb()
+    result = Journey(index, timeout).run(quests)
+    return result | {'rss_growth_mb': peak_rss_mb() - rss_before, 'peak_rss_mb': peak_rss_mb()}
+
+
+def summarise(results, stub_counters, elapsed, users):
+    reruns = {step: [t for r in results for t in r['timings'][step]] for step in STEPS}
+    all_reruns = [t for samples in reruns.values() for t in samples]
+    usage = [r['usage'] for r in results]
+    return {
+        'users': users,
+        'wall_seconds': round(elapsed, 2),
+        'rerun_ms': {
+            step: {'p50': round(percentile(s, 0.5) * 1000, 1), 'p95': round(percentile(s, 0.95) * 1000, 1),
+                   'p99': round(percentile(s, 0.99) * 1000, 1)}
+            for step, s in list(reruns.items()) + [('all', all_reruns)] if s
+        },
+        'llm_calls_per_journey': round(statistics.mean(u.get('llm_calls', 0) for u in usage), 2),
+        'tokens_per_journey': round(statistics.mean(u.get('prompt_tokens', 0) + u.get('completion_tokens', 0) for u in usage)),
+        'quests_completed_per_journey': round(statistics.mean(r['completed'] for r in results), 2),
+        'stub_requests': stub_counters['requests'],
+        'stub_errors': stub_counters['errors'],
+        'stub_tokens': stub_counters['prompt_tokens'] + stub_counters['completion_tokens'],
+        'peak_rss_mb': round(max(r['peak_rss_mb'] for r in results), 1),
+        'peak_rss_mb_per_session': round(statistics.mean(r['rss_growth_mb'] for r in results), 2),
+    }
+
+
+def compare(summary, baseline, tolerance):
+    # Higher is worse for every compared metric; returns the regressions beyond the tolerance
+    checks = [('llm_calls_per_journey',), ('tokens_per_journey',), ('peak_rss_mb_per_session',)]
+    checks += [('rerun_ms', step, 'p95') for step in baseline.get('rerun_ms', {})]
+    regressions = []
+    for path in checks:
+        old, new = baseline, summary
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old > 0 and new > old * (1 + tolerance):
+            regressions.append(f"{'.'.join(path)}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent headless journeys through gami.py against a stub LLM")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--quests", type=int, default=3, help="Quests to complete per journey")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--write-baseline", nargs="?", const=DEFAULT_BASELINE, help="Store this run as the baseline")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="Fail if this run regresses a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    server, stub = serve(0, args.latency, args.token_rate, args.error_rate, args.error_status)
+    workdir = tempfile.mkdtemp(prefix="lifequest-bench-")
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}/v1",
+        "LIFEQUEST_STATE_URL": "sqlite:///" + os.path.join(workdir, "state.sqlite3"),
+        "LIFEQUEST_QUEST_POOL_PATH": os.path.join(workdir, "quest_pool.json.gz"),
+        "LIFEQUEST_NUDGE_TABLE_PATH": os.path.join(workdir, "nudge_table.json"),
+        "LIFEQUEST_LEDGER_DIR": os.path.join(workdir, "ledger"),
+        "LIFEQUEST_LOG_LEVEL": "WARNING",
+    })
+
+    # AppTest drives a process-global Streamlit runtime, so concurrent sessions run in separate worker processes;
+    # they share the response cache, quest pool and progress store through one state database as server processes
+    # would. Workers are referenced through the module because AppTest swaps __main__ for the app script.
+    from bench_journeys import run_journey, warm_up
+    with ProcessPoolExecutor(max_workers=args.concurrency, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=warm_up, initargs=(args.timeout,)) as executor:
+        list(executor.map(time.sleep, [0.5] * args.concurrency))
+        started = time.perf_counter()
+        futures = [executor.submit(run_journey, i, args.timeout, args.quests) for i in range(args.users)]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+    time.sleep(1.0)  # let prefetch jobs started by the last clicks reach the stub before it is read
+    summary = summarise(results, stub.snapshot(), elapsed, args.users)
+    server.shutdown()
+
+    print(f"{args.users} journeys, concurrency {args.concurrency}, {summary['wall_seconds']}s")
+    print(f"{'step':<13}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in summary['rerun_ms'].items():
+        print(f"{step:<13}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}")
+    for key in ('llm_calls_per_journey', 'tokens_per_journey', 'quests_completed_per_journey', 'stub_requests',
+                'stub_errors', 'peak_rss_mb', 'peak_rss_mb_per_session'):
+        print(f"{key:<30}{summary[key]}")
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w", encoding="utf-8") as f:
+            json.dump({'settings': vars(args) | {'write_baseline': None, 'compare': None}, **summary}, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.write_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
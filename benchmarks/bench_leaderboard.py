@@ -0,0 +1,55 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gami import Leaderboard
+
+
+def timed(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Leaderboard engine benchmark")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--max-score", type=int, default=50_000)
+    parser.add_argument("--ops", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--tied", action="store_true", help="start every user on 0 points, as after a fresh launch")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    board = Leaderboard()
+    started = time.perf_counter()
+    for user in range(args.users):
+        board.set_score(user, 0 if args.tied else int(rng.paretovariate(1.5) * 100) % args.max_score)
+    load_seconds = time.perf_counter() - started
+    print(f"loaded {args.users:,} users in {load_seconds:.1f}s ({args.users / load_seconds:,.0f} inserts/s)")
+
+    users = [rng.randrange(args.users) for _ in range(args.ops)]
+    points = iter([rng.randint(50, 500) for _ in range(args.ops)])
+    picks = iter(users)
+    results = {
+        "add_points": timed(lambda: board.add_points(next(picks), next(points)), args.ops),
+        "rank": timed(lambda: board.rank(rng.choice(users)), args.ops),
+        "top(10)": timed(lambda: board.top(10), 2_000),
+        "around(r=5)": timed(lambda: board.around(rng.choice(users), 5), 2_000),
+    }
+    print(f"{'operation':<14}{'mean us':>10}{'p99 us':>10}")
+    for name, (mean, p99) in results.items():
+        print(f"{name:<14}{mean:>10.1f}{p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gami import AVAILABLE_PRODUCTS, PersonaCatalog, iter_persona_file
+
+FIRST_NAMES = ["Tom", "Sarah", "Mike", "Aisha", "James", "Priya", "Oliver", "Emma", "Kwame", "Sophie", "Liam", "Chloe"]
+LAST_NAMES = ["Carter", "Johnson", "Rodriguez", "Khan", "Smith", "Patel", "Jones", "Williams", "Brown", "Taylor", "Evans"]
+OCCUPATIONS = ["Freelance Designer", "Graduate Trainee", "Software Engineer", "Nurse", "Teacher", "Electrician", "Accountant"]
+INCOMES = ["£22,000-£28,000", "£35,000-£45,000", "£55,000-£70,000", "£70,000+"]
+STATUSES = ["Early Career", "Emerging Professional", "Established Professional"]
+RISKS = ["Conservative", "Moderate", "Aggressive"]
+
+
+def write_profiles(path, count, rng):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "age", "occupation", "income_range", "current_products", "financial_status",
+                         "risk_profile", "avatar"])
+        for i in range(count):
+            writer.writerow([f"C{i:08d}", f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}", rng.randint(18, 80),
+                             rng.choice(OCCUPATIONS), rng.choice(INCOMES),
+                             ";".join(rng.sample(AVAILABLE_PRODUCTS, rng.randint(0, 3))), rng.choice(STATUSES),
+                             rng.choice(RISKS), "👤"])
+
+
+def timed(fn, args):
+    samples = []
+    for arg in args:
+        started = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persona catalog load, memory and lookup benchmark")
+    parser.add_argument("--profiles", type=int, default=300_000)
+    parser.add_argument("--lookups", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "profiles.csv")
+        write_profiles(path, args.profiles, rng)
+        tracemalloc.start()
+        started = time.perf_counter()
+        catalog = PersonaCatalog.from_records(iter_persona_file(path))
+        load_seconds = time.perf_counter() - started
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print(f"loaded {len(catalog):,} profiles in {load_seconds:.1f}s; retained {retained / 2 ** 20:.1f} MB "
+          f"({retained / len(catalog):.0f} B/profile), peak during load {peak / 2 ** 20:.1f} MB")
+
+    ids = [f"C{rng.randrange(args.profiles):08d}" for _ in range(args.lookups)]
+    prefixes = [rng.choice(FIRST_NAMES)[:rng.randint(1, 3)] for _ in range(args.lookups // 10)]
+    results = {
+        "get(id)": timed(catalog.get, ids),
+        "search(id prefix)": timed(catalog.search, [i[:7] for i in ids[:args.lookups // 10]]),
+        "search(name prefix)": timed(catalog.search, prefixes),
+    }
+    print(f"{'operation':<22}{'mean us':>10}{'p99 us':>10}")
+    for name, (mean, p99) in results.items():
+        print(f"{name:<22}{mean:>10.1f}{p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
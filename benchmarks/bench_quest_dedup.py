@@ -0,0 +1,66 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gami import QuestDedupIndex, register_in_library
+
+TOPIC_WORDS = ["health", "insurance", "premium", "excess", "claim", "savings", "emergency", "fund", "budget", "pension",
+               "invest", "debt", "loan", "credit", "income", "protection", "life", "cover", "plan", "compare", "quote"]
+
+
+def synthetic_quest(rng, vocabulary):
+    # Quest-like text: a few common topic words plus rarer words from a large vocabulary
+    words = rng.sample(TOPIC_WORDS, 3) + rng.sample(vocabulary, 9)
+    return {'title': " ".join(words[:5]), 'description': " ".join(words[5:])}
+
+
+def reword(rng, quest, vocabulary):
+    # Swap one word and reorder the rest: the shape of an LLM rephrasing an earlier quest
+    words = (quest['title'] + " " + quest['description']).split()
+    words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    rng.shuffle(words)
+    return {'title': " ".join(words[:5]), 'description': " ".join(words[5:])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate quest index benchmark")
+    parser.add_argument("--library", type=int, default=100_000, help="Distinct quests loaded before measuring")
+    parser.add_argument("--probes", type=int, default=5_000)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    vocabulary = [f"w{i}" for i in range(args.vocabulary)]
+
+    library = QuestDedupIndex()
+    originals = [synthetic_quest(rng, vocabulary) for _ in range(args.library)]
+    started = time.perf_counter()
+    for quest in originals:
+        register_in_library(library, quest)
+    load_seconds = time.perf_counter() - started
+    print(f"loaded {args.library:,} quests in {load_seconds:.1f}s; {len(library):,} distinct after dedup")
+
+    rewordings = [reword(rng, rng.choice(originals), vocabulary) for _ in range(args.probes)]
+    fresh = [synthetic_quest(rng, vocabulary) for _ in range(args.probes)]
+    results = {}
+    for name, probes in (("reworded", rewordings), ("fresh", fresh)):
+        samples, merged = [], 0
+        for quest in probes:
+            began = time.perf_counter()
+            _, is_new = register_in_library(library, quest)
+            samples.append((time.perf_counter() - began) * 1e6)
+            merged += not is_new
+        samples.sort()
+        results[name] = (statistics.mean(samples), samples[int(len(samples) * 0.99) - 1], merged / len(probes))
+    print(f"{'insert':<10}{'mean us':>10}{'p99 us':>10}{'merged':>10}")
+    for name, (mean, p99, merged) in results.items():
+        print(f"{name:<10}{mean:>10.1f}{p99:>10.1f}{merged:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gami import PROGRESS_NAMESPACE_PREFIX, ResponseCache, SharedProgressStore, state_backend_from_url
+
+_barrier = None
+
+
+def init_worker(barrier):
+    global _barrier
+    _barrier = barrier
+
+
+def run_worker(index, url, users, duration, think_ms, cache_keys, seed):
+    # One simulated rerun: hydrate a user, maybe look up a cached LLM response, persist what changed
+    rng = random.Random(seed + index)
+    backend = state_backend_from_url(url)
+    store, cache = SharedProgressStore(backend), ResponseCache(backend, memory_entries=32)
+    written, samples = {}, []
+    _barrier.wait()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        user_id = f"user-{rng.randrange(users)}"
+        store.load(user_id)
+        key = f"response-{rng.randrange(cache_keys)}"
+        if cache.get(key) is None:
+            cache.set(key, "x" * 600)
+        version = written.get(user_id, 0) + 1
+        payload = json.dumps({'user_progress': {'total_points': version * 10, 'worker': index}, 'current_goal_id': None})
+        store.save_many([(user_id, 'progress', payload)] + ([(user_id, 'quests', "[]")] if version % 3 == 0 else []))
+        written[user_id] = version
+        samples.append(time.perf_counter() - started)
+        if think_ms:
+            time.sleep(think_ms / 1000)
+    return len(samples), samples, sorted(written), cache.stats
+
+
+def run_level(workers, url, args):
+    barrier = multiprocessing.get_context("spawn").Barrier(workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(barrier,)) as executor:
+        futures = [executor.submit(run_worker, i, url, args.users, args.duration, args.think_ms, args.cache_keys,
+                                   args.seed) for i in range(workers)]
+        results = [f.result() for f in futures]
+    samples = sorted(s for _, worker_samples, _, _ in results for s in worker_samples)
+    users = set().union(*(set(u) for _, _, u, _ in results))
+    hits = sum(r[3]['memory_hits'] + r[3]['shared_hits'] for r in results)
+    lookups = hits + sum(r[3]['misses'] for r in results)
+    return {
+        'reruns_per_s': len(samples) / args.duration,
+        'p50_ms': statistics.median(samples) * 1000,
+        'p99_ms': samples[int(len(samples) * 0.99) - 1] * 1000,
+        'cache_hit_rate': hits / lookups if lookups else 0.0,
+        'users_written': users,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-state throughput across Streamlit-like worker processes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds each level runs")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--cache-keys", type=int, default=500)
+    parser.add_argument("--think-ms", type=float, default=5.0,
+                        help="Per-rerun time outside the store (rendering, LLM waits); 0 measures the store alone")
+    parser.add_argument("--url", help="Shared state URL; defaults to a fresh SQLite file per level")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.duration:.0f}s per level, think time {args.think_ms:g} ms")
+    print(f"{'workers':>8}{'reruns/s':>12}{'speedup':>10}{'p50 ms':>10}{'p99 ms':>10}{'cache hit':>11}")
+    base = None
+    with tempfile.TemporaryDirectory() as workdir:
+        for workers in args.workers:
+            url = args.url or "sqlite:///" + os.path.join(workdir, f"state-{workers}.sqlite3")
+            result = run_level(workers, url, args)
+            # Every user any worker wrote must be visible through a fresh connection
+            backend = state_backend_from_url(url)
+            stored = {key for key, _ in backend.scan(PROGRESS_NAMESPACE_PREFIX + 'progress')}
+            missing = result['users_written'] - stored
+            base = base or result['reruns_per_s']
+            print(f"{workers:>8}{result['reruns_per_s']:>12,.0f}{result['reruns_per_s'] / base:>9.2f}x"
+                  f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['cache_hit_rate']:>11.0%}")
+            if missing:
+                sys.exit(f"{len(missing)} users written by workers are missing from the shared store")
+
+
+if __name__ == "__main__":
+    main()
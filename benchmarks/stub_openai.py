@@ -0,0 +1,179 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenAI-compatible chat completions stub. Answers are picked from the agent named in the prompt and are shaped
+# like real model output, so parsing, caching and streaming paths in gami.py run exactly as they do in production.
+
+GOALS = [
+    {"t": "Get Comprehensive Health Insurance", "d": "Secure cover against medical costs", "p": "High", "tl": "Short term",
+     "c": "Health Insurance Coverage", "a": 2000, "df": "Beginner", "w": "Protects your savings from medical bills"},
+    {"t": "Build Emergency Fund", "d": "Save three months of expenses", "p": "High", "tl": "Medium term",
+     "c": "Emergency Fund Building", "a": 6000, "df": "Beginner", "w": "A safety net for irregular income"},
+    {"t": "Protect Your Income", "d": "Cover lost earnings if you cannot work", "p": "Medium", "tl": "Medium term",
+     "c": "Income Protection", "a": 3000, "df": "Intermediate", "w": "Keeps bills paid during illness"},
+]
+LEARNING = ("Health insurance pays for private treatment so you are seen faster. A premium is what you pay each month; "
+            "an excess is what you pay towards each claim. Choosing a higher excess lowers your premium. ") * 3
+STEPS = ["Open the Lloyds health cover calculator", "Enter your age and postcode", "Compare two plans side by side"]
+QUESTION = {"q": "What is an excess?", "o": ["A fee you pay per claim", "A monthly cost", "A loyalty bonus", "A refund"],
+            "c": 0, "e": "You pay the excess towards each claim before the insurer pays the rest."}
+COACH_ANSWER = "Based on your income, a comprehensive cashless health plan at around £70-£90 a month is a good fit. " * 4
+COACH_SUMMARY = ("The user is weighing health cover on a variable freelance income. The coach suggested a cashless plan "
+                 "at £70-£90 a month, about 1.5-2% of income, and the user plans to compare two quotes this week.")
+QUESTS = [
+    ("learning", "Understand premiums and excess", "See how the monthly premium and claim excess trade off"),
+    ("action", "Get a health cover quote", "Use the Lloyds calculator to price a plan for your age"),
+    ("quiz", "Insurance jargon check", "Answer questions on waiting periods and exclusions"),
+    ("quiz", "Claims process quiz", "Test what happens from referral to settled claim"),
+    ("learning", "What cashless cover means", "Find out how hospitals bill your insurer directly"),
+    ("challenge", "Seven-day budget challenge", "Track spending for a week to free up room for cover"),
+    ("quiz", "Pick the better policy", "Choose between two example plans and explain why"),
+]
+
+
+def quests(skeleton):
+    items = []
+    for quest_type, title, description in QUESTS:
+        quest = {"t": f"{title} #{random.randrange(10 ** 6)}", "d": description, "ty": quest_type, "pt": 150,
+                 "df": "Easy", "et": "2 minutes", "r": "Cover guide"}
+        if not skeleton:
+            quest.update(lc=LEARNING, s=STEPS, q=[QUESTION, QUESTION])
+        items.append(quest)
+    return {"quests": items}
+
+
+def answer(body):
+    text = " ".join(str(message.get("content", "")) for message in body["messages"])
+    if "running memory of a conversation" in text:
+        return COACH_SUMMARY
+    if "Goal Coach" in text:
+        return json.dumps({"goals": GOALS})
+    if "Nudge Agent" in text:
+        return json.dumps({"m": "Great momentum - keep it going!", "a": "Complete your next quest", "u": "Medium",
+                           "r": "Earn 150 LifePoints", "mo": "Each quest moves you closer to your goal"})
+    if "financial advisor" in text:
+        return COACH_ANSWER
+    if "content of one quest" in text:
+        if "Type: quiz" in text:
+            return json.dumps({"q": [QUESTION, QUESTION]})
+        if "Type: action" in text or "Type: challenge" in text:
+            return json.dumps({"s": STEPS})
+        return json.dumps({"lc": LEARNING})
+    if "Quest Agent" in text or "quests" in text.lower():
+        return json.dumps(quests(skeleton="skeleton" in text))
+    return COACH_ANSWER
+
+
+class StubState:
+    def __init__(self, latency, token_rate, error_rate, error_status):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def count(self, **deltas):
+        with self.lock:
+            for key, value in deltas.items():
+                self.counters[key] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=()):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._send_json(200, state.snapshot())
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            state.count(requests=1)
+            time.sleep(state.latency)
+            if random.random() < state.error_rate:
+                state.count(errors=1)
+                self._send_json(state.error_status, {"error": {"message": "injected error", "type": "rate_limit_error"}},
+                                [("Retry-After", "0.2")] if state.error_status == 429 else [])
+                return
+            content = answer(body)
+            prompt_tokens = sum(len(str(m.get("content", ""))) for m in body["messages"]) // 4
+            completion_tokens = len(content) // 4
+            state.count(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                     "total_tokens": prompt_tokens + completion_tokens}
+            base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body["model"]}
+            if not body.get("stream"):
+                if state.token_rate:
+                    time.sleep(completion_tokens / state.token_rate)
+                self._send_json(200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            chunks = [content[i:i + 16] for i in range(0, len(content), 16)]
+            for piece in chunks:
+                event = {**base, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+                if state.token_rate:
+                    time.sleep(4 / state.token_rate)
+            done = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            tail = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(done)}\n\ndata: {json.dumps(tail)}\n\ndata: [DONE]\n\n".encode())
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+def serve(port=0, latency=0.2, token_rate=0.0, error_rate=0.0, error_status=429):
+    # Starts the stub on a background thread; returns the server (its port is server.server_address[1]) and its state
+    state = StubState(latency, token_rate, error_rate, error_status)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for LifeQuest benchmarks")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first byte")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Output tokens per second (0 = instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=429)
+    args = parser.parse_args()
+    server, _ = serve(args.port, args.latency, args.token_rate, args.error_rate, args.error_status)
+    print(f"stub listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,562 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import json
 import openai
+import numpy as np
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import re
 from datetime import datetime, timedelta
 import random
 from typing import Dict, List, Optional
 import time
 import hashlib
+import functools
+import zlib
+import os
+import sys
+import gzip
+import argparse
+import uuid
+import atexit
+import sqlite3
+import csv
+import threading
+import logging
+import logging.handlers
+import contextvars
+import heapq
+import itertools
+import bisect
+from collections import ChainMap, OrderedDict, Counter, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from types import MappingProxyType
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger("lifequest")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.environ.get("LIFEQUEST_LOG_LEVEL", "INFO"))
+    logger.propagate = False
+
+# Shared HTTP connection pool for all OpenAI clients in this process
+HTTP_POOL_MAX_CONNECTIONS = 100
+HTTP_POOL_MAX_KEEPALIVE = 20
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 60.0
+HTTP_TIMEOUT_SECONDS = 60.0
+
+if httpx is not None:
+    class MeteredHTTPTransport(httpx.HTTPTransport):
+        def __init__(self, registry, **kwargs):
+            super().__init__(**kwargs)
+            self.registry = registry
+
+        def handle_request(self, request):
+            self.registry._request_started()
+            try:
+                return super().handle_request(request)
+            finally:
+                self.registry._request_finished()
+
+class OpenAIClientRegistry:
+    def __init__(self):
+        self._clients = {}
+        self._transports = []
+        self._lock = threading.Lock()
+        self._metrics = {'clients': 0, 'requests': 0, 'in_flight': 0, 'peak_in_flight': 0}
+
+    def get(self, api_key):
+        key = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                # Retries are owned by the LLM scheduler so backoff is coordinated across sessions
+                client = openai.OpenAI(api_key=api_key, http_client=self._build_http_client(), max_retries=0)
+                self._clients[key] = client
+                self._metrics['clients'] = len(self._clients)
+            return client
+
+    def _build_http_client(self):
+        if httpx is None:
+            return None
+        transport = MeteredHTTPTransport(
+            self,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS
+            )
+        )
+        self._transports.append(transport)
+        return openai.DefaultHttpxClient(transport=transport, timeout=HTTP_TIMEOUT_SECONDS)
+
+    def _request_started(self):
+        with self._lock:
+            self._metrics['requests'] += 1
+            self._metrics['in_flight'] += 1
+            self._metrics['peak_in_flight'] = max(self._metrics['peak_in_flight'], self._metrics['in_flight'])
+
+    def _request_finished(self):
+        with self._lock:
+            self._metrics['in_flight'] -= 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            transports = list(self._transports)
+        connections = idle = 0
+        for transport in transports:
+            # httpcore does not expose pool state publicly, so read it defensively
+            for connection in getattr(getattr(transport, '_pool', None), 'connections', []):
+                connections += 1
+                idle += bool(connection.is_idle())
+        metrics['pool_connections'] = connections
+        metrics['pool_idle_connections'] = idle
+        metrics['pool_max_connections'] = HTTP_POOL_MAX_CONNECTIONS * max(len(transports), 1)
+        metrics['pool_utilisation'] = (connections - idle) / metrics['pool_max_connections']
+        return metrics
+
+@st.cache_resource
+def get_client_registry():
+    return OpenAIClientRegistry()
+
+# Process-wide LLM admission: token buckets sized to the account quota, priority lanes, single-flight and retries
+LLM_RPM_LIMIT = int(os.environ.get("LIFEQUEST_LLM_RPM", "500"))
+LLM_TPM_LIMIT = int(os.environ.get("LIFEQUEST_LLM_TPM", "200000"))
+LLM_MAX_CONCURRENCY = 32
+LLM_MAX_ATTEMPTS = 5
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 30.0
+LLM_WAIT_SAMPLES = 1000
+PRIORITY_INTERACTIVE, PRIORITY_QUESTS, PRIORITY_PREFETCH = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_QUESTS: "quests", PRIORITY_PREFETCH: "prefetch"}
+
+@st.cache_resource
+def get_context_var(name):
+    # The script module is re-executed on every rerun, but cached agents keep the globals of the run that built
+    # them; context variables must be shared process-wide objects for both to see the same value
+    return contextvars.ContextVar(name, default=None)
+
+llm_priority = get_context_var("llm_priority")
+
+llm_usage = get_context_var("llm_usage")
+
+def session_usage_meter():
+    # Binds this session's token meter to the running context; background jobs inherit it via copy_context
+    meter = st.session_state.setdefault('llm_usage', Counter())
+    llm_usage.set(meter)
+    return meter
+
+def record_llm_usage(usage):
+    meter = llm_usage.get()
+    if meter is None or usage is None:
+        return
+    meter['llm_calls'] += 1
+    meter['prompt_tokens'] += usage.prompt_tokens or 0
+    meter['completion_tokens'] += usage.completion_tokens or 0
+
+def record_llm_coalesced():
+    meter = llm_usage.get()
+    if meter is not None:
+        meter['coalesced_calls'] += 1
+
+def run_with_priority(priority, fn, *args):
+    # Executor threads do not inherit context variables, so background jobs set their lane explicitly
+    token = llm_priority.set(priority)
+    try:
+        return fn(*args)
+    finally:
+        llm_priority.reset(token)
+
+def is_transient_llm_error(error):
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code in (408, 409, 429) or error.status_code >= 500)
+
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class LLMScheduler:
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._queue = []
+        self._tickets = itertools.count()
+        self._running = 0
+        self._paused_until = 0.0
+        self._inflight = {}
+        self._waits = {priority: deque(maxlen=LLM_WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+        self.stats = Counter()
+
+    def run(self, call, tokens, priority, key=None):
+        # Callers with the same key while a request is in flight share its result instead of issuing their own
+        if key is not None:
+            with self._cond:
+                leader = self._inflight.get(key)
+                if leader is None:
+                    future = self._inflight[key] = Future()
+                else:
+                    self.stats['coalesced'] += 1
+            if leader is not None:
+                return leader.result()
+        try:
+            result = self._call_with_retry(call, tokens, priority)
+        except BaseException as error:
+            if key is not None:
+                self._finish_flight(key, future, error=error)
+            raise
+        if key is not None:
+            self._finish_flight(key, future, result=result)
+        return result
+
+    def _finish_flight(self, key, future, result=None, error=None):
+        with self._cond:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def stream(self, call, tokens, priority):
+        # Streams keep their slot while they are read; it is released, and the token estimate corrected from the
+        # final usage chunk, once the stream is exhausted, closed or dropped
+        return HeldStream(self._call_with_retry(call, tokens, priority, hold=True),
+                          lambda used: self._release(tokens, used))
+
+    def _call_with_retry(self, call, tokens, priority, hold=False):
+        for attempt in range(LLM_MAX_ATTEMPTS):
+            self._acquire(priority, tokens)
+            used = None
+            held = False
+            try:
+                response = call()
+                used = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+                held = hold
+                return response
+            except Exception as error:
+                if attempt == LLM_MAX_ATTEMPTS - 1 or not is_transient_llm_error(error):
+                    raise
+                delay = self._backoff_delay(error, attempt)
+            finally:
+                if not held:
+                    self._release(tokens, used)
+            time.sleep(delay)
+
+    def _backoff_delay(self, error, attempt):
+        # Full jitter spreads retries from a burst; a Retry-After header pauses every lane, not just this caller
+        retry_after = retry_after_seconds(error)
+        delay = retry_after if retry_after is not None else random.uniform(
+            0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+        with self._cond:
+            self.stats['retries'] += 1
+            if isinstance(error, openai.RateLimitError):
+                self.stats['rate_limited'] += 1
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        return delay
+
+    def _acquire(self, priority, tokens):
+        ticket = (priority, next(self._tickets))
+        queued = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            self._cond.notify_all()
+            while True:
+                now = time.monotonic()
+                if self._queue[0] != ticket or self._running >= self.max_concurrency:
+                    self._cond.wait()
+                    continue
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                delay = max(self._paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    break
+                self._cond.wait(delay)
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self._running += 1
+            self._waits[priority].append(now - queued)
+            self.stats['requests'] += 1
+            self._cond.notify_all()
+
+    def _release(self, estimated_tokens, used_tokens):
+        with self._cond:
+            self._running -= 1
+            if used_tokens is not None:
+                self.tokens.refund(estimated_tokens - used_tokens)
+            self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            depth = Counter(priority for priority, _ in self._queue)
+            waits = {priority: sorted(samples) for priority, samples in self._waits.items()}
+            metrics = dict(self.stats, running=self._running,
+                           rpm_available=int(self.requests.tokens), tpm_available=int(self.tokens.tokens))
+        for priority, name in PRIORITY_NAMES.items():
+            samples = waits[priority]
+            metrics[f'queue_depth_{name}'] = depth[priority]
+            metrics[f'wait_ms_mean_{name}'] = 1000 * sum(samples) / len(samples) if samples else 0.0
+            metrics[f'wait_ms_p95_{name}'] = 1000 * samples[int(len(samples) * 0.95) - 1] if samples else 0.0
+        return metrics
+
+class HeldStream:
+    # Wraps a streamed response so the scheduler slot it holds is released exactly once
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._used = None
+        self._released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    self._used = usage.total_tokens
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._release(self._used)
+
+    def __del__(self):
+        self.close()
+
+@st.cache_resource
+def get_llm_scheduler():
+    return LLMScheduler()
+
+# Per-agent LLM telemetry, keyed by agent class and call site. Exported as Prometheus text on LIFEQUEST_METRICS_PORT
+# and/or as JSON snapshots in a size-rotated file at LIFEQUEST_METRICS_PATH. The endpoint is unauthenticated, so it
+# listens on loopback unless LIFEQUEST_METRICS_HOST opens it up (e.g. to a scraper on a private network)
+METRICS_PORT = int(os.environ.get("LIFEQUEST_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("LIFEQUEST_METRICS_HOST", "127.0.0.1")
+METRICS_FILE_PATH = os.environ.get("LIFEQUEST_METRICS_PATH", "")
+METRICS_FILE_INTERVAL_SECONDS = 60.0
+METRICS_FILE_MAX_BYTES = 5 * 1024 * 1024
+METRICS_FILE_BACKUPS = 3
+OPERATOR_TOKEN = os.environ.get("LIFEQUEST_OPERATOR_TOKEN", "")
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TELEMETRY_TIMINGS = ('queue', 'ttft', 'latency')
+# USD per 1K prompt and completion tokens; only used to estimate spend
+LLM_PRICES_PER_1K_TOKENS = {"gpt-3.5-turbo": (0.0005, 0.0015)}
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_SECONDS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation; the last bucket reports the largest finite bound
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+class AgentTelemetry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Counter keys are either plain names or "label:value" pairs such as "finish_reason:length"
+        self.counters = defaultdict(Counter)
+        self.timings = defaultdict(lambda: {name: Histogram() for name in TELEMETRY_TIMINGS})
+        # Process-wide gauges read at export time: prefix -> callable returning {name: number}
+        self.gauge_sources = {}
+
+    def add_gauges(self, prefix, source):
+        with self._lock:
+            self.gauge_sources[prefix] = source
+
+    def gauges(self):
+        with self._lock:
+            sources = dict(self.gauge_sources)
+        return {f"{prefix}_{name}": value for prefix, source in sources.items() for name, value in source().items()}
+
+    def record(self, agent, site, **deltas):
+        with self._lock:
+            self.counters[agent, site].update(deltas)
+
+    def record_labelled(self, agent, site, label, value):
+        with self._lock:
+            self.counters[agent, site][f"{label}:{value}"] += 1
+
+    def observe(self, agent, site, timing, seconds):
+        with self._lock:
+            self.timings[agent, site][timing].observe(seconds)
+
+    def record_usage(self, agent, site, model, usage, finish_reason):
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        prompt_price, completion_price = LLM_PRICES_PER_1K_TOKENS.get(model, (0.0, 0.0))
+        with self._lock:
+            counters = self.counters[agent, site]
+            counters.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            cost_usd=(prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000)
+            if finish_reason:
+                counters[f"finish_reason:{finish_reason}"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            rows = []
+            for key in sorted(set(self.counters) | set(self.timings)):
+                row = {'agent': key[0], 'site': key[1], **self.counters.get(key, {})}
+                for name, histogram in self.timings[key].items() if key in self.timings else ():
+                    if histogram.count:
+                        row[f'{name}_ms_mean'] = round(1000 * histogram.sum / histogram.count, 1)
+                        row[f'{name}_ms_p95'] = round(1000 * histogram.quantile(0.95), 1)
+                rows.append(row)
+            return rows
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = {key: dict(values) for key, values in self.counters.items()}
+            timings = {key: {name: (list(h.counts), h.sum, h.count) for name, h in hists.items()}
+                       for key, hists in self.timings.items()}
+        families = defaultdict(list)
+        for (agent, site), values in counters.items():
+            labels = f'agent="{agent}",site="{site}"'
+            for name, value in values.items():
+                metric, _, label_value = name.partition(':')
+                extra = f',{metric}="{label_value}"' if label_value else ''
+                family = f"lifequest_llm_{metric}{'s' if label_value else ''}_total"
+                families[family].append(f"{family}{{{labels}{extra}}} {value}")
+        for family in sorted(families):
+            lines.append(f"# TYPE {family} counter")
+            lines.extend(families[family])
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE lifequest_{name} gauge")
+            lines.append(f"lifequest_{name} {value}")
+        for timing in TELEMETRY_TIMINGS:
+            family = f"lifequest_llm_{timing}_seconds"
+            lines.append(f"# TYPE {family} histogram")
+            for (agent, site), hists in timings.items():
+                counts, total, count = hists[timing]
+                labels = f'agent="{agent}",site="{site}"'
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS_SECONDS + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{family}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{family}_sum{{{labels}}} {total}")
+                lines.append(f"{family}_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+def start_metrics_server(telemetry, port, host=METRICS_HOST):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = telemetry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as error:
+        # Another server process on this host already exports; each process still writes its own metrics file
+        logger.warning("metrics endpoint not started on port %d: %s", port, error)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="lifequest-metrics").start()
+    return server
+
+def start_metrics_file(telemetry, path, interval=METRICS_FILE_INTERVAL_SECONDS):
+    metrics_logger = logger.getChild("metrics")
+    metrics_logger.propagate = False
+    metrics_logger.setLevel(logging.INFO)
+    metrics_logger.addHandler(logging.handlers.RotatingFileHandler(
+        path, maxBytes=METRICS_FILE_MAX_BYTES, backupCount=METRICS_FILE_BACKUPS, encoding="utf-8"))
+    write = lambda: metrics_logger.info(json.dumps({'ts': time.time(), 'pid': os.getpid(), 'agents': telemetry.snapshot(),
+                                                        'gauges': telemetry.gauges()}))
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write()
+
+    threading.Thread(target=loop, daemon=True, name="lifequest-metrics-file").start()
+    atexit.register(write)
+
+@st.cache_resource
+def get_agent_telemetry():
+    telemetry = AgentTelemetry()
+    telemetry.add_gauges("http", get_client_registry().metrics)
+    if METRICS_PORT:
+        start_metrics_server(telemetry, METRICS_PORT)
+    if METRICS_FILE_PATH:
+        start_metrics_file(telemetry, METRICS_FILE_PATH)
+    return telemetry
 
 # Initialize OpenAI client
 def initialize_openai():
     if 'openai_client' not in st.session_state:
         api_key = st.text_input("Enter OpenAI API Key", type="password")
         if api_key:
-            st.session_state.openai_client = openai.OpenAI(api_key=api_key)
+            st.session_state.openai_api_key = api_key
+            st.session_state.openai_client = get_client_registry().get(api_key)
         else:
             st.error("Please provide a valid OpenAI API key")
             st.stop()
@@ -56,6 +599,149 @@ PERSONAS_CONFIG = {
 # Available products for dropdown
 AVAILABLE_PRODUCTS = ["Savings Account", "Current Account", "Credit Card", "Investment Account", "Loan"]
 
+# Persona catalog: base profiles are held column-wise and shared read-only by every session. A session layers its own
+# edits over its base persona in a ChainMap, so nothing one user changes is visible to another.
+PERSONA_CATALOG_PATH = os.environ.get("LIFEQUEST_PERSONA_CATALOG", "")
+PERSONA_SEARCH_LIMIT = 50
+PERSONA_FIELDS = ('name', 'age', 'occupation', 'income_range', 'current_products', 'financial_status', 'risk_profile', 'avatar')
+PERSONA_DEFAULTS = {'age': 30, 'occupation': '', 'income_range': '', 'current_products': (), 'financial_status': '',
+                    'risk_profile': 'Moderate', 'avatar': '👤'}
+
+class StringColumn:
+    # Many strings stored as one text blob plus offsets rather than one Python object per row
+    def __init__(self, values):
+        self._offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(v) for v in values), dtype=np.int64, count=len(values)), out=self._offsets[1:])
+        self._blob = "".join(values)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        return self._blob[self._offsets[row]:self._offsets[row + 1]]
+
+class CategoryColumn:
+    # Low-cardinality values stored once, with a small integer code per row
+    def __init__(self, values):
+        index = {}
+        self.codes = np.fromiter((index.setdefault(v, len(index)) for v in values), dtype=np.uint32, count=len(values))
+        self.categories = list(index)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        return self.categories[self.codes[row]]
+
+def _parse_age(value, persona_id):
+    # CSV exports write ages as "32", " 32 " or "32.0"; anything else takes the default rather than failing the load
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        logger.warning("persona %s: unreadable age %r, using %d", persona_id, value, PERSONA_DEFAULTS['age'])
+        return PERSONA_DEFAULTS['age']
+
+class PersonaCatalog:
+    def __init__(self, columns):
+        # Rows are kept in ID order so IDs resolve by binary search; a second sorted copy of lower-cased names
+        # serves name prefix search
+        order = sorted(range(len(columns['id'])), key=columns['id'].__getitem__)
+        columns = {field: [values[row] for row in order] for field, values in columns.items()}
+        duplicate = next((a for a, b in zip(columns['id'], columns['id'][1:]) if a == b), None)
+        if duplicate is not None:
+            raise ValueError(f"Persona catalog has duplicate customer ID {duplicate!r}")
+        lowered = [name.lower() for name in columns['name']]
+        self.ids = StringColumn(columns.pop('id'))
+        self.names = StringColumn(columns.pop('name'))
+        self.ages = np.array(columns.pop('age'), dtype=np.uint8)
+        self.columns = {field: CategoryColumn(values) for field, values in columns.items()}
+        self._name_order = np.array(sorted(range(len(lowered)), key=lowered.__getitem__), dtype=np.int32)
+        self._name_keys = StringColumn([lowered[row] for row in self._name_order])
+
+    @classmethod
+    def from_records(cls, records):
+        columns = {field: [] for field in ('id',) + PERSONA_FIELDS}
+        for i, record in enumerate(records, 1):
+            # A generated ID could collide with a real one and resolve to the wrong customer, so IDs are required
+            persona_id = str(record.get('id') or '').strip()
+            if not persona_id:
+                raise ValueError(f"Persona catalog record {i} has no customer ID")
+            columns['id'].append(persona_id)
+            for field in PERSONA_FIELDS:
+                value = record.get(field)
+                if isinstance(value, str):
+                    value = value.strip()
+                if value in (None, ''):
+                    value = PERSONA_DEFAULTS.get(field, '')
+                if field == 'age':
+                    value = min(max(_parse_age(value, persona_id), 18), 100)
+                elif field == 'current_products':
+                    value = tuple(p.strip() for p in value.split(';') if p.strip()) if isinstance(value, str) else tuple(value)
+                columns[field].append(value)
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _row(self, persona_id):
+        row = bisect.bisect_left(self.ids, persona_id)
+        return row if row < len(self.ids) and self.ids[row] == persona_id else None
+
+    def __contains__(self, persona_id):
+        return persona_id is not None and self._row(persona_id) is not None
+
+    def get(self, persona_id):
+        row = self._row(persona_id) if persona_id is not None else None
+        if row is None:
+            return None
+        persona = {'name': self.names[row], 'age': int(self.ages[row])}
+        persona.update((field, column[row]) for field, column in self.columns.items())
+        persona['current_products'] = list(persona['current_products'])
+        return MappingProxyType(persona)
+
+    def label(self, persona_id):
+        row = self._row(persona_id)
+        return f"{self.columns['avatar'][row]} {self.names[row]}"
+
+    def search(self, query, limit=PERSONA_SEARCH_LIMIT):
+        # Customer IDs starting with the query, then names starting with it; an empty query lists names A-Z
+        query = query.strip()
+        if not query:
+            return [self.ids[row] for row in self._name_order[:limit]]
+        matches = []
+        row = bisect.bisect_left(self.ids, query)
+        while row < len(self.ids) and len(matches) < limit and self.ids[row].startswith(query):
+            matches.append(self.ids[row])
+            row += 1
+        key = query.lower()
+        i = bisect.bisect_left(self._name_keys, key)
+        while i < len(self._name_keys) and len(matches) < limit and self._name_keys[i].startswith(key):
+            persona_id = self.ids[self._name_order[i]]
+            if persona_id not in matches:
+                matches.append(persona_id)
+            i += 1
+        return matches
+
+def iter_persona_file(path):
+    # JSONL with one profile object per line, or CSV with a header row; products are ';'-separated in CSV
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+@st.cache_resource
+def get_persona_catalog():
+    if PERSONA_CATALOG_PATH:
+        return PersonaCatalog.from_records(iter_persona_file(PERSONA_CATALOG_PATH))
+    return PersonaCatalog.from_records({'id': persona_id, **persona} for persona_id, persona in PERSONAS_CONFIG.items())
+
+def session_persona(catalog):
+    # The session's own edits (current_user_data) layered over the shared base persona
+    return ChainMap(st.session_state.current_user_data, catalog.get(st.session_state.current_user) or {})
+
 # Enhanced base goal categories with health insurance priority
 BASE_GOAL_CATEGORIES = [
     "Health Insurance Coverage",  # Highest priority
@@ -68,25 +754,1112 @@ BASE_GOAL_CATEGORIES = [
     "Financial Education"
 ]
 
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Upper bound on concurrent quest generation calls when fanning out across goals
+QUEST_FANOUT_WORKERS = 6
+
+# A progressive batch of advanced quests unlocks after every N completions per goal
+PROGRESSIVE_QUEST_INTERVAL = 3
+PREFETCH_WORKERS = 4
+
+# Shared state: progress, generated content and the response cache live behind a small KV interface so several
+# Streamlit worker processes (or hosts) can serve the same users without sticky sessions
+SHARED_STATE_URL = os.environ.get("LIFEQUEST_STATE_URL", "sqlite:///.lifequest_state.sqlite3")
+SHARED_STATE_BUSY_TIMEOUT_SECONDS = 10.0
+SHARED_STATE_MAX_PARAMS = 500
+
+class SharedStateBackend(ABC):
+    # String values addressed by (namespace, key) with an optional per-entry TTL. A network store maps a namespace to
+    # a key prefix or hash (e.g. Redis HSET/HMGET per namespace, EXPIRE per key); every method must be safe to call
+    # from many threads and processes at once, and expired entries must never be returned
+    @abstractmethod
+    def get_many(self, namespace, keys):
+        # -> {key: value} for the keys that exist and have not expired
+        ...
+
+    @abstractmethod
+    def put_many(self, namespace, items, ttl_seconds=None):
+        # items: iterable of (key, value); last write wins per key
+        ...
+
+    @abstractmethod
+    def delete_many(self, namespace, keys):
+        ...
+
+    @abstractmethod
+    def scan(self, namespace):
+        # -> list of (key, value) for every live entry in the namespace
+        ...
+
+    def get_entries(self, namespace, keys):
+        # -> {key: (value, expires_at)}; expires_at is None for entries without a TTL or stores that cannot report it
+        return {key: (value, None) for key, value in self.get_many(namespace, keys).items()}
+
+    def trim(self, namespace, max_entries):
+        # Drop expired entries and the least recently written beyond max_entries; returns how many were removed.
+        # Stores with native eviction (maxmemory policies, TTL indexes) may leave this as a no-op
+        return 0
+
+    def get(self, namespace, key):
+        return self.get_many(namespace, [key]).get(key)
+
+    def put(self, namespace, key, value, ttl_seconds=None):
+        self.put_many(namespace, [(key, value)], ttl_seconds)
+
+class MemoryStateBackend(SharedStateBackend):
+    # Single-process backend for tests and one-worker deployments
+    def __init__(self):
+        self._namespaces = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def get_many(self, namespace, keys):
+        return {key: value for key, (value, _) in self.get_entries(namespace, keys).items()}
+
+    def get_entries(self, namespace, keys):
+        now = time.time()
+        with self._lock:
+            entries = self._namespaces[namespace]
+            found = {key: entries[key] for key in keys if key in entries}
+        return {key: (value, expires_at) for key, (value, _, expires_at) in found.items()
+                if expires_at is None or expires_at > now}
+
+    def put_many(self, namespace, items, ttl_seconds=None):
+        now = time.time()
+        expires_at = now + ttl_seconds if ttl_seconds else None
+        with self._lock:
+            entries = self._namespaces[namespace]
+            for key, value in items:
+                entries.pop(key, None)
+                entries[key] = (value, now, expires_at)
+
+    def delete_many(self, namespace, keys):
+        with self._lock:
+            entries = self._namespaces[namespace]
+            for key in keys:
+                entries.pop(key, None)
+
+    def scan(self, namespace):
+        now = time.time()
+        with self._lock:
+            entries = list(self._namespaces[namespace].items())
+        return [(key, value) for key, (value, _, expires_at) in entries if expires_at is None or expires_at > now]
+
+    def trim(self, namespace, max_entries):
+        now = time.time()
+        with self._lock:
+            entries = self._namespaces[namespace]
+            expired = [key for key, (_, _, expires_at) in entries.items() if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del entries[key]
+            # Insertion order is write order, so the oldest writes come first
+            overflow = list(islice(entries, max(0, len(entries) - max_entries)))
+            for key in overflow:
+                del entries[key]
+        return len(expired) + len(overflow)
+
+class SQLiteStateBackend(SharedStateBackend):
+    # One WAL database shared by every worker process on a host; each process opens its own connection and writers
+    # serialise on SQLite's file lock, waiting up to the busy timeout instead of failing
+    def __init__(self, path, busy_timeout=SHARED_STATE_BUSY_TIMEOUT_SECONDS):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._write([
+            ("CREATE TABLE IF NOT EXISTS state ("
+             "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, expires_at REAL, "
+             "PRIMARY KEY (namespace, key)) WITHOUT ROWID", ()),
+            ("CREATE INDEX IF NOT EXISTS state_updated_at ON state (namespace, updated_at)", ()),
+        ])
+
+    def _write(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front, so a busy database waits on the timeout rather than
+        # failing a read-to-write upgrade mid-transaction; returns the total rows changed
+        changed = 0
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        changed += self._db.executemany(sql, params).rowcount
+                    else:
+                        changed += self._db.execute(sql, params).rowcount
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return max(changed, 0)
+
+    def get_many(self, namespace, keys):
+        return {key: value for key, (value, _) in self.get_entries(namespace, keys).items()}
+
+    def get_entries(self, namespace, keys):
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SHARED_STATE_MAX_PARAMS):
+                chunk = keys[start:start + SHARED_STATE_MAX_PARAMS]
+                rows = self._db.execute(
+                    f"SELECT key, value, expires_at FROM state WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))}) "
+                    "AND (expires_at IS NULL OR expires_at > ?)", (namespace, *chunk, now)
+                ).fetchall()
+                found.update((key, (value, expires_at)) for key, value, expires_at in rows)
+        return found
+
+    def put_many(self, namespace, items, ttl_seconds=None):
+        now = time.time()
+        expires_at = now + ttl_seconds if ttl_seconds else None
+        rows = [(namespace, key, value, now, expires_at) for key, value in items]
+        if rows:
+            self._write([("INSERT OR REPLACE INTO state (namespace, key, value, updated_at, expires_at) "
+                          "VALUES (?, ?, ?, ?, ?)", rows)])
+
+    def delete_many(self, namespace, keys):
+        rows = [(namespace, key) for key in keys]
+        if rows:
+            self._write([("DELETE FROM state WHERE namespace = ? AND key = ?", rows)])
+
+    def scan(self, namespace):
+        with self._lock:
+            return self._db.execute(
+                "SELECT key, value FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, time.time())
+            ).fetchall()
+
+    def trim(self, namespace, max_entries):
+        return self._write([
+            ("DELETE FROM state WHERE namespace = ? AND expires_at <= ?", (namespace, time.time())),
+            ("DELETE FROM state WHERE namespace = ? AND key IN (SELECT key FROM state WHERE namespace = ? "
+             "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)", (namespace, namespace, max_entries)),
+        ])
+
+# URL scheme -> factory taking the rest of the URL; a network store registers itself here
+STATE_BACKENDS = {
+    # sqlite:///relative/path.db or sqlite:////absolute/path.db, as in SQLAlchemy URLs
+    'sqlite': lambda location: SQLiteStateBackend(location[1:] if location.startswith("/") else location),
+    'memory': lambda location: MemoryStateBackend(),
+}
+
+def state_backend_from_url(url):
+    scheme, _, location = url.partition("://")
+    if scheme not in STATE_BACKENDS:
+        raise ValueError(f"Unsupported shared state URL {url!r}; known schemes: {', '.join(sorted(STATE_BACKENDS))}")
+    return STATE_BACKENDS[scheme](location)
+
+@st.cache_resource
+def get_shared_state():
+    return state_backend_from_url(SHARED_STATE_URL)
+
+# LLM response cache settings: a per-process memory tier in front of the shared "responses" namespace
+RESPONSE_CACHE_NAMESPACE = "responses"
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+RESPONSE_CACHE_SHARED_ENTRIES = 5000
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESPONSE_CACHE_TRIM_EVERY = 100
+
+class ResponseCache:
+    def __init__(self, backend=None, memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                 shared_entries=RESPONSE_CACHE_SHARED_ENTRIES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                 trim_every=RESPONSE_CACHE_TRIM_EVERY):
+        self.backend = backend
+        self.memory_entries = memory_entries
+        self.shared_entries = shared_entries
+        self.ttl_seconds = ttl_seconds
+        self.trim_every = trim_every
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, response_format=None):
+        request = {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if response_format:
+            request['response_format'] = response_format
+        payload = json.dumps(request, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+        # Another worker process may already have paid for this response; its copy here expires when the shared one does
+        found = self.backend.get_entries(RESPONSE_CACHE_NAMESPACE, [key]) if self.backend is not None else {}
+        with self._lock:
+            if key not in found:
+                self.stats['misses'] += 1
+                return None
+            value, expires_at = found[key]
+            self._remember(key, value, expires_at or now + self.ttl_seconds)
+            self.stats['shared_hits'] += 1
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._remember(key, value, time.time() + self.ttl_seconds)
+            self.stats['writes'] += 1
+            should_trim = self.stats['writes'] % self.trim_every == 0
+        if self.backend is None:
+            return
+        self.backend.put(RESPONSE_CACHE_NAMESPACE, key, value, self.ttl_seconds)
+        if should_trim:
+            evicted = self.backend.trim(RESPONSE_CACHE_NAMESPACE, self.shared_entries)
+            with self._lock:
+                self.stats['evictions'] += evicted
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def hit_rate(self):
+        hits = self.stats['memory_hits'] + self.stats['shared_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(get_shared_state())
+
+# Structured output: agents request JSON mode with compact keys, and responses are validated and repaired locally
+REQUIRED = object()
+
+QUESTION_FIELDS = {
+    'q': ('question', str, REQUIRED),
+    'o': ('options', [str], REQUIRED),
+    'c': ('correct', 'option_index', 0),
+    'e': ('explanation', str, ''),
+}
+
+GOAL_FIELDS = {
+    't': ('title', str, REQUIRED),
+    'd': ('description', str, ''),
+    'p': ('priority', ('High', 'Medium', 'Low'), 'Medium'),
+    'tl': ('timeline', ('Short term', 'Medium term', 'Long term'), 'Medium term'),
+    'c': ('category', tuple(BASE_GOAL_CATEGORIES), 'Financial Education'),
+    'a': ('target_amount', int, 0),
+    'df': ('difficulty', ('Beginner', 'Intermediate', 'Advanced'), 'Beginner'),
+    'w': ('why_important', str, ''),
+}
+
+QUEST_FIELDS = {
+    't': ('title', str, REQUIRED),
+    'd': ('description', str, ''),
+    'ty': ('type', ('learning', 'action', 'quiz', 'challenge'), 'learning'),
+    'pt': ('points', int, 150),
+    'df': ('difficulty', ('Easy', 'Medium', 'Hard'), 'Medium'),
+    'et': ('estimated_time', str, '1-2 minutes'),
+    'r': ('unlock_reward', str, ''),
+    'lc': ('learning_content', str, None),
+    's': ('action_steps', [str], None),
+    'q': ('questions', [QUESTION_FIELDS], None),
+}
+
+QUEST_DETAIL_FIELDS = {
+    'lc': ('learning_content', str, None),
+    's': ('action_steps', [str], None),
+    'q': ('questions', [QUESTION_FIELDS], None),
+}
+
+NUDGE_FIELDS = {
+    'm': ('message', str, REQUIRED),
+    'a': ('action', str, REQUIRED),
+    'u': ('urgency', ('High', 'Medium', 'Low'), 'Medium'),
+    'r': ('reward_mention', str, ''),
+    'mo': ('motivation', str, ''),
+}
+
+# kind: (item fields, True if the response holds a list of items)
+STRUCTURED_SCHEMAS = {
+    'goals': (GOAL_FIELDS, True),
+    'quests': (QUEST_FIELDS, True),
+    'quest_details': (QUEST_DETAIL_FIELDS, False),
+    'nudge': (NUDGE_FIELDS, False),
+}
+
+QUEST_POINTS_RANGE = (50, 500)
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def repair_json_text(text):
+    # Returns the decoded JSON value and whether the text needed repairing to decode
+    text = text.strip()
+    match = re.search(r'```(?:json)?(.*?)(```|$)', text, re.DOTALL)
+    if match:
+        text = match.group(1).strip()
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        raise json.JSONDecodeError("No JSON value found", text, 0)
+    text = re.sub(r',\s*([}\]])', r'\1', text[min(starts):])
+    try:
+        return json.loads(text), True
+    except json.JSONDecodeError:
+        pass
+    # Truncated output: cut back to the last complete value inside a container and close what is still open
+    stack, in_string, escaped, cut = [], False, False, None
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+            if not stack:
+                return json.loads(text[:i + 1]), True
+            cut = (i + 1, list(stack))
+    if cut is None:
+        raise json.JSONDecodeError("Unrecoverable JSON", text, 0)
+    end, open_closers = cut
+    return json.loads(text[:end] + ''.join(reversed(open_closers))), True
+
+class StructuredOutputStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'responses': 0, 'parse_failures': 0, 'json_repaired': 0, 'fields_repaired': 0,
+                       'items_dropped': 0, 'key_chars_saved': 0}
+
+    def record(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self.counts[name] += delta
+
+    def parse_failure_rate(self):
+        return self.counts['parse_failures'] / self.counts['responses'] if self.counts['responses'] else 0.0
+
+    def output_tokens_saved(self):
+        return estimate_tokens(' ' * self.counts['key_chars_saved'])
+
+@st.cache_resource
+def get_structured_output_stats():
+    return StructuredOutputStats()
+
+def _coerce_field(value, spec, report):
+    if isinstance(spec, list):
+        items = value if isinstance(value, list) else [value]
+        if isinstance(spec[0], dict):
+            coerced = [_validate_item(item, spec[0], report) for item in items]
+            return [item for item in coerced if item is not None] or None
+        coerced = [str(item).strip() for item in items if item not in (None, '')]
+        return coerced or None
+    if isinstance(spec, tuple):
+        text = str(value).strip().lower()
+        for choice in spec:
+            if choice.lower() == text:
+                return choice
+        for choice in spec:
+            if text and (text in choice.lower() or choice.lower() in text):
+                report['fields_repaired'] += 1
+                return choice
+        return None
+    if spec is int:
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return int(value)
+        digits = re.sub(r'[^\d.]', '', str(value).split('-')[0])
+        try:
+            number = int(float(digits))
+        except ValueError:
+            # "£1.000.000", "v1.2.3" or no digits at all: the field falls back to its default
+            return None
+        report['fields_repaired'] += 1
+        return number
+    if spec == 'option_index':
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        text = str(value).strip()
+        report['fields_repaired'] += 1
+        if len(text) == 1 and text.upper() in 'ABCDEFGH':
+            return 'ABCDEFGH'.index(text.upper())
+        return int(text) if text.isdigit() else text
+    if isinstance(value, (list, dict)):
+        report['fields_repaired'] += 1
+        return '\n'.join(str(v) for v in value) if isinstance(value, list) else json.dumps(value)
+    return str(value).strip()
+
+def _validate_item(item, fields, report):
+    if not isinstance(item, dict):
+        report['items_dropped'] += 1
+        return None
+    result = {}
+    for short, (name, spec, default) in fields.items():
+        if short in item:
+            value = item[short]
+            report['key_chars_saved'] += len(name) - len(short)
+        else:
+            value = item.get(name)
+        coerced = _coerce_field(value, spec, report) if value not in (None, '') else None
+        if coerced is None:
+            if default is REQUIRED:
+                report['items_dropped'] += 1
+                return None
+            if default is None:
+                continue
+            if value is not None:
+                report['fields_repaired'] += 1
+            coerced = default
+        result[name] = coerced
+    if 'options' in result:
+        correct = result['correct']
+        if isinstance(correct, str):
+            matches = [i for i, option in enumerate(result['options']) if option.lower() == correct.lower()]
+            correct = matches[0] if matches else -1
+        if len(result['options']) < 2 or not 0 <= correct < len(result['options']):
+            report['items_dropped'] += 1
+            return None
+        result['correct'] = correct
+    if 'points' in result:
+        clamped = min(max(result['points'], QUEST_POINTS_RANGE[0]), QUEST_POINTS_RANGE[1])
+        if clamped != result['points']:
+            report['fields_repaired'] += 1
+            result['points'] = clamped
+    return result
+
+def _new_parse_report():
+    return {'responses': 1, 'parse_failures': 0, 'json_repaired': 0, 'fields_repaired': 0,
+            'items_dropped': 0, 'key_chars_saved': 0}
+
+def parse_structured_output(response, kind, report=None):
+    fields, is_list = STRUCTURED_SCHEMAS[kind]
+    stats = get_structured_output_stats()
+    report = _new_parse_report() if report is None else report
+    try:
+        data, repaired = repair_json_text(response)
+    except json.JSONDecodeError:
+        report['parse_failures'] = 1
+        stats.record(**report)
+        return None
+    report['json_repaired'] = int(repaired)
+    if is_list and isinstance(data, dict):
+        # JSON mode always returns an object, so the list sits under a single wrapper key
+        data = next((value for value in data.values() if isinstance(value, list)), [data])
+    if is_list:
+        items = [_validate_item(item, fields, report) for item in (data if isinstance(data, list) else [data])]
+        result = [item for item in items if item is not None] or None
+    else:
+        result = _validate_item(data[0] if isinstance(data, list) and data else data, fields, report)
+    if result is None:
+        report['parse_failures'] = 1
+    stats.record(**report)
+    return result
+
+class IncrementalJSONArrayParser:
+    # Decodes the objects of the first JSON array in a streamed document, each as soon as its closing brace arrives
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._array_depth = None
+        self._item_start = None
+
+    def feed(self, chunk):
+        self._text += chunk
+        items = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._stack.append(char)
+                if char == '[' and self._array_depth is None:
+                    self._array_depth = len(self._stack)
+                elif char == '{' and self._array_depth is not None and len(self._stack) == self._array_depth + 1:
+                    self._item_start = i
+            elif char in '}]' and self._stack:
+                self._stack.pop()
+                if char == '}' and self._item_start is not None and len(self._stack) == self._array_depth:
+                    try:
+                        items.append(json.loads(text[self._item_start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._item_start = None
+        self._pos = len(text)
+        return items
+
+def stream_structured_items(chunks, kind, report=None):
+    fields, _ = STRUCTURED_SCHEMAS[kind]
+    parser = IncrementalJSONArrayParser()
+    report = _new_parse_report() if report is None else report
+    produced = 0
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            item = _validate_item(item, fields, report)
+            if item is not None:
+                produced += 1
+                yield item
+    if not produced:
+        report['parse_failures'] = 1
+    get_structured_output_stats().record(**report)
+
+# Near-duplicate quests: MinHash signatures over the words of a quest's text, bucketed with LSH so a lookup only
+# compares against quests that share at least one band
+QUEST_MINHASH_PERMUTATIONS = 64
+QUEST_LSH_BANDS = 16
+QUEST_DUPLICATE_THRESHOLD = 0.6
+QUEST_LIBRARY_MAX_ENTRIES = 200_000
+MINHASH_PRIME = (1 << 31) - 1
+SHINGLE_STOPWORDS = frozenset("a an and the to of for in on your you with is are be it this that by at or as".split())
+
+def quest_shingles(quest):
+    # Distinct words of title, description and quiz text, lower-cased with plurals folded. Single words rather than
+    # n-grams, because reworded quests keep their vocabulary but rarely their word order
+    parts = [quest.get('title', ''), quest.get('description', '')]
+    parts += [q.get('question', '') for q in quest.get('questions') or () if isinstance(q, dict)]
+    return {w[:-1] if len(w) > 3 and w.endswith('s') else w
+            for w in re.findall(r"[a-z0-9£]+", " ".join(parts).lower()) if w not in SHINGLE_STOPWORDS}
+
+@functools.lru_cache(maxsize=None)
+def minhash_permutations(permutations, seed=1):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, MINHASH_PRIME, permutations, dtype=np.uint64)[:, None],
+            rng.integers(0, MINHASH_PRIME, permutations, dtype=np.uint64)[:, None])
+
+class QuestDedupIndex:
+    def __init__(self, threshold=QUEST_DUPLICATE_THRESHOLD, permutations=QUEST_MINHASH_PERMUTATIONS,
+                 bands=QUEST_LSH_BANDS, max_entries=QUEST_LIBRARY_MAX_ENTRIES, capacity=1024):
+        # Every index uses the same hash permutations, so signatures are comparable between indexes
+        self._a, self._b = minhash_permutations(permutations)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = permutations // bands
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._signatures = np.empty((capacity, permutations), dtype=np.uint32)
+        self.entries = []
+        self._buckets = defaultdict(list)
+        self.stats = {'lookups': 0, 'duplicates': 0, 'added': 0}
+
+    def signature(self, quest):
+        shingles = quest_shingles(quest)
+        if not shingles:
+            return None
+        x = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles)) % MINHASH_PRIME
+        return ((self._a * x + self._b) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def find(self, signature):
+        # The most similar indexed entry whose estimated Jaccard similarity reaches the threshold, or None
+        if signature is None:
+            return None
+        with self._lock:
+            self.stats['lookups'] += 1
+            candidates = {row for key in self._band_keys(signature) for row in self._buckets.get(key, ())}
+            if not candidates:
+                return None
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarity = (self._signatures[rows] == signature).mean(axis=1)
+            best = int(similarity.argmax())
+            if similarity[best] < self.threshold:
+                return None
+            self.stats['duplicates'] += 1
+            return self.entries[rows[best]]
+
+    def add(self, signature, entry):
+        if signature is None:
+            return False
+        with self._lock:
+            row = len(self.entries)
+            if row >= self.max_entries:
+                return False
+            if row == len(self._signatures):
+                self._signatures = np.concatenate([self._signatures, np.empty_like(self._signatures)])
+            self._signatures[row] = signature
+            self.entries.append(entry)
+            for key in self._band_keys(signature):
+                self._buckets[key].append(row)
+            self.stats['added'] += 1
+            return True
+
+    def __len__(self):
+        return len(self.entries)
+
+@st.cache_resource
+def get_quest_library():
+    # Process-wide library of distinct quests seen across all users, stored with personal details templated out
+    return QuestDedupIndex()
+
+def register_in_library(library, quest):
+    # Returns the library entry for a quest (already templated), adding it when nothing similar is indexed yet
+    signature = library.signature(quest)
+    entry = library.find(signature)
+    if entry is not None:
+        return entry, False
+    entry = {'library_id': quest.get('library_id') or f"lib_{uuid.uuid4().hex[:12]}", 'title': quest.get('title', '')}
+    return entry, library.add(signature, entry)
+
+def dedupe_quests(quests, existing=(), library=None, goal_data=None, persona_data=None):
+    # Drops quests that near-duplicate one in existing (the goal's current quests) or an earlier one in the batch.
+    # With nothing existing the first quest is always kept. Kept quests are tagged with their entry in the shared
+    # library, which they join if they are new to every user
+    local = QuestDedupIndex(capacity=64)
+    for quest in existing:
+        local.add(local.signature(quest), quest)
+    kept = []
+    for quest in quests:
+        signature = local.signature(quest)
+        if local.find(signature) is not None:
+            continue
+        local.add(signature, quest)
+        kept.append(quest)
+        if library is not None:
+            text = template_quest(quest, goal_data, persona_data) if goal_data and persona_data else quest
+            quest['library_id'] = register_in_library(library, text)[0]['library_id']
+    return kept
+
+# Cohort quest pool: pregenerated quest batches per (category, stage, age band, risk profile)
+QUEST_POOL_PATH = os.environ.get("LIFEQUEST_QUEST_POOL_PATH", "quest_pool.json.gz")
+QUEST_POOL_TTL_SECONDS = 30 * 24 * 3600
+QUEST_POOL_NAMESPACE_PREFIX = "quest_pool."
+AGE_BANDS = [(24, "18-24"), (34, "25-34"), (49, "35-49"), (200, "50+")]
+RISK_PROFILES = ["Conservative", "Moderate", "Aggressive"]
+QUEST_STAGES = {"beginner": 0, "intermediate": 2, "advanced": 5}
+
+# Representative goal and persona used when pregenerating a cohort; personal values are templated out afterwards
+POOL_GOAL_TEMPLATES = {
+    "Health Insurance Coverage": ("Get Comprehensive Health Insurance", 2000),
+    "Emergency Fund Building": ("Build Emergency Fund", 10000),
+    "Income Protection": ("Protect Your Income", 3000),
+    "Debt Management": ("Pay Down Your Debt", 5000),
+    "Investment Planning": ("Start Investment Portfolio", 5000),
+    "Retirement Planning": ("Boost Your Retirement Savings", 20000),
+    "Life Insurance Coverage": ("Get Life Insurance Coverage", 1500),
+    "Financial Education": ("Build Your Financial Knowledge", 500),
+}
+POOL_PERSONA_NAME = "Alex Morgan"
+
+def age_band(age):
+    for upper, label in AGE_BANDS:
+        if age <= upper:
+            return label
+    return AGE_BANDS[-1][1]
+
+def quest_cohort(goal_data, persona_data, quest_stage):
+    return "|".join([goal_data['category'], quest_stage, age_band(persona_data['age']), persona_data.get('risk_profile', 'Moderate')])
+
+def _map_quest_text(value, fn):
+    if isinstance(value, str):
+        return fn(value)
+    if isinstance(value, list):
+        return [_map_quest_text(item, fn) for item in value]
+    if isinstance(value, dict):
+        return {key: (_map_quest_text(item, fn) if key not in ('id', 'goal_id', 'stage', 'type', 'goal_category') else item)
+                for key, item in value.items()}
+    return value
+
+def _template_values(goal_data, persona_data):
+    amount = int(goal_data.get('target_amount') or 0)
+    full_name = persona_data['name']
+    values = [(f"£{amount:,}", "{target_amount}"), (f"£{amount}", "{target_amount}")] if amount else []
+    return values + [
+        (goal_data['title'], "{goal_title}"),
+        (full_name, "{name}"), (full_name.split()[0], "{first_name}"),
+    ]
+
+def _whole_token_pattern(value):
+    # "Tom" must not match inside "Tomorrow", nor "£500" at the start of "£5000", "£500,000" or "£500.50"
+    if value[0] in "£0123456789":
+        return re.compile(rf"(?<![\w,.]){re.escape(value)}(?!\d|[,.]\d)")
+    return re.compile(rf"(?<!\w){re.escape(value)}(?!\w)")
+
+def replace_whole_tokens(text, values):
+    for value, token in values:
+        if value:
+            text = _whole_token_pattern(value).sub(lambda match: token, text)
+    return text
+
+def template_text(text, goal_data, persona_data):
+    return replace_whole_tokens(text, _template_values(goal_data, persona_data))
+
+def template_quest(quest, goal_data, persona_data):
+    quest = {key: value for key, value in quest.items() if key not in ('id', 'goal_id', 'stage')}
+    return _map_quest_text(quest, lambda text: template_text(text, goal_data, persona_data))
+
+def render_quest_template(quest, goal_data, persona_data):
+    replacements = [(token, value) for value, token in _template_values(goal_data, persona_data)]
+    def from_template(text):
+        if '{' not in text:
+            return text
+        for token, value in replacements:
+            text = text.replace(token, value)
+        return text
+    return _map_quest_text(quest, from_template)
+
+class QuestPool:
+    def __init__(self, path=QUEST_POOL_PATH, ttl_seconds=QUEST_POOL_TTL_SECONDS, library=None, shared=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.library = library
+        self.shared = shared
+        self._cohorts = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale_batches': 0, 'exhausted': 0, 'duplicate_batches': 0,
+                      'shared_batches': 0}
+        if path and os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                self._cohorts = json.load(f)
+        if library is not None:
+            for batches in self._cohorts.values():
+                for batch in batches:
+                    for quest in batch['quests']:
+                        register_in_library(library, quest)
+
+    def draw(self, cohort, exclude_titles=()):
+        # Returns a fresh templated batch not yet served to this user, or None if the cohort needs the LLM
+        fresh, unseen = self._candidates(cohort, exclude_titles)
+        if not unseen and self.shared is not None and self._pull(cohort):
+            fresh, unseen = self._candidates(cohort, exclude_titles)
+        with self._lock:
+            if not unseen:
+                self.stats['exhausted' if fresh else 'misses'] += 1
+                return None
+            self.stats['hits'] += 1
+        return random.choice(unseen)['quests']
+
+    def _candidates(self, cohort, exclude_titles):
+        now = time.time()
+        with self._lock:
+            batches = self._cohorts.get(cohort, [])
+            fresh = [b for b in batches if now - b['created_at'] <= self.ttl_seconds]
+            self.stats['stale_batches'] += len(batches) - len(fresh)
+        return fresh, [b for b in fresh if not any(q['title'] in exclude_titles for q in b['quests'])]
+
+    def _pull(self, cohort):
+        # Picks up batches other worker processes generated for this cohort; True if any were new here
+        rows = self.shared.scan(QUEST_POOL_NAMESPACE_PREFIX + cohort)
+        with self._lock:
+            batches = self._cohorts.setdefault(cohort, [])
+            known = {b.get('id') for b in batches}
+            pulled = [json.loads(payload) for batch_id, payload in rows if batch_id not in known]
+            batches.extend(pulled)
+            self.stats['shared_batches'] += len(pulled)
+        if self.library is not None:
+            for batch in pulled:
+                for quest in batch['quests']:
+                    register_in_library(self.library, quest)
+        return bool(pulled)
+
+    def add(self, cohort, quests, goal_data, persona_data, save=True):
+        batch = {'id': uuid.uuid4().hex, 'created_at': time.time(),
+                 'quests': [template_quest(q, goal_data, persona_data) for q in quests]}
+        # A batch that mostly rewords quests already pooled for this cohort would only bloat it. Other cohorts are
+        # not compared: the same category in another age band still needs batches of its own
+        cohort_index = QuestDedupIndex(capacity=64)
+        with self._lock:
+            pooled = [quest for b in self._cohorts.get(cohort, []) for quest in b['quests']]
+        for quest in pooled:
+            cohort_index.add(cohort_index.signature(quest), quest)
+        repeats = sum(1 for quest in batch['quests'] if cohort_index.find(cohort_index.signature(quest)) is not None)
+        if repeats * 2 > len(batch['quests']):
+            with self._lock:
+                self.stats['duplicate_batches'] += 1
+            return
+        if self.library is not None:
+            for quest in batch['quests']:
+                quest['library_id'] = register_in_library(self.library, quest)[0]['library_id']
+        with self._lock:
+            batches = [b for b in self._cohorts.get(cohort, []) if time.time() - b['created_at'] <= self.ttl_seconds]
+            self._cohorts[cohort] = batches + [batch]
+        if self.shared is not None:
+            self.shared.put(QUEST_POOL_NAMESPACE_PREFIX + cohort, batch['id'], json.dumps(batch, separators=(',', ':')),
+                            self.ttl_seconds)
+        if save:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            payload = json.dumps(self._cohorts, separators=(',', ':'))
+        # Per-writer temp name: concurrent saves from several threads or processes must not share one file
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def cohort_count(self):
+        with self._lock:
+            return len(self._cohorts)
+
+@st.cache_resource
+def get_quest_pool():
+    return QuestPool(library=get_quest_library(), shared=get_shared_state())
+
+def pregenerate_quest_pool(quest_agent, pool, batches_per_cohort=1, workers=QUEST_FANOUT_WORKERS):
+    jobs = []
+    for category, (title, amount) in POOL_GOAL_TEMPLATES.items():
+        for stage, completed_count in QUEST_STAGES.items():
+            for upper, band in AGE_BANDS:
+                for risk in RISK_PROFILES:
+                    goal = {'id': 'goal_pool', 'title': title, 'description': f"{title} ({category})",
+                            'category': category, 'target_amount': amount, 'priority': 'High'}
+                    persona = {'name': POOL_PERSONA_NAME, 'age': min(upper, 60), 'occupation': 'Professional',
+                               'income_range': '£30,000-£50,000', 'risk_profile': risk}
+                    jobs.extend([(goal, persona, completed_count)] * batches_per_cohort)
+
+    def run(job):
+        # A job whose LLM call failed adds nothing, rather than pooling the canned defaults for the whole TTL
+        goal, persona, completed_count = job
+        quests = quest_agent.generate_quests_for_goal(goal, persona, completed_count, use_pool=False, use_defaults=False)
+        if not quests:
+            return False
+        pool.add(quest_cohort(goal, persona, quest_agent._determine_quest_stage(completed_count)),
+                 quests, goal, persona, save=False)
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        generated = sum(executor.map(run, jobs))
+    pool.save()
+    return generated
+
+# Prompt building: static instructions first so provider prefix caching applies, bounded per-user context after
+PROMPT_TOKEN_BUDGETS = {"coach": 2200, "nudge": 450}
+DIGEST_MAX_PRODUCTS = 5
+DIGEST_MAX_RECENT_QUESTS = 3
+DIGEST_MAX_FIELD_CHARS = 160
+
+prompt_logger = logger.getChild("prompts")
+
+def _clip(text, limit=DIGEST_MAX_FIELD_CHARS):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def progress_digest(user_progress, persona_data, recent_quest_titles=()):
+    # Fixed-size summary of a user's state; grows with nothing but the clipped field lengths
+    goal = user_progress.get('current_goal')
+    products = list(dict.fromkeys(user_progress.get('unlocked_products', [])))
+    lines = [
+        f"User: {persona_data['name']}, {persona_data['age']}, {persona_data['occupation']}, "
+        f"income {persona_data['income_range']}, {persona_data['risk_profile']} risk",
+        f"Progress: level {user_progress['level']}, {user_progress['total_points']} points, "
+        f"{len(user_progress['completed_quests'])} quests completed",
+    ]
+    if goal:
+        lines.append(f"Current goal: {_clip(goal['title'])} ({goal.get('category', 'General')}, "
+                     f"target £{goal.get('target_amount', 0)}, {goal.get('priority', 'Medium')} priority, {goal.get('timeline', '')})")
+    else:
+        lines.append("Current goal: none selected")
+    if products:
+        extra = len(products) - DIGEST_MAX_PRODUCTS
+        lines.append("Unlocked: " + ", ".join(products[:DIGEST_MAX_PRODUCTS]) + (f" (+{extra} more)" if extra > 0 else ""))
+    if recent_quest_titles:
+        lines.append("Recent quests: " + "; ".join(_clip(t, 60) for t in list(recent_quest_titles)[-DIGEST_MAX_RECENT_QUESTS:]))
+    return "\n".join(lines)
+
+class PromptBuilder:
+    def __init__(self, agent, instructions, budget=None):
+        self.agent = agent
+        self.instructions = instructions.strip()
+        self.budget = budget or PROMPT_TOKEN_BUDGETS[agent]
+
+    def build(self, context, user_content, uncompacted=None, history=()):
+        # The instructions message is byte-identical for every user; only the trailing messages vary.
+        # History is already windowed by the caller and sits between the user context and the new question
+        history = list(history)
+        fixed = estimate_tokens(self.instructions) + estimate_tokens(user_content) + sum(estimate_tokens(m['content']) for m in history)
+        room = max(self.budget - fixed, 0) * 4
+        if len(context) > room:
+            context = context[:room].rsplit("\n", 1)[0]
+        messages = [
+            {"role": "system", "content": self.instructions},
+            {"role": "system", "content": f"User context:\n{context}"},
+            *history,
+            {"role": "user", "content": user_content},
+        ]
+        after = sum(estimate_tokens(m['content']) for m in messages)
+        before = fixed + estimate_tokens(uncompacted) if uncompacted is not None else after
+        prompt_logger.info("%s prompt tokens: %d before compaction, %d after (budget %d)", self.agent, before, after, self.budget)
+        return messages
+
 class AIAgentManager:
-    def __init__(self, client):
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, client, cache=None, scheduler=None, telemetry=None):
         self.client = client
+        self.cache = cache
+        self.scheduler = scheduler
+        self.telemetry = telemetry
     
-    def get_completion(self, messages, temperature=0.7, max_tokens=800):
+    def get_completion(self, messages, temperature=0.7, max_tokens=800, use_cache=True, stream=False, response_format=None, site=None):
+        # Telemetry is keyed by the agent method that asked for the completion unless the caller names the site
+        site = site or sys._getframe(1).f_code.co_name
+        request = {'model': DEFAULT_MODEL, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if response_format:
+            request['response_format'] = response_format
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = ResponseCache.make_key(DEFAULT_MODEL, messages, temperature, max_tokens, response_format)
+        if stream:
+            return self._stream_completion(request, cache_key, site)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self._record(site, cache_hits=1)
+                return cached
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            return response.choices[0].message.content
+            response, dispatched = self._create(request, site, key=cache_key)
+            choice = response.choices[0]
+            if dispatched is not None:
+                self._observe(site, 'latency', time.perf_counter() - dispatched)
+                self._record_usage(site, request, response.usage, choice.finish_reason)
+            content = choice.message.content
+            if cache_key and content:
+                self.cache.set(cache_key, content)
+            return content
         except Exception as e:
             st.error(f"AI Agent Error: {str(e)}")
             return None
 
+    def _create(self, request, site, key=None, **kwargs):
+        # Returns the response and when its successful attempt was dispatched (None if it was coalesced onto another)
+        submitted = time.perf_counter()
+        dispatched = []
+        def call():
+            dispatched.append(time.perf_counter())
+            return self.client.chat.completions.create(**request, **kwargs)
+        self._record(site, calls=1)
+        try:
+            if self.scheduler is None:
+                response = call()
+            else:
+                priority = llm_priority.get()
+                tokens = sum(estimate_tokens(m['content']) for m in request['messages']) + request['max_tokens']
+                priority = self.priority if priority is None else priority
+                if kwargs.get('stream'):
+                    response = self.scheduler.stream(call, tokens, priority)
+                else:
+                    response = self.scheduler.run(call, tokens, priority, key=key)
+        except Exception as error:
+            self._record_labelled(site, 'error', type(error).__name__)
+            logger.warning("%s.%s LLM call failed: %r", type(self).__name__, site, error)
+            raise
+        if not dispatched:
+            # Joined another caller's identical request: no API call of its own, so no tokens to bill this session
+            self._record(site, coalesced=1)
+            record_llm_coalesced()
+            return response, None
+        record_llm_usage(getattr(response, 'usage', None))
+        self._observe(site, 'queue', dispatched[-1] - submitted)
+        return response, dispatched[-1]
+
+    def _record(self, site, **deltas):
+        if self.telemetry is not None:
+            self.telemetry.record(type(self).__name__, site, **deltas)
+
+    def _record_labelled(self, site, label, value):
+        if self.telemetry is not None:
+            self.telemetry.record_labelled(type(self).__name__, site, label, value)
+
+    def _observe(self, site, timing, seconds):
+        if self.telemetry is not None:
+            self.telemetry.observe(type(self).__name__, site, timing, seconds)
+
+    def _record_usage(self, site, request, usage, finish_reason):
+        if self.telemetry is not None:
+            self.telemetry.record_usage(type(self).__name__, site, request['model'], usage, finish_reason)
+
+    def _record_parse(self, site, report):
+        if report['parse_failures']:
+            outcome = 'failed'
+        elif report['json_repaired'] or report['fields_repaired'] or report['items_dropped']:
+            outcome = 'repaired'
+        else:
+            outcome = 'ok'
+        self._record_labelled(site, 'parse', outcome)
+
+    def _record_fallback(self, site):
+        self._record(site, fallbacks=1)
+
+    def get_structured(self, messages, kind, temperature=0.7, max_tokens=800, error_message=None, site=None):
+        site = site or sys._getframe(1).f_code.co_name
+        response = self.get_completion(messages, temperature=temperature, max_tokens=max_tokens,
+                                       response_format={"type": "json_object"}, site=site)
+        if not response:
+            return None
+        report = _new_parse_report()
+        result = parse_structured_output(response, kind, report)
+        self._record_parse(site, report)
+        if result is None and error_message:
+            st.error(error_message)
+        return result
+
+    def _stream_completion(self, request, cache_key, site):
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self._record(site, cache_hits=1)
+                yield cached
+                return
+        parts = []
+        usage = finish_reason = None
+        try:
+            stream, dispatched = self._create(request, site, stream=True, stream_options={'include_usage': True})
+        except Exception as e:
+            st.error(f"AI Agent Error: {str(e)}")
+            return
+        try:
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                    record_llm_usage(usage)
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts and dispatched is not None:
+                        self._observe(site, 'ttft', time.perf_counter() - dispatched)
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            self._record_labelled(site, 'error', type(e).__name__)
+            st.error(f"AI Agent Error: {str(e)}")
+            return
+        if dispatched is not None:
+            self._observe(site, 'latency', time.perf_counter() - dispatched)
+            self._record_usage(site, request, usage, finish_reason)
+        if cache_key and parts:
+            self.cache.set(cache_key, "".join(parts))
+
 class GoalCoachAgent(AIAgentManager):
-    def generate_personalized_goals(self, persona_data):
+    priority = PRIORITY_QUESTS
+
+    def generate_personalized_goals(self, persona_data, use_defaults=True):
         messages = [
             {"role": "system", "content": f"""You are an expert Goal Coach Agent for Lloyds Bank's LifeQuest platform. 
             Generate 4-6 highly personalized financial goals based on the user's profile. 
@@ -108,45 +1881,34 @@ class GoalCoachAgent(AIAgentManager):
             Generate diverse, realistic goals that match their life stage and financial situation.
             For target amounts, use realistic figures based on their income range.
             
-            Return ONLY a JSON array of goals in this exact format:
-            [
+            Return ONLY a JSON object in this exact format, using these short keys:
+            t=title, d=description, p=priority, tl=timeline, c=category, a=target_amount, df=difficulty, w=why_important
+            {{"goals": [
                 {{
-                    "id": "goal_1",
-                    "title": "Get Comprehensive Health Insurance",
-                    "description": "Secure health insurance coverage to protect against medical expenses",
-                    "priority": "High",
-                    "timeline": "Short term",
-                    "category": "Health Insurance Coverage",
-                    "target_amount": 2000,
-                    "difficulty": "Beginner",
-                    "why_important": "Health insurance is essential for financial security and peace of mind"
+                    "t": "Get Comprehensive Health Insurance",
+                    "d": "Secure health insurance coverage to protect against medical expenses",
+                    "p": "High",
+                    "tl": "Short term",
+                    "c": "Health Insurance Coverage",
+                    "a": 2000,
+                    "df": "Beginner",
+                    "w": "Health insurance is essential for financial security and peace of mind"
                 }}
-            ]
+            ]}}
+            Category must be one of: {", ".join(BASE_GOAL_CATEGORIES)}
             
             Make each goal specific to their situation, not generic."""},
             {"role": "user", "content": "Generate personalized financial goals for this user profile."}
         ]
         
-        response = self.get_completion(messages, temperature=0.8)
-        if response:
-            try:
-                response_clean = self._clean_json_response(response)
-                goals = json.loads(response_clean)
-                goals = self._prioritize_health_insurance(goals)
-                return goals
-            except json.JSONDecodeError:
-                st.error("Error parsing AI response for goals")
-                return self._get_default_goals_for_persona(persona_data)
-        return self._get_default_goals_for_persona(persona_data)
-    
-    def _clean_json_response(self, response):
-        match = re.search(r'```json(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        match = re.search(r'```(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        return response.strip()
+        goals = self.get_structured(messages, 'goals', temperature=0.8,
+                                    error_message="Error parsing AI response for goals")
+        if goals:
+            for i, goal in enumerate(goals):
+                goal['id'] = f"goal_{i + 1}"
+            return self._prioritize_health_insurance(goals)
+        self._record_fallback('generate_personalized_goals')
+        return self._get_default_goals_for_persona(persona_data) if use_defaults else None
     
     def _prioritize_health_insurance(self, goals):
         health_goals = [g for g in goals if 'health' in g.get('category', '').lower()]
@@ -159,7 +1921,7 @@ class GoalCoachAgent(AIAgentManager):
                 "priority": "High",
                 "timeline": "Short term",
                 "category": "Health Insurance Coverage",
-                "target_amount": "2000",
+                "target_amount": 2000,
                 "difficulty": "Beginner",
                 "why_important": "Health insurance is essential for financial security"
             }
@@ -217,12 +1979,92 @@ class GoalCoachAgent(AIAgentManager):
             })
         return base_goals
 
+# Two-phase quest generation: a short skeleton list first, then each quest's body when the user opens it
+QUEST_SKELETON_MAX_TOKENS = 600
+QUEST_DETAIL_MAX_TOKENS = {'learning_content': 450, 'action_steps': 250, 'questions': 500}
+QUEST_DETAIL_PROMPTS = {
+    'learning': ('learning_content', "Write 2-3 short but rich paragraphs (lc) explaining the topic in a friendly, educational tone. "
+                 "Use real examples, clarify key terms (e.g. premium, deductible), and avoid robotic one-liner definitions."),
+    'action': ('action_steps', "Write 3-5 concrete action steps (s), using real Lloyds Bank products and services where relevant."),
+    'quiz': ('questions', "Write 1-3 multiple-choice questions (q), each with 4 options, the index of the correct option "
+             "and a one-sentence explanation."),
+}
+
+def quest_detail_field(quest):
+    return 'action' if quest['type'] == 'challenge' else quest['type'] if quest['type'] in QUEST_DETAIL_PROMPTS else 'learning'
+
+def quest_needs_details(quest):
+    return not (quest.get('learning_content') or quest.get('action_steps') or quest.get('questions'))
+
 class QuestAgent(AIAgentManager):
-    def __init__(self, client):
-        super().__init__(client)
-        self.quest_counter = 0
+    priority = PRIORITY_QUESTS
+
+    def __init__(self, client, cache=None, pool=None, scheduler=None, telemetry=None):
+        super().__init__(client, cache, scheduler, telemetry)
+        self.pool = pool
+
+    def generate_quests_for_goal(self, goal_data, persona_data, completed_quests_count=0, exclude_titles=(), use_pool=True,
+                                 use_defaults=True):
+        pooled = self._draw_from_pool(goal_data, persona_data, completed_quests_count, exclude_titles) if use_pool else None
+        if pooled:
+            return pooled
+        messages, quest_stage = self._build_quest_messages(goal_data, persona_data, completed_quests_count)
+        quests = self.get_structured(messages, 'quests', temperature=0.8, max_tokens=QUEST_SKELETON_MAX_TOKENS,
+                                     error_message="Error parsing AI response for quests")
+        if quests:
+            created = int(time.time())
+            for i, quest in enumerate(quests):
+                self._tag_quest(quest, goal_data, quest_stage, i, created)
+            if use_pool and self.pool is not None:
+                self.pool.add(quest_cohort(goal_data, persona_data, quest_stage), quests, goal_data, persona_data)
+            return quests
+        self._record_fallback('generate_quests_for_goal')
+        return self._get_default_quests_for_goal(goal_data) if use_defaults else None
+
+    def stream_quests_for_goal(self, goal_data, persona_data, completed_quests_count=0, exclude_titles=()):
+        # Yields each quest as soon as it is complete in the streamed response
+        pooled = self._draw_from_pool(goal_data, persona_data, completed_quests_count, exclude_titles)
+        if pooled:
+            yield from pooled
+            return
+        messages, quest_stage = self._build_quest_messages(goal_data, persona_data, completed_quests_count)
+        chunks = self.get_completion(messages, temperature=0.8, max_tokens=QUEST_SKELETON_MAX_TOKENS, stream=True,
+                                     response_format={"type": "json_object"})
+        created = int(time.time())
+        quests = []
+        report = _new_parse_report()
+        for i, quest in enumerate(stream_structured_items(chunks, 'quests', report)):
+            self._tag_quest(quest, goal_data, quest_stage, i, created)
+            quests.append(quest)
+            yield quest
+        self._record_parse('stream_quests_for_goal', report)
+        if not quests:
+            self._record_fallback('stream_quests_for_goal')
+            yield from self._get_default_quests_for_goal(goal_data)
+        elif self.pool is not None:
+            self.pool.add(quest_cohort(goal_data, persona_data, quest_stage), quests, goal_data, persona_data)
 
-    def generate_quests_for_goal(self, goal_data, persona_data, completed_quests_count=0):
+    def _draw_from_pool(self, goal_data, persona_data, completed_quests_count, exclude_titles):
+        if self.pool is None:
+            return None
+        quest_stage = self._determine_quest_stage(completed_quests_count)
+        served = {template_text(title, goal_data, persona_data) for title in exclude_titles}
+        templates = self.pool.draw(quest_cohort(goal_data, persona_data, quest_stage), served)
+        if not templates:
+            return None
+        quests = [render_quest_template(q, goal_data, persona_data) for q in templates]
+        created = int(time.time())
+        for i, quest in enumerate(quests):
+            self._tag_quest(quest, goal_data, quest_stage, i, created)
+        return quests
+
+    def _tag_quest(self, quest, goal_data, quest_stage, index, created):
+        quest['id'] = f"quest_{goal_data['id']}_{quest_stage}_{index}_{created}"
+        quest['goal_id'] = goal_data['id']
+        quest['goal_category'] = goal_data['category']
+        quest['stage'] = quest_stage
+
+    def _build_quest_messages(self, goal_data, persona_data, completed_quests_count):
         quest_stage = self._determine_quest_stage(completed_quests_count)
         health_goal = goal_data['category'].lower() == "health insurance"
 
@@ -277,31 +2119,21 @@ class QuestAgent(AIAgentManager):
     - Intermediate: Practical steps and comparisons
     - Advanced: Action items like trials, account setup, product purchases
 
-    Return ONLY a JSON array of quests like this:
+    Return ONLY quest skeletons; learning content, action steps and quiz questions are written later, per quest.
+    Return ONLY a JSON object like this, using these short keys:
+    t=title, d=description, ty=type, pt=points, df=difficulty, et=estimated_time, r=unlock_reward
 
-    [
+    {{"quests": [
         {{
-            "id": "quest_[unique_id]",
-            "title": "Quest Title",
-            "description": "Specific description related to the goal",
-            "type": "learning/action/quiz/challenge",
-            "points": 100-300,
-            "difficulty": "Easy/Medium/Hard",
-            "estimated_time": "1-2 minutes",
-            "unlock_reward": "Specific reward related to goal",
-            "goal_category": "{goal_data['category']}",
-            "learning_content": "For learning quests, provide 2–3 short but rich paragraphs explaining the topic in a friendly, educational tone. Use real examples, clarify key terms (e.g. premium, deductible), and make the user feel informed. Avoid robotic or one-liner definitions.",
-            "action_steps": ["Step 1", "Step 2"] (only for action type),
-            "questions": [
-                {{
-                    "question": "Goal-specific question?",
-                    "options": ["A", "B", "C", "D"],
-                    "correct": 0,
-                    "explanation": "Why this is correct"
-                }}
-            ] (only for quiz type)
+            "t": "Quest Title",
+            "d": "Specific description related to the goal",
+            "ty": "learning/action/quiz/challenge",
+            "pt": 100-300,
+            "df": "Easy/Medium/Hard",
+            "et": "1-2 minutes",
+            "r": "Specific reward related to goal"
         }}
-    ]
+    ]}}
     """
             },
             {
@@ -309,24 +2141,38 @@ class QuestAgent(AIAgentManager):
                 "content": f"Generate {quest_stage} quests specifically for achieving the goal: {goal_data['title']}"
             }
         ]
-
-
-
-        response = self.get_completion(messages, temperature=0.8, max_tokens=1200)
-        if response:
-            try:
-                response_clean = self._clean_json_response(response)
-                quests = json.loads(response_clean)
-                for i, quest in enumerate(quests):
-                    quest['id'] = f"quest_{goal_data['id']}_{quest_stage}_{i}_{int(time.time())}"
-                    quest['goal_id'] = goal_data['id']
-                    quest['stage'] = quest_stage
-                return quests
-            except json.JSONDecodeError:
-                st.error("Error parsing AI response for quests")
-                return self._get_default_quests_for_goal(goal_data)
-        return self._get_default_quests_for_goal(goal_data)
+        return messages, quest_stage
     
+    def generate_quests_for_goals(self, goals, persona_data, max_workers=QUEST_FANOUT_WORKERS, exclude_titles=(),
+                                  use_defaults=True):
+        if not goals:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(goals))) as executor:
+            futures = {
+                goal['id']: executor.submit(contextvars.copy_context().run, self.generate_quests_for_goal, goal, persona_data, 0,
+                                            exclude_titles, True, use_defaults)
+                for goal in goals
+            }
+            return {goal_id: future.result() for goal_id, future in futures.items()}
+    
+    def generate_quest_details(self, quest, persona_data):
+        # Phase two: the body of a single quest, written when it is first opened. The prompt names no user,
+        # so the response cache serves it to everyone in the same cohort who opens the same quest
+        field, instruction = QUEST_DETAIL_PROMPTS[quest_detail_field(quest)]
+        messages = [
+            {"role": "system", "content": f"""You are a Quest Agent for Lloyds Bank's LifeQuest platform, writing the content of one quest.
+            {instruction}
+            Return ONLY a JSON object using these short keys:
+            lc=learning_content, s=action_steps, q=questions (each with q=question, o=options, c=correct, e=explanation)"""},
+            {"role": "user", "content": f"""Quest: {quest['title']}
+            Description: {quest.get('description', '')}
+            Type: {quest['type']} ({quest.get('difficulty', 'Medium')}, {quest.get('stage', 'beginner')} stage)
+            Goal category: {quest.get('goal_category', 'General')}
+            Audience: age {age_band(persona_data['age'])}, {persona_data.get('risk_profile', 'Moderate')} risk profile"""}
+        ]
+        details = self.get_structured(messages, 'quest_details', temperature=0.7, max_tokens=QUEST_DETAIL_MAX_TOKENS[field])
+        return details if details and field in details else None
+
     def generate_progressive_quests(self, goal_data, persona_data, completed_quests_count):
         if completed_quests_count < 3:
             return self.generate_quests_for_goal(goal_data, persona_data, completed_quests_count)
@@ -342,25 +2188,22 @@ class QuestAgent(AIAgentManager):
             Goal: {goal_data['title']}
             Category: {goal_data['category']}
             
-            Make quests actionable and specific to Lloyds Bank products."""},
+            Make quests actionable and specific to Lloyds Bank products.
+            
+            Return ONLY a JSON object using these short keys:
+            t=title, d=description, pt=points, df=difficulty, et=estimated_time, r=unlock_reward, s=action_steps
+            {{"quests": [{{"t": "Quest Title", "d": "What to do", "pt": 250, "df": "Hard", "et": "10 minutes", "r": "Reward", "s": ["Step 1", "Step 2"]}}]}}"""},
             {"role": "user", "content": f"Generate advanced action quests for {goal_data['title']}"}
         ]
         
-        response = self.get_completion(messages, temperature=0.7)
-        if response:
-            try:
-                response_clean = self._clean_json_response(response)
-                quests = json.loads(response_clean)
-                for i, quest in enumerate(quests):
-                    quest['id'] = f"quest_{goal_data['id']}_advanced_{i}_{int(time.time())}"
-                    quest['goal_id'] = goal_data['id']
-                    quest['stage'] = "advanced"
-                    quest['type'] = "action"
-                    quest['points'] = quest.get('points', 250)
-                return quests
-            except:
-                return []
-        return []
+        quests = self.get_structured(messages, 'quests', temperature=0.7) or []
+        for i, quest in enumerate(quests):
+            quest['id'] = f"quest_{goal_data['id']}_advanced_{i}_{int(time.time())}"
+            quest['goal_id'] = goal_data['id']
+            quest['goal_category'] = goal_data['category']
+            quest['stage'] = "advanced"
+            quest['type'] = "action"
+        return quests
     
     def _determine_quest_stage(self, completed_count):
         if completed_count < 2:
@@ -378,15 +2221,6 @@ class QuestAgent(AIAgentManager):
         }
         return focus_map.get(stage, "basic education")
     
-    def _clean_json_response(self, response):
-        match = re.search(r'```json(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        match = re.search(r'```(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        return response.strip()
-    
     def _get_default_quests_for_goal(self, goal_data):
         if "health" in goal_data['category'].lower():
             return [
@@ -470,43 +2304,202 @@ An emergency fund is a savings buffer to cover unexpected expenses, providing fi
                 }
             ]
 
+# Local nudge engine: a decision table over bucketed progress state, learning templated LLM answers for new states
+NUDGE_TABLE_PATH = os.environ.get("LIFEQUEST_NUDGE_TABLE_PATH", "nudge_table.json")
+NUDGE_POINT_BUCKETS = [0, 100, 500, 1000, 2500, 5000]
+NUDGE_COMPLETED_BUCKETS = [0, 1, 3, 6, 11, 21]
+NUDGE_UNLOCKED_BUCKETS = [0, 1, 2, 4]
+NUDGE_MAX_LEVEL_BUCKET = 10
+
+def nudge_state(user_progress, current_goal):
+    completed = len(user_progress['completed_quests'])
+    unlocked = len(set(user_progress['unlocked_products']))
+    return "|".join([
+        current_goal.get('category', 'General') if current_goal else "none",
+        f"p{bisect.bisect_right(NUDGE_POINT_BUCKETS, user_progress['total_points']) - 1}",
+        f"l{min(user_progress['level'], NUDGE_MAX_LEVEL_BUCKET)}",
+        f"c{bisect.bisect_right(NUDGE_COMPLETED_BUCKETS, completed) - 1}",
+        f"u{bisect.bisect_right(NUDGE_UNLOCKED_BUCKETS, unlocked) - 1}",
+    ])
+
+def _coarse_nudge_state(state):
+    category, _, _, completed, _ = state.split("|")
+    return f"{category}|{completed}"
+
+def _nudge_template_values(user_progress, persona_data, current_goal):
+    # Rendering only; {total_points} stays so tables learned before points stopped being templated still render
+    values = _template_values(current_goal or {'title': '', 'target_amount': 0}, persona_data)
+    points = user_progress['total_points']
+    if points >= 100:
+        values = [(f"{points:,}", "{total_points}"), (str(points), "{total_points}")] + values
+    return values
+
+def _persona_details(user_progress, persona_data):
+    # Values that cannot be templated safely: a table entry that still mentions one is this user's advice only.
+    # A point total in the text may equally be a reward amount, so it is not templated either
+    details = [persona_data.get('occupation'), str(persona_data.get('age', '')), persona_data.get('income_range')]
+    details += re.findall(r"£[\d,]+k?", persona_data.get('income_range') or '')
+    points = user_progress['total_points']
+    if points >= 10:
+        details += [f"{points:,}", str(points)]
+    return [value for value in details if value]
+
+def template_nudge(nudge, user_progress, persona_data, current_goal):
+    # Returns None when the nudge is too personal to be shared with the rest of its state bucket
+    values = _template_values(current_goal or {'title': '', 'target_amount': 0}, persona_data)
+    template = _map_quest_text(nudge, lambda text: replace_whole_tokens(text, values))
+    text = " ".join(str(value) for value in template.values())
+    for value in _persona_details(user_progress, persona_data):
+        if re.search(_whole_token_pattern(value).pattern, text, re.IGNORECASE):
+            return None
+    return template
+
+def render_nudge(template, user_progress, persona_data, current_goal):
+    replacements = [(token, value) for value, token in _nudge_template_values(user_progress, persona_data, current_goal)]
+    def from_template(text):
+        if '{' not in text:
+            return text
+        for token, value in replacements:
+            text = text.replace(token, value)
+        return text
+    return _map_quest_text(template, from_template)
+
+def seed_nudge_rules():
+    # Hand-written answers for states where the advice does not depend on the details: no goal yet, or no quests yet
+    rules = {}
+    for completed in range(len(NUDGE_COMPLETED_BUCKETS)):
+        rules[f"none|c{completed}"] = {
+            "message": "Nice work, {first_name}! Pick a goal to unlock your next set of quests.",
+            "action": "Open the Goals tab and select the goal that matters most to you right now",
+            "urgency": "High",
+            "reward_mention": "Every goal comes with quests worth 100-500 LifePoints",
+            "motivation": "A clear goal turns good intentions into a plan you can follow",
+        }
+    for category in BASE_GOAL_CATEGORIES:
+        rules[f"{category}|c0"] = {
+            "message": "You're all set, {first_name}! Your first quest for {goal_title} is waiting.",
+            "action": "Start your first quest in the Quests tab - it only takes a couple of minutes",
+            "urgency": "High",
+            "reward_mention": "Earn 150+ LifePoints for your very first quest",
+            "motivation": f"Small first steps build momentum towards your {category.lower()} goal",
+        }
+    return rules
+
+class NudgeDecisionTable:
+    def __init__(self, path=NUDGE_TABLE_PATH):
+        self.path = path
+        self._seeded = seed_nudge_rules()
+        self._learned = {}
+        self._lock = threading.Lock()
+        self.stats = {'local': 0, 'llm': 0, 'learned': 0}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._learned = json.load(f)
+
+    def lookup(self, state):
+        with self._lock:
+            template = self._learned.get(state) or self._seeded.get(_coarse_nudge_state(state))
+            self.stats['local' if template else 'llm'] += 1
+            return template
+
+    def learn(self, state, template, save=True):
+        with self._lock:
+            self._learned[state] = template
+            self.stats['learned'] += 1
+        if save:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            payload = json.dumps(self._learned, separators=(',', ':'))
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def local_share(self):
+        with self._lock:
+            total = self.stats['local'] + self.stats['llm']
+            return self.stats['local'] / total if total else 0.0
+
+@st.cache_resource
+def get_nudge_table():
+    return NudgeDecisionTable()
+
+NUDGE_PROMPT = PromptBuilder("nudge", """You are a Nudge Agent for Lloyds Bank's LifeQuest platform.
+Analyze the user's progress and provide personalized, motivating guidance.
+Provide encouraging, specific guidance based on their progress and current goal.
+Focus on next actionable steps and benefits they'll gain.
+
+Return JSON using these short keys (m=message, a=action, u=urgency, r=reward_mention, mo=motivation):
+{
+    "m": "Personalized encouraging message",
+    "a": "Specific next step they should take",
+    "u": "High/Medium/Low",
+    "r": "Specific points/rewards they can earn",
+    "mo": "Why this action is important for their goal"
+}""")
+
 class NudgeAgent(AIAgentManager):
-    def get_next_best_action(self, user_progress, persona_data, current_goal=None):
-        goal_context = f"Current Goal: {current_goal['title']}" if current_goal else "No goal selected"
-        messages = [
-            {"role": "system", "content": f"""You are a Nudge Agent for Lloyds Bank's LifeQuest platform.
-            Analyze user progress and provide personalized, motivating guidance.
-            
-            User: {persona_data['name']} ({persona_data['age']} years old, {persona_data['occupation']})
-            {goal_context}
-            
-            Progress Analysis:
-            - Total Points: {user_progress['total_points']}
-            - Level: {user_progress['level']}
-            - Completed Quests: {len(user_progress['completed_quests'])}
-            - Unlocked Products: {len(user_progress['unlocked_products'])}
-            
-            Provide encouraging, specific guidance based on their progress and current goal.
-            Focus on next actionable steps and benefits they'll gain.
-            
-            Return JSON:
-            {{
-                "message": "Personalized encouraging message",
-                "action": "Specific next step they should take",
-                "urgency": "High/Medium/Low",
-                "reward_mention": "Specific points/rewards they can earn",
-                "motivation": "Why this action is important for their goal"
-            }}"""},
-            {"role": "user", "content": "What should the user do next based on their progress?"}
-        ]
-        
-        response = self.get_completion(messages, temperature=0.8)
+    def __init__(self, client, cache=None, table=None, scheduler=None, telemetry=None):
+        super().__init__(client, cache, scheduler, telemetry)
+        self.table = table
+
+    def get_next_best_action(self, user_progress, persona_data, current_goal=None, use_defaults=True):
+        local = self._local_nudge(user_progress, persona_data, current_goal)
+        if local:
+            return local
+        messages = self._build_nudge_messages(user_progress, persona_data, current_goal)
+        nudge = self.get_structured(messages, 'nudge', temperature=0.8)
+        self._learn(nudge, user_progress, persona_data, current_goal)
+        if not nudge:
+            self._record_fallback('get_next_best_action')
+        return nudge or (self._default_nudge(persona_data) if use_defaults else None)
+
+    def stream_next_best_action(self, user_progress, persona_data, current_goal=None):
+        # Yields partial nudges carrying the message decoded so far, then the full nudge
+        local = self._local_nudge(user_progress, persona_data, current_goal)
+        if local:
+            yield local
+            return
+        messages = self._build_nudge_messages(user_progress, persona_data, current_goal)
+        response = ""
+        for delta in self.get_completion(messages, temperature=0.8, stream=True, response_format={"type": "json_object"}):
+            response += delta
+            message = self._partial_json_string(response, "m") or self._partial_json_string(response, "message")
+            if message:
+                yield {"message": message}
+        nudge = None
         if response:
-            try:
-                response_clean = self._clean_json_response(response)
-                return json.loads(response_clean)
-            except json.JSONDecodeError:
-                pass
+            report = _new_parse_report()
+            nudge = parse_structured_output(response, 'nudge', report)
+            self._record_parse('stream_next_best_action', report)
+        self._learn(nudge, user_progress, persona_data, current_goal)
+        if not nudge:
+            self._record_fallback('stream_next_best_action')
+        yield nudge or self._default_nudge(persona_data)
+
+    def _local_nudge(self, user_progress, persona_data, current_goal):
+        if self.table is None:
+            return None
+        template = self.table.lookup(nudge_state(user_progress, current_goal))
+        return template and render_nudge(template, user_progress, persona_data, current_goal)
+
+    def _learn(self, nudge, user_progress, persona_data, current_goal):
+        if self.table is None or not nudge:
+            return
+        template = template_nudge(nudge, user_progress, persona_data, current_goal)
+        if template is not None:
+            self.table.learn(nudge_state(user_progress, current_goal), template)
+
+    def _build_nudge_messages(self, user_progress, persona_data, current_goal):
+        progress = dict(user_progress, current_goal=current_goal)
+        return NUDGE_PROMPT.build(progress_digest(progress, persona_data), "What should the user do next based on their progress?",
+                                  uncompacted=json.dumps(progress))
+
+    def _default_nudge(self, persona_data):
         return {
             "message": f"Great progress, {persona_data['name']}! You're building strong financial habits.",
             "action": "Complete your next available quest to continue your journey",
@@ -514,47 +2507,964 @@ class NudgeAgent(AIAgentManager):
             "reward_mention": "Earn 150+ LifePoints and unlock exclusive rewards!",
             "motivation": "Every quest completed brings you closer to your financial goals"
         }
-    
-    def _clean_json_response(self, response):
-        match = re.search(r'```json(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        match = re.search(r'```(.*?)```', response, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        return response.strip()
+
+    def _partial_json_string(self, response, field):
+        match = re.search(rf'"{field}"\s*:\s*"((?:[^"\\]|\\.)*)', response)
+        if not match:
+            return None
+        raw = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', '', match.group(1))
+        try:
+            return json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return raw
+
+COACH_PROMPT = PromptBuilder("coach", """You are a warm, intelligent, and friendly financial advisor for Lloyds Bank LifeQuest.
+
+Your goal is to recommend **the best affordable health insurance plan** based on the user's income, lifestyle, and job pattern. 
+
+The user's profile, progress and current financial goal follow in the user context message.
+
+---
+
+### 🔧 HOW TO RESPOND:
+Give your response like a trusted coach who knows their life and wants to help.
+
+Use the following structure and tone:
+
+---
+
+**🧭 Here's What I Recommend For You:**
+
+Hi <their name>, based on your income and work pattern, here's a personalized health insurance suggestion to help you stay covered — without breaking your budget.
+
+---
+
+**💡 Recommended Plan:**
+- ✅ **Plan Type**: Comprehensive cashless health cover  
+- 💰 **Coverage Amount**: £50,000  
+- 💸 **Estimated Monthly Premium**: £70–£90
+
+This is a good balance between affordability and protection, especially for self-employed professionals like you.
+
+---
+
+**📊 Why This Fits Your Budget:**
+With your income in the range of <their income range>, spending about **1.5–2% of your income** on health insurance is a smart choice.
+
+That means:
+- **Estimated Budget for Insurance**: £600–£900/year  
+- Which equals about **£70–£90 per month**
+
+This keeps your savings intact while still getting essential medical protection.
+
+---
+
+**🎯 Why This Plan Is Right For You:**
+- You're a freelancer, so your income might vary — this plan offers **flexible premium options** and **cashless claims** to reduce stress during emergencies.
+- It covers common medical expenses and hospitalization without the need for pre-approvals or long waiting periods.
+- You don’t need to over-insure — this level of cover is enough to handle most medium-risk situations.
+
+---
+
+**⚠️ A Quick Heads-Up:**
+Medical inflation is currently around **6.2%**. This means treatment costs can rise fast — so it’s better to **lock in a plan now** while premiums are low.
+
+If your income grows in the next 6–12 months, you can upgrade your plan or add critical illness cover later.
+
+---
+
+**🎁 Bonus Tip:**
+Securing this plan now may qualify you for **Lloyds Health Cashback** or other seasonal loyalty rewards.
+
+---
+
+Use plain, encouraging language. Make the user feel supported and confident.
+Avoid robotic lists — speak like a person giving real, helpful advice.""")
+
+# Coach chat memory: the newest turns go verbatim into a fixed token window, older ones are folded into a rolling
+# summary in the background. The prompt is capped by these sizes however long the conversation runs
+COACH_HISTORY_TOKEN_BUDGET = 800
+COACH_TURN_MAX_TOKENS = 250
+COACH_SUMMARY_MAX_TOKENS = 200
+COACH_QUESTION_MAX_TOKENS = 300
+COACH_CHAT_MAX_STORED_TURNS = 100
+
+COACH_SUMMARY_INSTRUCTIONS = """You maintain the running memory of a conversation between a LifeQuest user and their coach.
+Merge the new turns into the existing summary. Keep facts the user shared, questions they asked, advice and figures
+already given, and anything they said they would do. Drop greetings and repetition. Reply with the summary only,
+in plain sentences, under 120 words."""
+
+def new_coach_chat():
+    # 'folded' counts the leading turns covered by the summary; 'folding' is the count a running fold will reach
+    return {'summary': "", 'turns': [], 'folded': 0, 'folding': None}
+
+def _turn_cost(turn):
+    return min(estimate_tokens(turn['content']), COACH_TURN_MAX_TOKENS)
+
+def _exchanges(turns):
+    # Turns are stored as user/assistant pairs; windowing and folding never split one, so the model never sees an
+    # answer without its question
+    return [turns[i:i + 2] for i in range(0, len(turns), 2)]
+
+def coach_chat_window(chat, budget=COACH_HISTORY_TOKEN_BUDGET):
+    # Newest unfolded exchanges that fit the budget, behind the summary. Exchanges older than the window that a fold
+    # has not reached yet are left out rather than growing the prompt
+    window, used = [], 0
+    for exchange in reversed(_exchanges(chat['turns'][chat['folded']:])):
+        used += sum(_turn_cost(turn) for turn in exchange)
+        if used > budget:
+            break
+        window[:0] = [{'role': turn['role'], 'content': _clip(turn['content'], COACH_TURN_MAX_TOKENS * 4)}
+                      for turn in exchange]
+    if chat['summary']:
+        window.insert(0, {'role': 'system', 'content': "Earlier in this conversation: "
+                          + _clip(chat['summary'], COACH_SUMMARY_MAX_TOKENS * 4)})
+    return window
+
+def coach_fold_target(chat, budget=COACH_HISTORY_TOKEN_BUDGET):
+    # Once the unfolded turns overflow the window, fold all but the newest half-budget of exchanges, always keeping
+    # the latest exchange (at most two clipped turns, which the window always has room for)
+    pending = chat['turns'][chat['folded']:]
+    if sum(_turn_cost(turn) for turn in pending) <= budget:
+        return None
+    keep, used = 0, 0
+    for exchange in reversed(_exchanges(pending)):
+        used += sum(_turn_cost(turn) for turn in exchange)
+        if used > budget // 2 and keep:
+            break
+        keep += len(exchange)
+    return len(chat['turns']) - keep
+
+def apply_coach_summary(chat, scheduler):
+    # Swaps in a finished fold; a fold that failed or was cancelled is dropped so the next turn schedules another
+    target = chat['folding']
+    if target is None:
+        return
+    summary = scheduler.take("coach_summary", target)
+    if summary is None and scheduler.is_pending("coach_summary", target):
+        return
+    if summary:
+        chat['summary'] = summary
+        chat['folded'] = target
+    chat['folding'] = None
+    excess = min(len(chat['turns']) - COACH_CHAT_MAX_STORED_TURNS, chat['folded'])
+    excess -= excess % 2
+    if excess > 0:
+        del chat['turns'][:excess]
+        chat['folded'] -= excess
+
+def schedule_coach_summary(coach_agent, chat, scheduler):
+    target = coach_fold_target(chat)
+    if chat['folding'] is not None or target is None:
+        return
+    chat['folding'] = target
+    scheduler.submit("coach_summary", target, coach_agent.summarize_turns, chat['summary'],
+                     list(chat['turns'][chat['folded']:target]))
+
+class CoachAgent(AIAgentManager):
+    def build_messages(self, question, user_progress, persona_data, recent_quest_titles=(), history=()):
+        return COACH_PROMPT.build(progress_digest(user_progress, persona_data, recent_quest_titles),
+                                  _clip(question, COACH_QUESTION_MAX_TOKENS * 4),
+                                  uncompacted=json.dumps(user_progress, indent=2), history=history)
+
+    def stream_answer(self, question, user_progress, persona_data, recent_quest_titles=(), history=()):
+        messages = self.build_messages(question, user_progress, persona_data, recent_quest_titles, history)
+        return self.get_completion(messages, stream=True)
+
+    def summarize_turns(self, summary, turns):
+        # Only the tail of the transcript is sent, so a backlog left by failed folds cannot grow this prompt either
+        transcript = "\n".join(f"{turn['role']}: {_clip(turn['content'], COACH_TURN_MAX_TOKENS * 4)}" for turn in turns)
+        transcript = transcript[-COACH_HISTORY_TOKEN_BUDGET * 8:]
+        messages = [
+            {"role": "system", "content": COACH_SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Summary so far:\n{summary or 'None yet.'}\n\nNew turns:\n{transcript}"},
+        ]
+        response = self.get_completion(messages, temperature=0.3, max_tokens=COACH_SUMMARY_MAX_TOKENS)
+        return response.strip() if response else None
+
+# Single source of truth for point multipliers, unlocks, badges and levels
+REWARD_RULES = {
+    'default_points': 100,
+    'level_multiplier': 0.1,
+    'level_step': 500,
+    'unlocks': [(200, "Premium Financial Calculator"), (400, "30-Day Insurance Trial"), (600, "Personal Finance Consultation")],
+    'badges': [(0, "🎯 Getting Started"), (200, "🌟 Smart Saver"), (500, "💎 Money Master"), (1000, "🏆 Financial Champion")],
+}
+
+def level_for_points(total_points):
+    return 1 + np.asarray(total_points, dtype=np.int64) // REWARD_RULES['level_step']
 
 class RewardsAgent(AIAgentManager):
+    def __init__(self, client, cache=None, rules=REWARD_RULES, scheduler=None, telemetry=None):
+        super().__init__(client, cache, scheduler, telemetry)
+        self.rules = rules
+        self._unlock_thresholds = np.array([points for points, _ in rules['unlocks']])
+        self._unlock_names = [name for _, name in rules['unlocks']]
+        self._badge_thresholds = np.array([points for points, _ in rules['badges']])
+        self._badge_names = np.array([name for _, name in rules['badges']], dtype=object)
+
     def calculate_reward(self, quest_completed, user_level):
-        base_points = quest_completed.get('points', 100)
+        base_points = quest_completed.get('points', self.rules['default_points'])
         if base_points is None:
-            base_points = 100
-        multiplier = 1 + (user_level * 0.1)
-        total_points = int(base_points * multiplier)
-        unlock_rewards = []
-        if total_points >= 200:
-            unlock_rewards.append("Premium Financial Calculator")
-        if total_points >= 400:
-            unlock_rewards.append("30-Day Insurance Trial")
-        if total_points >= 600:
-            unlock_rewards.append("Personal Finance Consultation")
+            base_points = self.rules['default_points']
+        total_points = int(self._earned_points(base_points, user_level))
+        unlocked = int(np.searchsorted(self._unlock_thresholds, total_points, side='right'))
         return {
             "points_earned": total_points,
-            "unlock_rewards": unlock_rewards,
+            "unlock_rewards": self._unlock_names[:unlocked],
             "achievement": self.get_achievement_badge(total_points)
         }
     
     def get_achievement_badge(self, total_points):
-        if total_points >= 1000:
-            return "🏆 Financial Champion"
-        elif total_points >= 500:
-            return "💎 Money Master"
-        elif total_points >= 200:
-            return "🌟 Smart Saver"
-        else:
-            return "🎯 Getting Started"
+        return self._badge_names[np.searchsorted(self._badge_thresholds, total_points, side='right') - 1]
+
+    def _earned_points(self, base_points, levels):
+        multiplier = 1 + np.asarray(levels, dtype=np.float64) * self.rules['level_multiplier']
+        return np.floor(np.asarray(base_points, dtype=np.float64) * multiplier).astype(np.int64)
+
+    def recompute_rewards(self, user_ids, base_points, levels_at_time):
+        # Replays (user, base_points, level-at-time) events in their given order under the current rule table
+        user_ids = np.asarray(user_ids)
+        earned = self._earned_points(base_points, levels_at_time)
+        if not len(user_ids):
+            user_ids, earned = user_ids[:0], earned[:0]
+            return {'points_earned': earned, 'cumulative_points': earned, 'level_after': earned, 'unlock_counts': earned,
+                    'users': user_ids, 'total_points': earned, 'levels': earned,
+                    'badges': self._badge_names[:0], 'unlocked_products': []}
+        order = np.argsort(user_ids, kind='stable')
+        sorted_users, sorted_earned = user_ids[order], earned[order]
+        starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+        ends = np.r_[starts[1:], len(order)] - 1
+        running = np.cumsum(sorted_earned)
+        # Turn the global running sum into per-user running sums by subtracting each user's starting offset
+        offsets = np.repeat(running[starts] - sorted_earned[starts], ends - starts + 1)
+        cumulative = np.empty_like(earned)
+        cumulative[order] = running - offsets
+        unlock_counts = np.searchsorted(self._unlock_thresholds, earned, side='right')
+        totals = (running - offsets)[ends]
+        user_unlocks = np.maximum.reduceat(unlock_counts[order], starts)
+        return {
+            'points_earned': earned,
+            'cumulative_points': cumulative,
+            'level_after': level_for_points(cumulative),
+            'unlock_counts': unlock_counts,
+            'users': sorted_users[starts],
+            'total_points': totals,
+            'levels': level_for_points(totals),
+            'badges': self._badge_names[np.searchsorted(self._badge_thresholds, totals, side='right') - 1],
+            'unlocked_products': [self._unlock_names[:count] for count in user_unlocks],
+        }
+
+class PrefetchScheduler:
+    def __init__(self, executor):
+        self._executor = executor
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, context, fn, *args):
+        # A job is identified by name and the context it was computed for; resubmitting the same pair is a no-op
+        with self._lock:
+            job = self._jobs.get(name)
+            if job and job[0] == context:
+                return job[1]
+            if job:
+                job[1].cancel()
+            future = self._executor.submit(contextvars.copy_context().run, run_with_priority, PRIORITY_PREFETCH, fn, *args)
+            self._jobs[name] = (context, future)
+            return future
+
+    def is_pending(self, name, context):
+        with self._lock:
+            job = self._jobs.get(name)
+            return bool(job) and job[0] == context and not job[1].done()
+
+    def take(self, name, context):
+        with self._lock:
+            job = self._jobs.get(name)
+            if not job or job[0] != context or not job[1].done():
+                return None
+            del self._jobs[name]
+        future = job[1]
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def cancel_all(self):
+        # Running jobs cannot be interrupted, but dropping them means their results are never swapped in
+        with self._lock:
+            for _, future in self._jobs.values():
+                future.cancel()
+            self._jobs.clear()
+
+@st.cache_resource
+def get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="lifequest-prefetch")
+
+def get_prefetch_scheduler():
+    if 'prefetch_scheduler' not in st.session_state:
+        st.session_state.prefetch_scheduler = PrefetchScheduler(get_prefetch_executor())
+    return st.session_state.prefetch_scheduler
+
+# Durable progress storage; session state is written behind in batches and hydrated again on reconnect, from
+# whichever worker process the user lands on. 0 writes through on every rerun
+PROGRESS_NAMESPACE_PREFIX = "progress."
+PROGRESS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("LIFEQUEST_PROGRESS_FLUSH_SECONDS", "2.0"))
+PROGRESS_FLUSH_MAX_PENDING = 500
+
+# Record kind -> session state keys stored together under it
+PERSISTED_SESSION_KEYS = {
+    'profile': ('current_user', 'current_user_data'),
+    'goals': ('generated_goals',),
+    'quests': ('generated_quests', 'delivered_quest_batches'),
+    'progress': ('user_progress', 'current_goal_id'),
+    'coach': ('coach_chat',),
+}
+
+class ProgressStore(ABC):
+    # Records are JSON payloads addressed by (user_id, kind); backends only need these three methods
+    @abstractmethod
+    def load(self, user_id):
+        ...
+
+    @abstractmethod
+    def save_many(self, records):
+        ...
+
+    @abstractmethod
+    def iter_kind(self, kind):
+        ...
+
+    def flush(self):
+        pass
+
+class SharedProgressStore(ProgressStore):
+    # One shared-state namespace per record kind, keyed by user id
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, user_id):
+        records = {}
+        for kind in PERSISTED_SESSION_KEYS:
+            payload = self.backend.get(PROGRESS_NAMESPACE_PREFIX + kind, user_id)
+            if payload is not None:
+                records[kind] = payload
+        return records
+
+    def save_many(self, records):
+        by_kind = defaultdict(list)
+        for user_id, kind, payload in records:
+            by_kind[kind].append((user_id, payload))
+        for kind, items in by_kind.items():
+            self.backend.put_many(PROGRESS_NAMESPACE_PREFIX + kind, items)
+
+    def iter_kind(self, kind):
+        return iter(self.backend.scan(PROGRESS_NAMESPACE_PREFIX + kind))
+
+class WriteBehindProgressStore(ProgressStore):
+    def __init__(self, backend, flush_interval=PROGRESS_FLUSH_INTERVAL_SECONDS, max_pending=PROGRESS_FLUSH_MAX_PENDING):
+        self.backend = backend
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.stats = {'staged': 0, 'flushes': 0, 'records_written': 0}
+        self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,),
+                                         name="lifequest-progress-flush", daemon=True)
+        self._flusher.start()
+
+    def load(self, user_id):
+        records = self.backend.load(user_id)
+        with self._lock:
+            records.update({kind: payload for (uid, kind), payload in self._pending.items() if uid == user_id})
+        return records
+
+    def save_many(self, records):
+        # Later writes to the same record replace earlier ones before they ever reach the backend
+        with self._lock:
+            for user_id, kind, payload in records:
+                self._pending[(user_id, kind)] = payload
+            self.stats['staged'] += len(records)
+            should_flush = len(self._pending) >= self.max_pending
+        if should_flush:
+            self.flush()
+
+    def iter_kind(self, kind):
+        self.flush()
+        return self.backend.iter_kind(kind)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.backend.save_many([(user_id, kind, payload) for (user_id, kind), payload in pending.items()])
+        except Exception:
+            # Requeue for the next flush without overwriting anything staged since
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+            raise
+        with self._lock:
+            self.stats['flushes'] += 1
+            self.stats['records_written'] += len(pending)
+
+    def _flush_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as error:
+                logger.warning("progress flush failed: %r", error)
+
+@st.cache_resource
+def get_progress_store():
+    store = SharedProgressStore(get_shared_state())
+    if PROGRESS_FLUSH_INTERVAL_SECONDS <= 0:
+        return store
+    store = WriteBehindProgressStore(store, flush_interval=PROGRESS_FLUSH_INTERVAL_SECONDS)
+    atexit.register(store.flush)
+    return store
+
+def get_session_user_id():
+    # The id lives in the URL so a refresh or reconnect lands on the same stored progress
+    user_id = st.query_params.get("uid")
+    if not user_id:
+        user_id = uuid.uuid4().hex
+        st.query_params["uid"] = user_id
+    return user_id
+
+def hydrate_session_state(store):
+    user_id = get_session_user_id()
+    if st.session_state.get('hydrated_user_id') == user_id:
+        return
+    st.session_state.hydrated_user_id = user_id
+    st.session_state.persisted_payloads = {}
+    for kind, payload in store.load(user_id).items():
+        if kind not in PERSISTED_SESSION_KEYS:
+            continue
+        values = json.loads(payload)
+        for key in PERSISTED_SESSION_KEYS[kind]:
+            if key in values:
+                st.session_state[key] = values[key]
+        st.session_state.persisted_payloads[kind] = payload
+    if st.session_state.get('current_user') is not None and st.session_state.current_user not in get_persona_catalog():
+        st.session_state.current_user = None
+
+def persist_session_state(store):
+    # Called once at the end of each rerun; only kinds whose serialised value changed are staged
+    user_id = st.session_state.get('hydrated_user_id')
+    if not user_id:
+        return
+    records = []
+    for kind, keys in PERSISTED_SESSION_KEYS.items():
+        payload = json.dumps({key: st.session_state.get(key) for key in keys}, separators=(',', ':'))
+        if st.session_state.persisted_payloads.get(kind) != payload:
+            st.session_state.persisted_payloads[kind] = payload
+            records.append((user_id, kind, payload))
+    if records:
+        store.save_many(records)
+
+# Leaderboards: a Fenwick tree over score buckets gives O(log n) updates, ranks and ordered walks
+LEADERBOARD_INITIAL_BUCKETS = 1 << 12
+LEADERBOARD_MAX_BUCKETS = 1 << 22
+
+class FenwickTree:
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    @classmethod
+    def from_counts(cls, counts):
+        fenwick = cls(len(counts))
+        tree = fenwick.tree
+        for i, count in enumerate(counts, 1):
+            tree[i] += count
+            parent = i + (i & -i)
+            if parent <= fenwick.size:
+                tree[parent] += tree[i]
+        return fenwick
+
+    def add(self, index, delta):
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        # Sum of counts in buckets [0, index]
+        total, i = 0, min(index + 1, self.size)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find_kth(self, k):
+        # Smallest bucket whose prefix sum reaches k (k is 1-based)
+        position, step = 0, 1 << self.size.bit_length()
+        while step:
+            nxt = position + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                position = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return position
+
+class TieBucket:
+    # Users on one score in arrival order. A Fenwick tree over arrival slots finds a member's position, and the member
+    # at a position, in O(log n) however many users are tied; slots freed by departures are compacted away in bulk
+    def __init__(self, initial_slots=16):
+        self._slots = []
+        self._slot_of = {}
+        self._tree = FenwickTree(initial_slots)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, user_id):
+        if len(self._slots) == self._tree.size:
+            self._compact()
+        slot = len(self._slots)
+        self._slots.append(user_id)
+        self._slot_of[user_id] = slot
+        self._tree.add(slot, 1)
+
+    def remove(self, user_id):
+        slot = self._slot_of.pop(user_id)
+        self._slots[slot] = None
+        self._tree.add(slot, -1)
+
+    def position(self, user_id):
+        return self._tree.prefix_sum(self._slot_of[user_id] - 1)
+
+    def at(self, position):
+        return self._slots[self._tree.find_kth(position + 1)]
+
+    def _compact(self):
+        live = [user_id for user_id in self._slots if user_id is not None]
+        size = self._tree.size * 2 if len(live) * 2 > self._tree.size else self._tree.size
+        self._slots = live
+        self._slot_of = {user_id: slot for slot, user_id in enumerate(live)}
+        self._tree = FenwickTree.from_counts([1] * len(live) + [0] * (size - len(live)))
+
+class Leaderboard:
+    # One bucket per score. Scores beyond max_buckets share the last bucket and rank among themselves by arrival
+    def __init__(self, initial_buckets=LEADERBOARD_INITIAL_BUCKETS, max_buckets=LEADERBOARD_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._scores = {}
+        self._buckets = {}
+        self._tree = FenwickTree(initial_buckets)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def _bucket_for(self, score):
+        bucket = max(score, 0)
+        if bucket >= self._tree.size and self._tree.size < self.max_buckets:
+            self._grow(bucket)
+        return min(bucket, self._tree.size - 1)
+
+    def _grow(self, bucket):
+        size = self._tree.size
+        while size <= bucket and size < self.max_buckets:
+            size *= 2
+        counts = [0] * size
+        for index, members in self._buckets.items():
+            counts[index] = len(members)
+        self._tree = FenwickTree.from_counts(counts)
+
+    def score(self, user_id):
+        return self._scores.get(user_id)
+
+    def set_score(self, user_id, score):
+        with self._lock:
+            self._remove(user_id)
+            bucket = self._bucket_for(score)
+            self._scores[user_id] = score
+            members = self._buckets.get(bucket)
+            if members is None:
+                members = self._buckets[bucket] = TieBucket()
+            members.add(user_id)
+            self._tree.add(bucket, 1)
+
+    def add_points(self, user_id, points):
+        self.set_score(user_id, (self._scores.get(user_id) or 0) + points)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        score = self._scores.pop(user_id, None)
+        if score is None:
+            return
+        bucket = self._bucket_for(score)
+        members = self._buckets[bucket]
+        members.remove(user_id)
+        if not members:
+            del self._buckets[bucket]
+        self._tree.add(bucket, -1)
+
+    def rank(self, user_id):
+        # Competition ranking: 1 + number of users with a strictly higher score
+        with self._lock:
+            score = self._scores.get(user_id)
+            if score is None:
+                return None
+            return 1 + len(self._scores) - self._tree.prefix_sum(self._bucket_for(score))
+
+    def _walk(self, position, count):
+        # Entries from 0-based descending position onwards, as (rank, user_id, score); ties keep arrival order
+        total = len(self._scores)
+        entries = []
+        while len(entries) < count and position < total:
+            bucket = self._tree.find_kth(total - position)
+            above = total - self._tree.prefix_sum(bucket)
+            members = self._buckets[bucket]
+            for offset in range(position - above, min(len(members), position - above + count - len(entries))):
+                user_id = members.at(offset)
+                entries.append((1 + above, user_id, self._scores[user_id]))
+            position = above + len(members)
+        return entries
+
+    def top(self, k=10):
+        with self._lock:
+            return self._walk(0, k)
+
+    def around(self, user_id, radius=2):
+        with self._lock:
+            score = self._scores.get(user_id)
+            if score is None:
+                return []
+            bucket = self._bucket_for(score)
+            position = len(self._scores) - self._tree.prefix_sum(bucket) + self._buckets[bucket].position(user_id)
+            start = max(position - radius, 0)
+            return self._walk(start, position - start + radius + 1)
+
+class LeaderboardRegistry:
+    # One global board plus lazily created cohort boards, e.g. "age:25-34" or "category:Debt Management"
+    GLOBAL = "global"
+
+    def __init__(self, name_loader=None):
+        self._boards = {self.GLOBAL: Leaderboard()}
+        self.names = {}
+        self.name_loader = name_loader
+        self._lock = threading.Lock()
+
+    def board(self, name=GLOBAL):
+        with self._lock:
+            if name not in self._boards:
+                self._boards[name] = Leaderboard()
+            return self._boards[name]
+
+    def record_points(self, user_id, points, cohorts=()):
+        for name in (self.GLOBAL,) + tuple(cohorts):
+            self.board(name).add_points(user_id, points)
+
+    def display_name(self, user_id):
+        # Users who joined through another worker process are named from their stored profile on first display
+        if user_id not in self.names and self.name_loader is not None:
+            name = self.name_loader(user_id)
+            if name:
+                self.names[user_id] = name
+        return self.names.get(user_id, 'LifeQuest member')
+
+    def apply_events(self, records, states):
+        # Ledger listener. PointsAwarded events carry the cohorts the points count towards; global and age boards take
+        # the ledger's running total, so they are exact even for users first seen through another process's events
+        for record in records:
+            if record['type'] != "PointsAwarded":
+                continue
+            user_id = record['user']
+            for name in (self.GLOBAL,) + tuple(record.get('cohorts', ())):
+                if name.startswith("category:"):
+                    self.board(name).add_points(user_id, record['points'])
+                else:
+                    self.board(name).set_score(user_id, states[user_id]['total_points'])
+
+    def ensure_user(self, user_id, display_name, total_points, cohorts=()):
+        self.names[user_id] = display_name
+        for name in (self.GLOBAL,) + tuple(cohorts):
+            board = self.board(name)
+            if board.score(user_id) is None:
+                board.set_score(user_id, total_points if not name.startswith("category:") else 0)
+
+def stored_persona(profile, catalog):
+    return ChainMap(profile.get('current_user_data') or {}, catalog.get(profile['current_user']) or {})
+
+@st.cache_resource
+def get_leaderboards():
+    # Points follow the event ledger, which every worker process appends to: boards start from its per-user totals
+    # and then apply each later PointsAwarded event, whichever process wrote it. Names and age bands come from profiles
+    store = get_progress_store()
+    catalog = get_persona_catalog()
+
+    def load_name(user_id):
+        profile = json.loads(store.load(user_id).get('profile') or '{}')
+        return stored_persona(profile, catalog).get('name') if profile.get('current_user') else None
+
+    registry = LeaderboardRegistry(load_name)
+
+    def seed(states):
+        profiles = {user_id: json.loads(payload) for user_id, payload in store.iter_kind('profile')}
+        for user_id, payload in store.iter_kind('progress'):
+            profile = profiles.get(user_id) or {}
+            if not profile.get('current_user'):
+                continue
+            # Progress saved before the ledger existed has no events to count from
+            state = states.get(user_id) or (json.loads(payload).get('user_progress') or {})
+            persona = stored_persona(profile, catalog)
+            registry.ensure_user(user_id, persona.get('name', 'LifeQuest member'), state.get('total_points', 0),
+                                 [f"age:{age_band(persona.get('age', 30))}"])
+
+    get_event_ledger().subscribe(registry.apply_events, seed)
+    return registry
+
+def leaderboard_cohorts(persona_data, goal_data=None):
+    cohorts = [f"age:{age_band(persona_data['age'])}"]
+    if goal_data:
+        cohorts.append(f"category:{goal_data['category']}")
+    return cohorts
+
+# Append-only event ledger for quest completions, points, level-ups and unlocks
+LEDGER_DIR = os.environ.get("LIFEQUEST_LEDGER_DIR", ".lifequest_ledger")
+LEDGER_SEGMENT_BYTES = 4 * 1024 * 1024
+LEDGER_SNAPSHOT_EVERY = 1000
+LEDGER_SNAPSHOTS_KEPT = 2
+LEDGER_LOCK_NAME = "ledger.lock"
+
+def new_ledger_state():
+    return {'total_points': 0, 'level': 1, 'completed_quests': [], 'unlocked_products': []}
+
+def apply_event(state, event):
+    # The only place ledger events change progress, shared by live completions and replays
+    event_type = event['type']
+    if event_type == "QuestCompleted":
+        if event['quest_id'] not in state['completed_quests']:
+            state['completed_quests'].append(event['quest_id'])
+    elif event_type == "PointsAwarded":
+        state['total_points'] += event['points']
+    elif event_type == "LevelUp":
+        state['level'] = max(state['level'], event['level'])
+    elif event_type == "ProductUnlocked":
+        if event['product'] not in state['unlocked_products']:
+            state['unlocked_products'].append(event['product'])
+    return state
+
+def _segment_name(number):
+    return f"segment-{number:08d}.jsonl"
+
+def iter_ledger_events(directory, segment=None, offset=0):
+    # Streams events in append order, optionally starting from a (segment, byte offset) position
+    segments = sorted(name for name in os.listdir(directory) if name.startswith("segment-"))
+    if segment is not None:
+        segments = [name for name in segments if name >= segment]
+    for name in segments:
+        with open(os.path.join(directory, name), 'rb') as f:
+            if name == segment:
+                f.seek(offset)
+            for line in f:
+                if line.endswith(b"\n"):
+                    yield json.loads(line)
+
+def _snapshot_names(directory):
+    # Finished snapshots only; one being written (or left behind by a crash) is still a dot-prefixed temp file
+    return sorted(name for name in os.listdir(directory) if name.startswith("snapshot-") and name.endswith(".json.gz"))
+
+def load_latest_snapshot(directory):
+    snapshots = _snapshot_names(directory)
+    if not snapshots:
+        return None
+    with gzip.open(os.path.join(directory, snapshots[-1]), 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+class EventLedger:
+    # Every worker process on a host may append to the same directory. Appends hold an flock on LEDGER_LOCK_NAME and
+    # first read what other processes appended, so seq numbers stay unique and ordered and a snapshot covers every
+    # user. Without fcntl (Windows) only one process may use a directory
+    def __init__(self, directory=LEDGER_DIR, segment_bytes=LEDGER_SEGMENT_BYTES, snapshot_every=LEDGER_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._segment = None
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, LEDGER_LOCK_NAME), 'ab')
+        with self._lock, self._directory_lock():
+            snapshot = load_latest_snapshot(directory)
+            self._states = snapshot['states'] if snapshot else {}
+            self._seq = self._snapshot_seq = snapshot['seq'] if snapshot else 0
+            # Read position: (segment, byte offset) just past the last event applied to _states
+            self._position = (snapshot['segment'], snapshot['offset']) if snapshot else (_segment_name(1), 0)
+            self._read_new()
+
+    @contextmanager
+    def _directory_lock(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _read_segment(self, name, offset, records):
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Another process is mid-write; the rest of the line is picked up next time
+                        break
+                    records.append(json.loads(line))
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return offset
+
+    def _read_new(self):
+        # Applies whatever was appended past the read position, by any process, and returns those records
+        records = []
+        name, offset = self._position
+        while True:
+            offset = self._read_segment(name, offset, records)
+            next_name = _segment_name(int(name[8:16]) + 1)
+            if offset < self.segment_bytes or not os.path.exists(os.path.join(self.directory, next_name)):
+                break
+            # The writer that rotated finished this segment before creating the next one
+            offset = self._read_segment(name, offset, records)
+            name, offset = next_name, 0
+        self._position = (name, offset)
+        self._apply(records)
+        return records
+
+    def _apply(self, records):
+        for record in records:
+            apply_event(self._states.setdefault(record['user'], new_ledger_state()), record)
+            self._seq = record['seq']
+        if records:
+            for listener in self._listeners:
+                listener(records, self._states)
+
+    def subscribe(self, listener, seed=None):
+        # seed(states) sees every user's state so far, then listener(records, states) gets each later batch of events
+        # whichever process appended it. Both run under the ledger lock, must not call back into the ledger and must
+        # not modify states
+        with self._lock:
+            self._read_new()
+            if seed is not None:
+                seed(self._states)
+            self._listeners.append(listener)
+
+    def sync(self):
+        # Picks up events other processes appended; one read of the current segment when there are none
+        with self._lock:
+            return self._read_new()
+
+    def append(self, user_id, events):
+        now = time.time()
+        with self._lock, self._directory_lock():
+            self._read_new()
+            name, offset = self._position
+            path = os.path.join(self.directory, name)
+            if self._segment is None or self._segment.name != path:
+                if self._segment is not None:
+                    self._segment.close()
+                self._segment = open(path, 'ab')
+            if os.fstat(self._segment.fileno()).st_size > offset:
+                # A torn line from a writer that crashed mid-append; nobody else can be writing while we hold the lock
+                self._segment.truncate(offset)
+            records = [{'seq': self._seq + i, 'ts': now, 'user': user_id, **event} for i, event in enumerate(events, 1)]
+            data = b"".join(json.dumps(r, separators=(',', ':')).encode('utf-8') + b"\n" for r in records)
+            self._segment.write(data)
+            self._segment.flush()
+            offset += len(data)
+            if offset >= self.segment_bytes:
+                name, offset = _segment_name(int(name[8:16]) + 1), 0
+                self._segment.close()
+                self._segment = open(os.path.join(self.directory, name), 'ab')
+            self._position = (name, offset)
+            self._apply(records)
+            if self._seq - self._snapshot_seq >= self.snapshot_every:
+                # Another process may have written one since; its name carries the seq it covers
+                snapshots = _snapshot_names(self.directory)
+                if snapshots:
+                    self._snapshot_seq = max(self._snapshot_seq, int(snapshots[-1][9:21]))
+                if self._seq - self._snapshot_seq >= self.snapshot_every:
+                    self._write_snapshot()
+            return records
+
+    def _write_snapshot(self):
+        segment, offset = self._position
+        snapshot = {'seq': self._seq, 'segment': segment, 'offset': offset, 'states': self._states}
+        name = f"snapshot-{self._seq:012d}.json.gz"
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_path, os.path.join(self.directory, name))
+        self._snapshot_seq = self._seq
+        for name in _snapshot_names(self.directory)[:-LEDGER_SNAPSHOTS_KEPT]:
+            os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._lock_file.close()
+
+    def user_state(self, user_id):
+        with self._lock:
+            self._read_new()
+            return json.loads(json.dumps(self._states.get(user_id) or new_ledger_state()))
+
+    def rebuild_user(self, user_id):
+        # Snapshot plus the events appended after it; never more than snapshot_every events of tail
+        snapshot = load_latest_snapshot(self.directory)
+        state = (snapshot['states'].get(user_id) if snapshot else None) or new_ledger_state()
+        position = (snapshot['segment'], snapshot['offset']) if snapshot else (None, 0)
+        for event in iter_ledger_events(self.directory, *position):
+            if event['user'] == user_id:
+                apply_event(state, event)
+        return state
+
+@st.cache_resource
+def get_event_ledger():
+    ledger = EventLedger()
+    atexit.register(ledger.close)
+    return ledger
+
+def replay_ledger(directory, output=None, from_snapshot=False):
+    # One streaming pass over every segment; from_snapshot starts at the latest snapshot instead of the beginning
+    if not os.path.isdir(directory):
+        return {}, 0
+    snapshot = load_latest_snapshot(directory) if from_snapshot else None
+    states = snapshot['states'] if snapshot else {}
+    position = (snapshot['segment'], snapshot['offset']) if snapshot else (None, 0)
+    count = 0
+    for event in iter_ledger_events(directory, *position):
+        apply_event(states.setdefault(event['user'], new_ledger_state()), event)
+        count += 1
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            for user_id, state in states.items():
+                f.write(json.dumps({'user': user_id, **state}, separators=(',', ':')) + "\n")
+    return states, count
+
+@st.cache_resource
+def get_agents(api_key):
+    # Agents hold no per-user state, so one set per API key is shared by every session
+    client = get_client_registry().get(api_key)
+    cache = get_response_cache()
+    scheduler = get_llm_scheduler()
+    telemetry = get_agent_telemetry()
+    return (GoalCoachAgent(client, cache, scheduler, telemetry), QuestAgent(client, cache, get_quest_pool(), scheduler, telemetry),
+            NudgeAgent(client, cache, get_nudge_table(), scheduler, telemetry),
+            RewardsAgent(client, cache, scheduler=scheduler, telemetry=telemetry), CoachAgent(client, cache, scheduler, telemetry))
 
 def initialize_session_state():
+    hydrate_session_state(get_progress_store())
     if 'current_user' not in st.session_state:
         st.session_state.current_user = None
     if 'user_progress' not in st.session_state:
@@ -574,6 +3484,166 @@ def initialize_session_state():
         st.session_state.current_goal_id = None
     if 'current_user_data' not in st.session_state:
         st.session_state.current_user_data = {}
+    if 'delivered_quest_batches' not in st.session_state:
+        st.session_state.delivered_quest_batches = []
+    if 'coach_chat' not in st.session_state:
+        st.session_state.coach_chat = new_coach_chat()
+
+class ProgressModel:
+    # Indexes over the session's quest and completion lists, kept in step as they are mutated through this model
+    def __init__(self, quests, completed_quests):
+        self.quests = quests
+        self.completed_quests = completed_quests
+        self._reindex()
+
+    def _reindex(self):
+        self.completed = set(self.completed_quests)
+        self.quests_by_goal = {}
+        self.completed_by_goal = Counter()
+        self.completed_by_stage = Counter()
+        for quest in self.quests:
+            self._index(quest)
+        self._synced_lengths = (len(self.quests), len(self.completed_quests))
+
+    def _index(self, quest):
+        self.quests_by_goal.setdefault(quest['goal_id'], []).append(quest)
+        if quest['id'] in self.completed:
+            self._count_completion(quest)
+
+    def _count_completion(self, quest):
+        self.completed_by_goal[quest['goal_id']] += 1
+        self.completed_by_stage[(quest['goal_id'], quest.get('stage', 'beginner'))] += 1
+
+    def is_synced(self, quests, completed_quests):
+        # Anything that replaced or resized the lists behind our back (hydration, profile switch) forces a rebuild
+        return (self.quests is quests and self.completed_quests is completed_quests
+                and self._synced_lengths == (len(quests), len(completed_quests)))
+
+    def is_completed(self, quest_id):
+        return quest_id in self.completed
+
+    def quests_for_goal(self, goal_id):
+        return self.quests_by_goal.get(goal_id, [])
+
+    def completed_count(self, goal_id, stage=None):
+        if stage is None:
+            return self.completed_by_goal[goal_id]
+        return self.completed_by_stage[(goal_id, stage)]
+
+    def add_quests(self, quests):
+        self.quests.extend(quests)
+        for quest in quests:
+            self._index(quest)
+        self._synced_lengths = (len(self.quests), len(self.completed_quests))
+
+    def set_goal_quests(self, quests_by_goal):
+        self.quests[:] = [q for q in self.quests if q['goal_id'] not in quests_by_goal] + [
+            q for quests in quests_by_goal.values() for q in quests
+        ]
+        self._reindex()
+
+    def complete(self, quest):
+        if quest['id'] in self.completed:
+            return False
+        self.completed.add(quest['id'])
+        self.completed_quests.append(quest['id'])
+        self._count_completion(quest)
+        self._synced_lengths = (len(self.quests), len(self.completed_quests))
+        return True
+
+def get_progress_model():
+    quests = st.session_state.generated_quests
+    completed_quests = st.session_state.user_progress['completed_quests']
+    model = st.session_state.get('progress_model')
+    if model is None or not model.is_synced(quests, completed_quests):
+        model = ProgressModel(quests, completed_quests)
+        st.session_state.progress_model = model
+    return model
+
+def quests_for_goal(goal_id):
+    return get_progress_model().quests_for_goal(goal_id)
+
+def store_goal_quests(quests_by_goal, persona):
+    # Replace each goal's quests, deduped within the goal only: goals legitimately share vocabulary ("compare
+    # insurance quotes"), and deduping across them could leave a goal with no quests at all
+    model = get_progress_model()
+    goals = {goal['id']: goal for goal in st.session_state.generated_goals}
+    model.set_goal_quests({goal_id: dedupe_quests(quests, (), get_quest_library(), goals.get(goal_id), persona)
+                           for goal_id, quests in quests_by_goal.items()})
+
+def complete_quest(quest, rewards_agent, persona):
+    # Idempotent, so a double click or a resubmitted quiz cannot award the same quest twice
+    if not get_progress_model().complete(quest):
+        return None
+    progress = st.session_state.user_progress
+    reward = rewards_agent.calculate_reward(quest, progress['level'])
+    events = [
+        {'type': "QuestCompleted", 'quest_id': quest['id'], 'goal_id': quest['goal_id'],
+         'base_points': quest.get('points') or REWARD_RULES['default_points'], 'level': progress['level']},
+        {'type': "PointsAwarded", 'quest_id': quest['id'], 'points': reward['points_earned'],
+         'cohorts': leaderboard_cohorts(persona, progress['current_goal'])},
+    ]
+    new_unlocks = [product for product in reward['unlock_rewards'] if product not in progress['unlocked_products']]
+    events.extend({'type': "ProductUnlocked", 'product': product} for product in new_unlocks)
+    new_level = int(level_for_points(progress['total_points'] + reward['points_earned']))
+    if new_level > progress['level']:
+        events.append({'type': "LevelUp", 'level': new_level})
+    for event in events:
+        apply_event(progress, event)
+    # The leaderboards pick the points up from the ledger, as every other worker process does
+    get_leaderboards()
+    get_event_ledger().append(st.session_state.hydrated_user_id, events)
+    st.success(f"🎉 Quest completed! You earned {reward['points_earned']} points!")
+    if new_unlocks:
+        st.success(f"🔓 Unlocked: {', '.join(new_unlocks)}")
+    if events[-1]['type'] == "LevelUp":
+        st.balloons()
+    return reward
+
+def completed_count_for_goal(goal_id):
+    return get_progress_model().completed_count(goal_id)
+
+def nudge_context(user_progress):
+    goal = user_progress['current_goal']
+    return (st.session_state.current_user, goal['id'] if goal else None, user_progress['total_points'],
+            user_progress['level'], len(user_progress['completed_quests']), len(user_progress['unlocked_products']))
+
+def schedule_prefetch(quest_agent, nudge_agent, goal, persona):
+    # Start the next progressive batch one completion early, and precompute the nudge for the new progress state
+    scheduler = get_prefetch_scheduler()
+    completed_count = completed_count_for_goal(goal['id'])
+    milestone = ((completed_count + 1) // PROGRESSIVE_QUEST_INTERVAL) * PROGRESSIVE_QUEST_INTERVAL
+    if milestone and f"{goal['id']}:{milestone}" not in st.session_state.delivered_quest_batches:
+        scheduler.submit(
+            f"progressive_{goal['id']}", (st.session_state.current_user, goal['id'], milestone),
+            quest_agent.generate_progressive_quests, dict(goal), dict(persona), milestone
+        )
+    progress = json.loads(json.dumps(st.session_state.user_progress))
+    scheduler.submit(
+        "nudge", nudge_context(progress),
+        nudge_agent.get_next_best_action, progress, dict(persona), progress['current_goal']
+    )
+
+def deliver_prefetched_quests(quest_agent, goal, persona):
+    milestone = (completed_count_for_goal(goal['id']) // PROGRESSIVE_QUEST_INTERVAL) * PROGRESSIVE_QUEST_INTERVAL
+    batch_key = f"{goal['id']}:{milestone}"
+    if not milestone or batch_key in st.session_state.delivered_quest_batches:
+        return
+    scheduler = get_prefetch_scheduler()
+    name, context = f"progressive_{goal['id']}", (st.session_state.current_user, goal['id'], milestone)
+    new_quests = scheduler.take(name, context)
+    if new_quests is None:
+        scheduler.submit(name, context, quest_agent.generate_progressive_quests, dict(goal), dict(persona), milestone)
+        st.caption("🔄 Preparing your next quests...")
+        return
+    st.session_state.delivered_quest_batches.append(batch_key)
+    model = get_progress_model()
+    held = [q for q in model.quests if q['goal_id'] == goal['id']]
+    new_quests = dedupe_quests(new_quests, held, get_quest_library(), goal, persona)
+    if not new_quests:
+        return
+    model.add_quests(new_quests)
+    st.success(f"🆕 New quests unlocked!")
 
 def get_goal_popularity_percentage(category, age):
     # Simulated percentages for UK users pursuing each goal by age
@@ -589,6 +3659,143 @@ def get_goal_popularity_percentage(category, age):
     }
     return popularity_map.get(category, 50)
 
+def finish_quest(quest, quest_agent, nudge_agent, rewards_agent, persona):
+    # Only the card is redrawn unless the completion changes something rendered elsewhere on the page
+    progress = st.session_state.user_progress
+    level, unlocked = progress['level'], len(progress['unlocked_products'])
+    current_goal = progress['current_goal']
+    if complete_quest(quest, rewards_agent, persona):
+        schedule_prefetch(quest_agent, nudge_agent, current_goal, persona)
+    persist_session_state(get_progress_store())
+    milestone = completed_count_for_goal(current_goal['id']) % PROGRESSIVE_QUEST_INTERVAL == 0
+    if milestone or progress['level'] != level or len(progress['unlocked_products']) != unlocked:
+        st.rerun()
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        # Reached during a full-app run (the card is then redrawn with everything else)
+        st.rerun()
+
+@st.fragment
+def render_quest_card(quest, quest_agent, nudge_agent, rewards_agent, persona):
+    session_usage_meter()
+    quest_id = quest['id']
+    is_completed = get_progress_model().is_completed(quest_id)
+    status_icon = "✅" if is_completed else "🎯"
+    card = st.expander(f"{status_icon} {quest['title']} ({quest.get('points', 100)} pts)", key=f"card_{quest_id}", on_change="rerun")
+    with card:
+        st.write(f"**Description:** {quest['description']}")
+        st.write(f"**Type:** {quest['type']}")
+        st.write(f"**Difficulty:** {quest['difficulty']}")
+        st.write(f"**Estimated Time:** {quest['estimated_time']}")
+        st.write(f"**Unlock Reward:** {quest['unlock_reward']}")
+        if is_completed:
+            st.success("✅ Quest completed!")
+            return
+        if not card.open:
+            return
+        if quest_needs_details(quest):
+            with st.spinner("AI Quest Agent is preparing this quest..."):
+                details = quest_agent.generate_quest_details(quest, persona)
+            if not details:
+                st.warning("This quest's content isn't ready yet. Close and reopen it to try again.")
+                return
+            quest.update(details)
+            persist_session_state(get_progress_store())
+        if quest['type'] == 'learning' and 'learning_content' in quest:
+            st.markdown("### 📚 Learning Content")
+            st.markdown(quest['learning_content'])
+            st.markdown("---")
+            if st.button(f"Mark as Completed", key=f"complete_{quest_id}"):
+                finish_quest(quest, quest_agent, nudge_agent, rewards_agent, persona)
+        if quest['type'] in ('action', 'challenge') and 'action_steps' in quest:
+            st.markdown("### 🎯 Action Steps")
+            for i, step in enumerate(quest['action_steps'], 1):
+                st.write(f"{i}. {step}")
+            st.markdown("---")
+            if st.button(f"Mark as Completed", key=f"complete_{quest_id}"):
+                finish_quest(quest, quest_agent, nudge_agent, rewards_agent, persona)
+        if 'questions' in quest and quest['questions']:
+            st.subheader("📝 Complete the Quiz:")
+            with st.form(key=f"quiz_{quest_id}"):
+                user_answers = {}
+                for i, q in enumerate(quest['questions']):
+                    st.write(f"**Question {i+1}:** {q['question']}")
+                    user_answers[i] = st.radio("Choose your answer:", q['options'], key=f"q_{quest_id}_{i}")
+                submitted = st.form_submit_button("Submit Quiz", key=f"submit_{quest_id}")
+            if submitted:
+                all_correct = True
+                for i, q in enumerate(quest['questions']):
+                    if user_answers[i] != q['options'][q['correct']]:
+                        all_correct = False
+                        st.error(f"Question {i+1}: Incorrect. {q['explanation']}")
+                    else:
+                        st.success(f"Question {i+1}: Correct! {q['explanation']}")
+                if all_correct:
+                    finish_quest(quest, quest_agent, nudge_agent, rewards_agent, persona)
+
+@st.fragment
+def render_rewards(rewards_agent, persona):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("💰 LifePoints", st.session_state.user_progress['total_points'])
+    with col2:
+        st.metric("🏅 Level", st.session_state.user_progress['level'])
+    with col3:
+        completion_rate = (len(st.session_state.user_progress['completed_quests']) / max(len(st.session_state.generated_quests), 1)) * 100
+        st.metric("📊 Completion Rate", f"{completion_rate:.1f}%")
+    if st.session_state.user_progress['unlocked_products']:
+        st.subheader("🔓 Unlocked Products & Trials")
+        for product in dict.fromkeys(st.session_state.user_progress['unlocked_products']):
+            st.success(f"✅ {product}")
+            st.success("**🏆You are rewarded with LifePoints and unlocks a simplified £50K critical illness cover for just £5/month**")
+    total_points = st.session_state.user_progress['total_points']
+    badge = rewards_agent.get_achievement_badge(total_points)
+    st.subheader(f"🏆 Current Achievement: {badge}")
+    st.subheader("🏆 Leaderboard")
+    leaderboards = get_leaderboards()
+    get_event_ledger().sync()
+    user_id = st.session_state.hydrated_user_id
+    cohorts = leaderboard_cohorts(persona, st.session_state.user_progress['current_goal'])
+    leaderboards.ensure_user(user_id, persona['name'], total_points, cohorts)
+    board_labels = {LeaderboardRegistry.GLOBAL: "Everyone"}
+    board_labels.update({cohort: cohort.split(":", 1)[1] for cohort in cohorts})
+    board_name = st.radio("Compare with:", list(board_labels), format_func=board_labels.get, horizontal=True)
+    board = leaderboards.board(board_name)
+    entries = {entry[1]: entry for entry in board.top(5)}
+    entries.update({entry[1]: entry for entry in board.around(user_id, 2)})
+    st.caption(f"{len(board):,} members on this board")
+    for rank, entry_user, points in sorted(entries.values(), key=lambda e: -e[2]):
+        if entry_user == user_id:
+            st.success(f"#{rank} 🏆 You: {points} points")
+        else:
+            st.info(f"#{rank} {leaderboards.display_name(entry_user)}: {points} points")
+
+def render_operator_panel():
+    # Process-wide health for operators, shown only when the page is opened with ?operator=<LIFEQUEST_OPERATOR_TOKEN>
+    with st.sidebar.expander("Operator metrics"):
+        st.markdown("**LLM calls by agent**")
+        st.dataframe(get_agent_telemetry().snapshot(), hide_index=True)
+        cache, pool, structured = get_response_cache(), get_quest_pool(), get_structured_output_stats()
+        st.markdown(f"**Response cache** hit rate {cache.hit_rate():.0%}")
+        st.json(cache.stats, expanded=False)
+        st.markdown("**Quest pool**")
+        st.json(pool.stats, expanded=False)
+        library = get_quest_library()
+        st.markdown(f"**Quest library** {len(library):,} distinct quests")
+        st.json(library.stats, expanded=False)
+        st.markdown(f"**Structured output** parse failure rate {structured.parse_failure_rate():.1%}, "
+                    f"about {structured.output_tokens_saved():,} output tokens saved by short keys")
+        st.json(structured.counts, expanded=False)
+        st.markdown("**LLM scheduler**")
+        st.json(get_llm_scheduler().metrics(), expanded=False)
+        http = get_client_registry().metrics()
+        st.markdown(f"**HTTP connection pool** utilisation {http['pool_utilisation']:.0%}")
+        st.json(http, expanded=False)
+        st.markdown(f"**Nudge table** served locally {get_nudge_table().local_share():.0%}")
+        st.markdown("**This session**")
+        st.json(dict(st.session_state.get('llm_usage', {})), expanded=False)
+
 def main():
     st.set_page_config(
         page_title="Lloyds LifeQuest",
@@ -599,51 +3806,47 @@ def main():
     
     initialize_openai()
     initialize_session_state()
+    session_usage_meter()
     
     # Initialize AI Agents
-    goal_coach = GoalCoachAgent(st.session_state.openai_client)
-    quest_agent = QuestAgent(st.session_state.openai_client)
-    nudge_agent = NudgeAgent(st.session_state.openai_client)
-    rewards_agent = RewardsAgent(st.session_state.openai_client)
+    goal_coach, quest_agent, nudge_agent, rewards_agent, coach_agent = get_agents(st.session_state.openai_api_key)
     
     # Sidebar - User Profile Selection
     st.sidebar.title("🏦 Lloyds LifeQuest")
     st.sidebar.markdown("### Persona Selection")
     
+    catalog = get_persona_catalog()
     if st.session_state.current_user is None:
-        selected_persona = st.sidebar.selectbox(
-            "Select Profile:",
-            list(PERSONAS_CONFIG.keys()),
-            format_func=lambda x: f"{PERSONAS_CONFIG[x]['avatar']} {PERSONAS_CONFIG[x]['name']}"
-        )
-        # Input fields for persona attributes
-        default_persona = PERSONAS_CONFIG[selected_persona]
-        age = st.sidebar.number_input("Age", min_value=18, max_value=100, value=default_persona['age'])
-        st.sidebar.markdown("### Lifestyle Selection")
-        occupation = st.sidebar.text_input("Occupation", value=default_persona['occupation'])
-        income_range = st.sidebar.text_input("Income Range", value=default_persona['income_range'])
-        current_products = st.sidebar.multiselect(
-            "Current Products",
-            options=AVAILABLE_PRODUCTS,
-            default=default_persona['current_products']
-        )
-        if st.sidebar.button("Start Your Journey"):
-            st.session_state.current_user = selected_persona
-            st.session_state.current_user_data = {
-                'name': default_persona['name'],
-                'age': age,
-                'occupation': occupation,
-                'income_range': income_range,
-                'current_products': current_products,
-                'financial_status': default_persona['financial_status'],
-                'risk_profile': default_persona['risk_profile'],
-                'avatar': default_persona['avatar']
-            }
-            # Update PERSONAS_CONFIG with user inputs
-            PERSONAS_CONFIG[selected_persona].update(st.session_state.current_user_data)
-            st.rerun()
+        query = ""
+        if len(catalog) > PERSONA_SEARCH_LIMIT:
+            query = st.sidebar.text_input("Search customers", placeholder="Name or customer ID")
+        options = catalog.search(query)
+        if not options:
+            st.sidebar.warning("No customers match your search")
+        else:
+            selected_persona = st.sidebar.selectbox("Select Profile:", options, format_func=catalog.label)
+            # Input fields for persona attributes
+            default_persona = catalog.get(selected_persona)
+            age = st.sidebar.number_input("Age", min_value=18, max_value=100, value=default_persona['age'])
+            st.sidebar.markdown("### Lifestyle Selection")
+            occupation = st.sidebar.text_input("Occupation", value=default_persona['occupation'])
+            income_range = st.sidebar.text_input("Income Range", value=default_persona['income_range'])
+            current_products = st.sidebar.multiselect(
+                "Current Products",
+                options=AVAILABLE_PRODUCTS,
+                default=[p for p in default_persona['current_products'] if p in AVAILABLE_PRODUCTS]
+            )
+            if st.sidebar.button("Start Your Journey"):
+                st.session_state.current_user = selected_persona
+                st.session_state.current_user_data = {
+                    'age': age,
+                    'occupation': occupation,
+                    'income_range': income_range,
+                    'current_products': current_products,
+                }
+                st.rerun()
     else:
-        persona = PERSONAS_CONFIG[st.session_state.current_user]
+        persona = session_persona(catalog)
         st.sidebar.success(f"Welcome back, {persona['name']}!")
         st.sidebar.markdown("### Update Profile")
         age = st.sidebar.number_input("Age", min_value=18, max_value=100, value=persona['age'])
@@ -652,20 +3855,16 @@ def main():
         current_products = st.sidebar.multiselect(
             "Current Products",
             options=AVAILABLE_PRODUCTS,
-            default=persona['current_products']
+            default=[p for p in persona['current_products'] if p in AVAILABLE_PRODUCTS]
         )
         if st.sidebar.button("Update Profile"):
             st.session_state.current_user_data = {
-                'name': persona['name'],
                 'age': age,
                 'occupation': occupation,
                 'income_range': income_range,
                 'current_products': current_products,
-                'financial_status': persona['financial_status'],
-                'risk_profile': persona['risk_profile'],
-                'avatar': persona['avatar']
             }
-            PERSONAS_CONFIG[st.session_state.current_user].update(st.session_state.current_user_data)
+            get_prefetch_scheduler().cancel_all()
             st.success("Profile updated successfully!")
             st.rerun()
         st.sidebar.markdown("### Your Progress")
@@ -676,6 +3875,10 @@ def main():
             st.sidebar.markdown("### Current Goal")
             st.sidebar.info(f"🎯 {st.session_state.user_progress['current_goal']['title']}")
         if st.sidebar.button("Switch Profile"):
+            get_prefetch_scheduler().cancel_all()
+            # The new profile gets its own id, so its leaderboard entries and ledger history start from zero
+            st.query_params["uid"] = uuid.uuid4().hex
+            st.session_state.hydrated_user_id = None
             st.session_state.current_user = None
             st.session_state.user_progress = {
                 'total_points': 0,
@@ -689,7 +3892,11 @@ def main():
             st.session_state.generated_quests = []
             st.session_state.current_goal_id = None
             st.session_state.current_user_data = {}
+            st.session_state.delivered_quest_batches = []
+            st.session_state.coach_chat = new_coach_chat()
             st.rerun()
+    if OPERATOR_TOKEN and st.query_params.get("operator") == OPERATOR_TOKEN:
+        render_operator_panel()
     
     # Main Content
     if st.session_state.current_user is None:
@@ -709,7 +3916,7 @@ def main():
         **Choose your profile from the sidebar to begin!**
         """)
     else:
-        persona = PERSONAS_CONFIG[st.session_state.current_user]
+        persona = session_persona(catalog)
         st.title(f"Hi {persona['name']}! 👋 Let’s Secure your life with LifeQuest")
         
         # Progress Bar
@@ -726,11 +3933,11 @@ def main():
             if st.session_state.user_progress['current_goal']:
                 current_goal = st.session_state.user_progress['current_goal']
                 st.success(f"🎯 **Currently Selected Goal:** {current_goal['title']}")
-                completed_quests = [q for q in st.session_state.generated_quests if q['id'] in st.session_state.user_progress['completed_quests'] and q['goal_id'] == current_goal['id']]
-                total_quests = [q for q in st.session_state.generated_quests if q['goal_id'] == current_goal['id']]
-                progress = (len(completed_quests) / max(len(total_quests), 1)) * 100
+                total_quests = len(quests_for_goal(current_goal['id']))
+                completed_quests = completed_count_for_goal(current_goal['id'])
+                progress = (completed_quests / max(total_quests, 1)) * 100
                 st.progress(progress / 100)
-                st.caption(f"Goal Progress: {progress:.1f}% ({len(completed_quests)}/{len(total_quests)} quests completed)")
+                st.caption(f"Goal Progress: {progress:.1f}% ({completed_quests}/{total_quests} quests completed)")
                 if st.button("🎮 Go to Quests", type="primary"):
                     st.session_state.tab = "quests"
                     st.rerun()
@@ -742,6 +3949,12 @@ def main():
                         st.rerun()
             else:
                 st.success("✅ Goals generated by AI Goal Coach!")
+                missing_goals = [g for g in st.session_state.generated_goals if not quests_for_goal(g['id'])]
+                if missing_goals and st.button("⚡ Generate Quests for All Goals"):
+                    with st.spinner(f"AI Quest Agent is creating challenges for {len(missing_goals)} goals..."):
+                        served_titles = {q['title'] for q in st.session_state.generated_quests}
+                        store_goal_quests(quest_agent.generate_quests_for_goals(missing_goals, persona, exclude_titles=served_titles), persona)
+                        st.rerun()
                 for goal in st.session_state.generated_goals:
                     is_selected = st.session_state.user_progress['current_goal'] and st.session_state.user_progress['current_goal']['id'] == goal['id']
                     with st.expander(f"🎯 {goal['title']} ({goal['priority']} Priority)" + (" - SELECTED" if is_selected else "")):
@@ -756,7 +3969,7 @@ def main():
                         if not is_selected:
                             if st.button(f"Select This Goal", key=f"select_{goal['id']}"):
                                 st.session_state.user_progress['current_goal'] = goal
-                                st.session_state.generated_quests = []
+                                get_prefetch_scheduler().cancel_all()
                                 st.success(f"Goal selected: {goal['title']}")
                                 st.rerun()
                         else:
@@ -767,235 +3980,289 @@ def main():
             if st.session_state.user_progress['current_goal']:
                 current_goal = st.session_state.user_progress['current_goal']
                 st.info(f"Current Goal: **{current_goal['title']}**")
-                if not st.session_state.generated_quests:
+                goal_quests = quests_for_goal(current_goal['id'])
+                if not goal_quests:
                     if st.button("🤖 Generate Quests for This Goal", type="primary"):
-                        with st.spinner("AI Quest Agent is creating your challenges..."):
-                            quests = quest_agent.generate_quests_for_goal(current_goal, persona)
-                            st.session_state.generated_quests = quests
-                            st.rerun()
+                        st.caption("AI Quest Agent is creating your challenges...")
+                        quests = []
+                        served_titles = {q['title'] for q in st.session_state.generated_quests}
+                        started = time.perf_counter()
+                        for quest in quest_agent.stream_quests_for_goal(current_goal, persona, exclude_titles=served_titles):
+                            quests.append(quest)
+                            with st.expander(f"🎯 {quest['title']} ({quest.get('points', 100)} pts)"):
+                                st.write(f"**Description:** {quest['description']}")
+                                st.write(f"**Type:** {quest['type']}")
+                        meter = session_usage_meter()
+                        meter['quest_lists'] += 1
+                        meter['quest_list_seconds'] += time.perf_counter() - started
+                        logger.info("quest list for %s ready in %.2fs; session has used %d tokens in %d LLM calls",
+                                    current_goal['id'], time.perf_counter() - started,
+                                    meter['prompt_tokens'] + meter['completion_tokens'], meter['llm_calls'])
+                        store_goal_quests({current_goal['id']: quests}, persona)
+                        st.rerun()
                 else:
                     st.success("✅ Quests generated by AI Quest Agent!")
-                    for quest in st.session_state.generated_quests:
-                        if quest['goal_id'] != current_goal['id']:
-                            continue
-                        quest_id = quest['id']
-                        is_completed = quest_id in st.session_state.user_progress['completed_quests']
-                        status_icon = "✅" if is_completed else "🎯"
-                        with st.expander(f"{status_icon} {quest['title']} ({quest.get('points', 100)} pts)"):
-                            st.write(f"**Description:** {quest['description']}")
-                            st.write(f"**Type:** {quest['type']}")
-                            st.write(f"**Difficulty:** {quest['difficulty']}")
-                            st.write(f"**Estimated Time:** {quest['estimated_time']}")
-                            st.write(f"**Unlock Reward:** {quest['unlock_reward']}")
-                            if not is_completed:
-                                if quest['type'] == 'learning' and 'learning_content' in quest:
-                                    st.markdown("### 📚 Learning Content")
-                                    st.markdown(quest['learning_content'])
-                                    st.markdown("---")
-                                    if st.button(f"Mark as Completed", key=f"complete_{quest_id}"):
-                                        st.session_state.user_progress['completed_quests'].append(quest_id)
-                                        reward = rewards_agent.calculate_reward(quest, st.session_state.user_progress['level'])
-                                        st.session_state.user_progress['total_points'] += reward['points_earned']
-                                        if reward['unlock_rewards']:
-                                            st.session_state.user_progress['unlocked_products'].extend(reward['unlock_rewards'])
-                                        st.success(f"🎉 Quest completed! You earned {reward['points_earned']} points!")
-                                        if reward['unlock_rewards']:
-                                            st.success(f"🔓 Unlocked: {', '.join(reward['unlock_rewards'])}")
-                                        if st.session_state.user_progress['total_points'] >= (st.session_state.user_progress['level'] * 500):
-                                            st.session_state.user_progress['level'] += 1
-                                            st.balloons()
-                                        completed_count = len([q for q in st.session_state.user_progress['completed_quests'] if q.startswith(f"quest_{current_goal['id']}_")])
-                                        if completed_count % 3 == 0:
-                                            new_quests = quest_agent.generate_progressive_quests(current_goal, persona, completed_count)
-                                            st.session_state.generated_quests.extend(new_quests)
-                                            st.success(f"🆕 New quests unlocked!")
-                                        st.rerun()
-                                if quest['type'] == 'action' and 'action_steps' in quest:
-                                    st.markdown("### 🎯 Action Steps")
-                                    for i, step in enumerate(quest['action_steps'], 1):
-                                        st.write(f"{i}. {step}")
-                                    st.markdown("---")
-                                    if st.button(f"Mark as Completed", key=f"complete_{quest_id}"):
-                                        st.session_state.user_progress['completed_quests'].append(quest_id)
-                                        reward = rewards_agent.calculate_reward(quest, st.session_state.user_progress['level'])
-                                        st.session_state.user_progress['total_points'] += reward['points_earned']
-                                        if reward['unlock_rewards']:
-                                            st.session_state.user_progress['unlocked_products'].extend(reward['unlock_rewards'])
-                                        st.success(f"🎉 Quest completed! You earned {reward['points_earned']} points!")
-                                        if reward['unlock_rewards']:
-                                            st.success(f"🔓 Unlocked: {', '.join(reward['unlock_rewards'])}")
-                                        if st.session_state.user_progress['total_points'] >= (st.session_state.user_progress['level'] * 500):
-                                            st.session_state.user_progress['level'] += 1
-                                            st.balloons()
-                                        completed_count = len([q for q in st.session_state.user_progress['completed_quests'] if q.startswith(f"quest_{current_goal['id']}_")])
-                                        if completed_count % 3 == 0:
-                                            new_quests = quest_agent.generate_progressive_quests(current_goal, persona, completed_count)
-                                            st.session_state.generated_quests.extend(new_quests)
-                                            st.success(f"🆕 New quests unlocked!")
-                                        st.rerun()
-                                if 'questions' in quest and quest['questions']:
-                                    st.subheader("📝 Complete the Quiz:")
-                                    user_answers = {}
-                                    for i, q in enumerate(quest['questions']):
-                                        st.write(f"**Question {i+1}:** {q['question']}")
-                                        user_answer = st.radio(
-                                            "Choose your answer:",
-                                            q['options'],
-                                            key=f"q_{quest_id}_{i}"
-                                        )
-                                        user_answers[i] = user_answer
-                                    if st.button(f"Submit Quiz", key=f"submit_{quest_id}"):
-                                        all_correct = True
-                                        for i, q in enumerate(quest['questions']):
-                                            correct_answer = q['options'][q['correct']]
-                                            if user_answers[i] != correct_answer:
-                                                all_correct = False
-                                                st.error(f"Question {i+1}: Incorrect. {q['explanation']}")
-                                            else:
-                                                st.success(f"Question {i+1}: Correct! {q['explanation']}")
-                                        if all_correct:
-                                            st.session_state.user_progress['completed_quests'].append(quest_id)
-                                            reward = rewards_agent.calculate_reward(quest, st.session_state.user_progress['level'])
-                                            st.session_state.user_progress['total_points'] += reward['points_earned']
-                                            if reward['unlock_rewards']:
-                                                st.session_state.user_progress['unlocked_products'].extend(reward['unlock_rewards'])
-                                            st.success(f"🎉 Quest completed! You earned {reward['points_earned']} points!")
-                                            if reward['unlock_rewards']:
-                                                st.success(f"🔓 Unlocked: {', '.join(reward['unlock_rewards'])}")
-                                            if st.session_state.user_progress['total_points'] >= (st.session_state.user_progress['level'] * 500):
-                                                st.session_state.user_progress['level'] += 1
-                                                st.balloons()
-                                            completed_count = len([q for q in st.session_state.user_progress['completed_quests'] if q.startswith(f"quest_{current_goal['id']}_")])
-                                            if completed_count % 3 == 0:
-                                                new_quests = quest_agent.generate_progressive_quests(current_goal, persona, completed_count)
-                                                st.session_state.generated_quests.extend(new_quests)
-                                                st.success(f"🆕 New quests unlocked!")
-                                        st.rerun()
-                            else:
-                                st.success("✅ Quest completed!")
+                    deliver_prefetched_quests(quest_agent, current_goal, persona)
+                    for quest in quests_for_goal(current_goal['id']):
+                        render_quest_card(quest, quest_agent, nudge_agent, rewards_agent, persona)
             else:
                 st.info("👈 Select a goal first to unlock quests!")
         
         with tab4:
             st.header("Your Rewards & Achievements")
             st.markdown("**Points can be redeemed as a discount on processing fees for Lloyds Bank products.**")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.metric("💰 LifePoints", st.session_state.user_progress['total_points'])
-            with col2:
-                st.metric("🏅 Level", st.session_state.user_progress['level'])
-            with col3:
-                completion_rate = (len(st.session_state.user_progress['completed_quests']) / max(len(st.session_state.generated_quests), 1)) * 100
-                st.metric("📊 Completion Rate", f"{completion_rate:.1f}%")
-            if st.session_state.user_progress['unlocked_products']:
-                st.subheader("🔓 Unlocked Products & Trials")
-                for product in st.session_state.user_progress['unlocked_products']:
-                    st.success(f"✅ {product}")
-                    st.success("**🏆You are rewarded with LifePoints and unlocks a simplified £50K critical illness cover for just £5/month**")
-            total_points = st.session_state.user_progress['total_points']
-            badge = rewards_agent.get_achievement_badge(total_points)
-            st.subheader(f"🏆 Current Achievement: {badge}")
-            st.subheader("🏆 Leaderboard")
-            leaderboard_data = [
-                {"name": "You", "points": st.session_state.user_progress['total_points']},
-                {"name": "Alex M.", "points": random.randint(800, 1500)},
-                {"name": "Sarah K.", "points": random.randint(600, 1200)},
-                {"name": "Mike R.", "points": random.randint(400, 1000)},
-                {"name": "Emma L.", "points": random.randint(200, 800)}
-            ]
-            leaderboard_data.sort(key=lambda x: x['points'], reverse=True)
-            for i, user in enumerate(leaderboard_data):
-                if user['name'] == "You":
-                    st.success(f"#{i+1} 🏆 {user['name']}: {user['points']} points")
-                else:
-                    st.info(f"#{i+1} {user['name']}: {user['points']} points")
-        
+            render_rewards(rewards_agent, persona)
+
         with tab3:
             st.header("💡 AI Coach Recommendations")
             if st.button("🤖 Get Next Best Action", type="primary"):
-                with st.spinner("AI Coach is analyzing your progress..."):
-                    nudge = nudge_agent.get_next_best_action(st.session_state.user_progress, persona, st.session_state.user_progress['current_goal'])
-                    st.success(f"💬 **Coach Says:** {nudge['message']}")
-                    st.info(f"🎯 **Next Action:** {nudge['action']}")
-                    st.warning(f"⚡ **Urgency:** {nudge['urgency']}")
-                    st.warning("⚡ **Projected inflation is 4.2% — consider adjusting your coverage.**")
-                    if nudge.get('reward_mention'):
-                        st.success(f"🎁 **Reward:** {nudge['reward_mention']}")
+                coach_says = st.empty()
+                nudge = get_prefetch_scheduler().take("nudge", nudge_context(st.session_state.user_progress))
+                if nudge is None:
+                    coach_says.info("AI Coach is analyzing your progress...")
+                    for nudge in nudge_agent.stream_next_best_action(st.session_state.user_progress, persona, st.session_state.user_progress['current_goal']):
+                        coach_says.success(f"💬 **Coach Says:** {nudge['message']}")
+                else:
+                    coach_says.success(f"💬 **Coach Says:** {nudge['message']}")
+                st.info(f"🎯 **Next Action:** {nudge['action']}")
+                st.warning(f"⚡ **Urgency:** {nudge['urgency']}")
+                st.warning("⚡ **Projected inflation is 4.2% — consider adjusting your coverage.**")
+                if nudge.get('reward_mention'):
+                    st.success(f"🎁 **Reward:** {nudge['reward_mention']}")
             st.subheader("💬 Chat with Your AI Coach")
+            chat = st.session_state.coach_chat
+            apply_coach_summary(chat, get_prefetch_scheduler())
+            for turn in chat['turns'][-COACH_CHAT_MAX_STORED_TURNS:]:
+                with st.chat_message(turn['role'], avatar="🤖" if turn['role'] == "assistant" else None):
+                    st.markdown(turn['content'])
             user_question = st.text_input("Ask your AI Coach anything about your financial journey:")
             if user_question and st.button("Ask Coach"):
-                messages = [
-                    {"role": "system", "content": f"""You are a warm, intelligent, and friendly financial advisor for Lloyds Bank LifeQuest.
+                recent_ids = set(st.session_state.user_progress['completed_quests'][-DIGEST_MAX_RECENT_QUESTS:])
+                recent = [q['title'] for q in get_progress_model().quests if q['id'] in recent_ids]
+                history = coach_chat_window(chat)
+                with st.chat_message("user"):
+                    st.markdown(user_question)
+                with st.chat_message("assistant", avatar="🤖"):
+                    answer = st.write_stream(coach_agent.stream_answer(user_question, st.session_state.user_progress,
+                                                                       persona, recent, history))
+                if isinstance(answer, str) and answer:
+                    chat['turns'].append({'role': 'user', 'content': user_question})
+                    chat['turns'].append({'role': 'assistant', 'content': answer})
+                    schedule_coach_summary(coach_agent, chat, get_prefetch_scheduler())
 
-Your goal is to recommend **the best affordable health insurance plan** based on the user's income, lifestyle, and job pattern. 
+    persist_session_state(get_progress_store())
 
-The user is {persona['name']}, a {persona['age']}-year-old {persona['occupation']} with income range {persona['income_range']}.
+# Offline batch runner: JSONL persona/goal requests in, sharded JSONL results out, resumable from a checkpoint
+BATCH_OUTPUT_DIR = "batch_output"
+BATCH_SHARDS = 8
+BATCH_WORKERS = 8
+BATCH_REPORT_SECONDS = 10.0
 
-Their current profile and financial goal:
-{json.dumps(st.session_state.user_progress, indent=2)}
+def iter_batch_requests(path):
+    # Yields (request_id, request); the id defaults to the line number so unlabelled inputs still resume correctly
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                request = json.loads(line)
+                yield str(request.get('id') or f"line-{line_number}"), request
 
----
+def batch_persona(request, catalog):
+    if request.get('persona_id'):
+        base = catalog.get(request['persona_id'])
+        if base is None:
+            raise KeyError(f"unknown persona_id {request['persona_id']}")
+        return dict(ChainMap(request.get('persona') or {}, base))
+    return dict(PERSONA_DEFAULTS, **request['persona'])
 
-### 🔧 HOW TO RESPOND:
-Give your response like a trusted coach who knows their life and wants to help.
-
-Use the following structure and tone:
-
----
-
-**🧭 Here's What I Recommend For You:**
-
-Hi {persona['name']}, based on your income and freelance work pattern, here's a personalized health insurance suggestion to help you stay covered — without breaking your budget.
-
----
-
-**💡 Recommended Plan:**
-- ✅ **Plan Type**: Comprehensive cashless health cover  
-- 💰 **Coverage Amount**: £50,000  
-- 💸 **Estimated Monthly Premium**: £70–£90
+class BatchFallbackError(RuntimeError):
+    # An agent could only offer its canned default; the request is retried on the next run instead of being checkpointed
+    pass
 
-This is a good balance between affordability and protection, especially for self-employed professionals like you.
+def run_batch_request(request, goal_coach, quest_agent, nudge_agent, catalog):
+    persona = batch_persona(request, catalog)
+    if request.get('goal'):
+        goal = request['goal']
+        goals = [{'id': 'goal_1', 'description': goal.get('title', ''), 'priority': 'High', 'target_amount': 0, **goal}]
+    else:
+        goals = goal_coach.generate_personalized_goals(persona, use_defaults=False)
+        if not goals:
+            raise BatchFallbackError("goal generation failed")
+    quests = quest_agent.generate_quests_for_goals(goals, persona, use_defaults=False)
+    failed = [goal_id for goal_id, goal_quests in quests.items() if not goal_quests]
+    if failed:
+        raise BatchFallbackError(f"quest generation failed for {', '.join(failed)}")
+    progress = {'total_points': 0, 'level': 1, 'completed_quests': [], 'current_goal': goals[0] if goals else None,
+                'achievements': [], 'unlocked_products': []}
+    nudge = nudge_agent.get_next_best_action(progress, persona, progress['current_goal'], use_defaults=False)
+    if not nudge:
+        raise BatchFallbackError("nudge generation failed")
+    return {'persona_id': request.get('persona_id'), 'goals': goals, 'quests': quests, 'nudge': nudge}
 
----
+def truncate_partial_line(path, block_size=65536):
+    # Drops a trailing line cut short by a crash so later appends start on a line boundary
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            step = min(block_size, position)
+            f.seek(position - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                if position - step + newline + 1 < end:
+                    f.truncate(position - step + newline + 1)
+                return
+            position -= step
+        f.truncate(0)
 
-**📊 Why This Fits Your Budget:**
-With your income in the range of {persona['income_range']}, spending about **1.5–2% of your income** on health insurance is a smart choice.
+class BatchWriter:
+    # Results go to a shard chosen by a stable hash of the request id. An id is added to the checkpoint only after
+    # its result line is flushed, so a crash can at worst repeat the requests that were in flight
+    def __init__(self, output_dir, shards):
+        os.makedirs(output_dir, exist_ok=True)
+        self.shards = shards
+        self._lock = threading.Lock()
+        shard_paths = [os.path.join(output_dir, f"shard-{i:03d}.jsonl") for i in range(shards)]
+        checkpoint_path = os.path.join(output_dir, "checkpoint.txt")
+        for path in shard_paths + [checkpoint_path]:
+            truncate_partial_line(path)
+        self.done = set()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, encoding='utf-8') as f:
+                self.done = {line.rstrip("\n") for line in f}
+        self._files = [open(path, 'a', encoding='utf-8') for path in shard_paths]
+        self._checkpoint = open(checkpoint_path, 'a', encoding='utf-8')
+        self._errors = open(os.path.join(output_dir, "errors.jsonl"), 'a', encoding='utf-8')
 
-That means:
-- **Estimated Budget for Insurance**: £600–£900/year  
-- Which equals about **£70–£90 per month**
+    def write(self, request_id, result):
+        line = json.dumps({'id': request_id, **result}, separators=(',', ':')) + "\n"
+        shard = int(hashlib.md5(request_id.encode()).hexdigest(), 16) % self.shards
+        with self._lock:
+            self._files[shard].write(line)
+            self._files[shard].flush()
+            self._checkpoint.write(request_id + "\n")
+            self._checkpoint.flush()
+            self.done.add(request_id)
 
-This keeps your savings intact while still getting essential medical protection.
+    def write_error(self, request_id, error):
+        with self._lock:
+            self._errors.write(json.dumps({'id': request_id, 'error': repr(error), 'ts': time.time()}) + "\n")
+            self._errors.flush()
 
----
+    def close(self):
+        for f in self._files + [self._checkpoint, self._errors]:
+            f.close()
 
-**🎯 Why This Plan Is Right For You:**
-- You're a freelancer, so your income might vary — this plan offers **flexible premium options** and **cashless claims** to reduce stress during emergencies.
-- It covers common medical expenses and hospitalization without the need for pre-approvals or long waiting periods.
-- You don’t need to over-insure — this level of cover is enough to handle most medium-risk situations.
+def run_batch(input_path, agents, output_dir=BATCH_OUTPUT_DIR, workers=BATCH_WORKERS, shards=BATCH_SHARDS,
+              report_seconds=BATCH_REPORT_SECONDS):
+    goal_coach, quest_agent, nudge_agent = agents
+    catalog = get_persona_catalog()
+    writer = BatchWriter(output_dir, shards)
+    meter = Counter()
+    llm_usage.set(meter)
+    stats = Counter(skipped=0, done=0, failed=0)
+    started = last_report = time.time()
 
----
+    def report(final=False):
+        elapsed = max(time.time() - started, 1e-9)
+        tokens = meter['prompt_tokens'] + meter['completion_tokens']
+        # A long scheduler wait means the run is held back by the RPM/TPM quota rather than by --workers
+        wait_ms = get_llm_scheduler().metrics()[f'wait_ms_mean_{PRIORITY_NAMES[PRIORITY_PREFETCH]}']
+        print(f"{'done' if final else 'progress'}: {stats['done']} written, {stats['failed']} failed, {stats['skipped']} "
+              f"already done; {stats['done'] / elapsed:.1f} req/s, {meter['llm_calls']} LLM calls, {tokens:,} tokens "
+              f"({tokens / elapsed:,.0f} tok/s), mean quota wait {wait_ms:.0f} ms, in {elapsed:.1f}s", flush=True)
 
-**⚠️ A Quick Heads-Up:**
-Medical inflation is currently around **6.2%**. This means treatment costs can rise fast — so it’s better to **lock in a plan now** while premiums are low.
+    def settle(future):
+        request_id = in_flight.pop(future)
+        try:
+            writer.write(request_id, future.result())
+            stats['done'] += 1
+        except Exception as error:
+            logger.warning("batch request %s failed: %r", request_id, error)
+            writer.write_error(request_id, error)
+            stats['failed'] += 1
 
-If your income grows in the next 6–12 months, you can upgrade your plan or add critical illness cover later.
+    # At most 2x workers requests are read ahead, so inputs of any size stream through in bounded memory
+    in_flight = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for request_id, request in iter_batch_requests(input_path):
+                if request_id in writer.done:
+                    stats['skipped'] += 1
+                    continue
+                while len(in_flight) >= 2 * workers:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        settle(future)
+                future = executor.submit(contextvars.copy_context().run, run_with_priority, PRIORITY_PREFETCH,
+                                         run_batch_request, request, goal_coach, quest_agent, nudge_agent, catalog)
+                in_flight[future] = request_id
+                if time.time() - last_report >= report_seconds:
+                    report()
+                    last_report = time.time()
+            for future in as_completed(list(in_flight)):
+                settle(future)
+    finally:
+        writer.close()
+        get_quest_pool().save()
+        get_nudge_table().save()
+    report(final=True)
+    return stats
 
----
+# Offline tools run as `python gami.py <command> ...`; anything else is the Streamlit app
+CLI_COMMANDS = ("pregenerate-quest-pool", "replay-ledger", "run-batch")
 
-**🎁 Bonus Tip:**
-Securing this plan now may qualify you for **Lloyds Health Cashback** or other seasonal loyalty rewards.
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="gami.py", description="Lloyds LifeQuest offline tools")
+    llm_options = argparse.ArgumentParser(add_help=False)
+    llm_options.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    llm_options.add_argument("--base-url", default=os.environ.get("OPENAI_BASE_URL"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    pool_parser = commands.add_parser("pregenerate-quest-pool", parents=[llm_options],
+                                      help="Fill the cohort quest pool ahead of time")
+    pool_parser.add_argument("--output", default=QUEST_POOL_PATH)
+    pool_parser.add_argument("--batches-per-cohort", type=int, default=1)
+    pool_parser.add_argument("--workers", type=int, default=QUEST_FANOUT_WORKERS)
+    replay_parser = commands.add_parser("replay-ledger", help="Rebuild every user's state from the event ledger")
+    replay_parser.add_argument("--ledger-dir", default=LEDGER_DIR)
+    replay_parser.add_argument("--output", help="Write rebuilt states as JSONL")
+    replay_parser.add_argument("--from-snapshot", action="store_true", help="Start from the latest snapshot")
+    batch_parser = commands.add_parser("run-batch", parents=[llm_options],
+                                       help="Generate goals, quests and a nudge for each JSONL request")
+    batch_parser.add_argument("input", help="JSONL with persona or persona_id, and optionally goal, per line")
+    batch_parser.add_argument("--output-dir", default=BATCH_OUTPUT_DIR)
+    batch_parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    batch_parser.add_argument("--shards", type=int, default=BATCH_SHARDS)
+    args = parser.parse_args(argv)
 
----
+    if args.command == "replay-ledger":
+        started = time.time()
+        states, count = replay_ledger(args.ledger_dir, args.output, args.from_snapshot)
+        elapsed = time.time() - started
+        print(f"Replayed {count} events for {len(states)} users in {elapsed:.2f}s ({count / max(elapsed, 1e-9):,.0f} events/s)")
+        return
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or OPENAI_API_KEY)")
+    client = openai.OpenAI(api_key=args.api_key, base_url=args.base_url, max_retries=0)
 
-Use plain, encouraging language. Make the user feel supported and confident.
-Avoid robotic lists — speak like a person giving real, helpful advice.
-                    """},
-                    {"role": "user", "content": user_question}
-                ]
-                response = nudge_agent.get_completion(messages)
-                if response:
-                    st.success(f"🤖 **AI Coach:** {response}")
+    if args.command == "pregenerate-quest-pool":
+        pool = QuestPool(path=args.output, library=get_quest_library())
+        started = time.time()
+        quest_agent = QuestAgent(client, get_response_cache(), scheduler=get_llm_scheduler(), telemetry=get_agent_telemetry())
+        count = pregenerate_quest_pool(quest_agent, pool, args.batches_per_cohort, args.workers)
+        print(f"Generated {count} batches for {pool.cohort_count()} cohorts in {time.time() - started:.1f}s -> {args.output}")
+    elif args.command == "run-batch":
+        cache, scheduler, telemetry = get_response_cache(), get_llm_scheduler(), get_agent_telemetry()
+        agents = (GoalCoachAgent(client, cache, scheduler, telemetry),
+                  QuestAgent(client, cache, get_quest_pool(), scheduler, telemetry),
+                  NudgeAgent(client, cache, get_nudge_table(), scheduler, telemetry))
+        stats = run_batch(args.input, agents, args.output_dir, args.workers, args.shards)
+        sys.exit(1 if stats['failed'] else 0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Streamlit also executes this module as __main__, with its own script arguments; only an explicit command from a
+    # plain `python gami.py` invocation goes to the CLI
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS and not st.runtime.exists():
+        cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
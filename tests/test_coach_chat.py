@@ -0,0 +1,24 @@
+from gami import COACH_HISTORY_TOKEN_BUDGET, coach_chat_window, coach_fold_target, new_coach_chat
+
+
+def long_chat(exchanges):
+    chat = new_coach_chat()
+    for i in range(exchanges):
+        chat['turns'] += [{'role': 'user', 'content': f"Question {i} " + "q" * 300},
+                          {'role': 'assistant', 'content': f"Answer {i} " + "a" * 2000}]
+    return chat
+
+
+def test_window_never_starts_with_an_orphaned_answer():
+    for exchanges in range(1, 13):
+        window = coach_chat_window(long_chat(exchanges))
+        assert window and window[0]['role'] == 'user'
+        assert [m['role'] for m in window] == ['user', 'assistant'] * (len(window) // 2)
+        assert sum(len(m['content']) for m in window) // 4 <= COACH_HISTORY_TOKEN_BUDGET
+
+
+def test_fold_target_lands_on_an_exchange_boundary_and_keeps_the_latest():
+    chat = long_chat(12)
+    target = coach_fold_target(chat)
+    assert target % 2 == 0
+    assert target <= len(chat['turns']) - 2
@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+
+from gami import EventLedger, LeaderboardRegistry, iter_ledger_events, replay_ledger
+
+
+def test_unfinished_snapshot_files_are_ignored(tmp_path):
+    ledger = EventLedger(str(tmp_path), snapshot_every=2)
+    ledger.append("u1", [{'type': "PointsAwarded", 'points': 10}, {'type': "PointsAwarded", 'points': 5}])
+    ledger.append("u1", [{'type': "PointsAwarded", 'points': 1}])
+    ledger.close()
+    # A crash mid-write leaves a truncated temp file next to the finished snapshots
+    for name in (".snapshot-000000000009.json.gz.tmp", "snapshot-000000000009.json.gz.tmp"):
+        (tmp_path / name).write_bytes(b"\x1f\x8b")
+    assert sorted(n for n in os.listdir(tmp_path) if n.startswith("snapshot-") and n.endswith(".json.gz")) == [
+        "snapshot-000000000002.json.gz"]
+    restarted = EventLedger(str(tmp_path))
+    assert restarted.user_state("u1")['total_points'] == 16
+    assert restarted.rebuild_user("u1")['total_points'] == 16
+    assert replay_ledger(str(tmp_path), from_snapshot=True)[0]["u1"]['total_points'] == 16
+
+
+def _append_points(directory, user_id, batches, start):
+    start.wait()
+    ledger = EventLedger(directory, snapshot_every=7)
+    for _ in range(batches):
+        ledger.append(user_id, [{'type': "PointsAwarded", 'points': 10, 'cohorts': ["age:25-34"]},
+                                {'type': "LevelUp", 'level': 2}])
+    ledger.close()
+
+
+def test_two_processes_share_one_ledger(tmp_path):
+    directory = str(tmp_path)
+    watcher = EventLedger(directory)
+    boards = LeaderboardRegistry()
+    watcher.subscribe(boards.apply_events)
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    workers = [context.Process(target=_append_points, args=(directory, user_id, 50, start)) for user_id in ("u1", "u2")]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    events = list(iter_ledger_events(directory))
+    assert [event['seq'] for event in events] == list(range(1, 201))
+    restarted = EventLedger(directory)
+    for user_id in ("u1", "u2"):
+        assert restarted.user_state(user_id)['total_points'] == 500
+        assert restarted.rebuild_user(user_id)['total_points'] == 500
+    states, _ = replay_ledger(directory, from_snapshot=True)
+    assert {user_id: state['total_points'] for user_id, state in states.items()} == {'u1': 500, 'u2': 500}
+    # A process that never appended still follows the other two
+    watcher.sync()
+    for name in (LeaderboardRegistry.GLOBAL, "age:25-34"):
+        assert [(user, points) for _, user, points in sorted(boards.board(name).top(2), key=lambda e: e[1])] == [
+            ('u1', 500), ('u2', 500)]
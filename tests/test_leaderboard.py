@@ -0,0 +1,30 @@
+from gami import Leaderboard
+
+
+def test_ties_share_a_rank_and_keep_arrival_order():
+    board = Leaderboard()
+    for user in ["a", "b", "c", "d"]:
+        board.set_score(user, 0)
+    board.set_score("top", 10)
+    assert board.rank("top") == 1
+    assert [board.rank(user) for user in "abcd"] == [2, 2, 2, 2]
+    assert [user for _, user, _ in board.top(10)] == ["top", "a", "b", "c", "d"]
+    assert board.around("c", 1) == [(2, "b", 0), (2, "c", 0), (2, "d", 0)]
+
+
+def test_tied_positions_match_a_sorted_reference():
+    board = Leaderboard()
+    arrivals = {}
+    for step, (user, score) in enumerate([(f"u{i % 40}", (i * 7) % 3) for i in range(200)]):
+        if step % 5 == 4:
+            board.remove(user)
+            arrivals.pop(user, None)
+        else:
+            board.set_score(user, score)
+            arrivals[user] = (score, step)
+    expected = sorted(arrivals, key=lambda user: (-arrivals[user][0], arrivals[user][1]))
+    assert [user for _, user, _ in board.top(len(board))] == expected
+    for position, user in enumerate(expected):
+        start = max(position - 2, 0)
+        assert [entry[1] for entry in board.around(user, 2)] == expected[start:position + 3]
+        assert board.rank(user) == 1 + sum(1 for other in expected if arrivals[other][0] > arrivals[user][0])
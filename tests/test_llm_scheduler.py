@@ -0,0 +1,66 @@
+import threading
+from collections import Counter
+
+from gami import PRIORITY_INTERACTIVE, AIAgentManager, LLMScheduler, llm_usage
+
+
+class Usage:
+    total_tokens = 40
+
+
+class Chunk:
+    def __init__(self, usage=None):
+        self.usage = usage
+
+
+def test_stream_holds_its_slot_until_exhausted():
+    scheduler = LLMScheduler(rpm=1000, tpm=10_000, max_concurrency=1)
+    stream = scheduler.stream(lambda: iter([Chunk(), Chunk(Usage())]), 100, PRIORITY_INTERACTIVE)
+    assert scheduler.metrics()['running'] == 1
+    chunks = list(stream)
+    assert len(chunks) == 2
+    assert scheduler.metrics()['running'] == 0
+    # 100 tokens were reserved up front; the 60 not used are returned once the usage chunk is seen
+    assert scheduler.metrics()['tpm_available'] >= 9_900 + 60 - 1
+
+
+def test_closing_an_unread_stream_releases_its_slot():
+    scheduler = LLMScheduler(rpm=1000, tpm=10_000, max_concurrency=1)
+    stream = scheduler.stream(lambda: iter([Chunk()]), 100, PRIORITY_INTERACTIVE)
+    stream.close()
+    assert scheduler.metrics()['running'] == 0
+
+
+def test_coalesced_callers_are_not_billed_for_tokens():
+    release = threading.Event()
+
+    class Completions:
+        calls = 0
+
+        def create(self, **request):
+            Completions.calls += 1
+            release.wait(5)
+            return type("Response", (), {'usage': type("Usage", (), {'prompt_tokens': 10, 'completion_tokens': 5})()})()
+
+    client = type("Client", (), {'chat': type("Chat", (), {'completions': Completions()})()})()
+    agent = AIAgentManager(client, scheduler=LLMScheduler(rpm=1000, tpm=100_000))
+    request = {'model': "m", 'messages': [{'role': 'user', 'content': "hi"}], 'max_tokens': 10}
+    meters = [Counter(), Counter()]
+
+    def call(meter):
+        llm_usage.set(meter)
+        agent._create(request, "site", key="same")
+
+    threads = [threading.Thread(target=call, args=(meter,)) for meter in meters]
+    threads[0].start()
+    while not agent.scheduler._inflight:
+        pass
+    threads[1].start()
+    while agent.scheduler.stats['coalesced'] == 0:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert Completions.calls == 1
+    assert meters[0]['prompt_tokens'] == 10 and meters[0]['coalesced_calls'] == 0
+    assert meters[1]['prompt_tokens'] == 0 and meters[1]['coalesced_calls'] == 1
@@ -0,0 +1,24 @@
+from gami import render_nudge, template_nudge
+
+TOM = {'name': "Tom Carter", 'age': 30, 'occupation': "Nurse", 'income_range': "£35,000-£45,000"}
+GOAL = {'title': "Build Emergency Fund", 'target_amount': 5000}
+PROGRESS = {'total_points': 200}
+
+
+def nudge(message, reward="Earn 150 LifePoints"):
+    return {"message": message, "action": "Complete your next quest", "urgency": "Medium", "reward_mention": reward,
+            "motivation": "Small steps add up"}
+
+
+def test_names_and_amounts_are_templated_as_whole_tokens():
+    template = template_nudge(nudge("Tomorrow is a good day, Tom. Aim for £5,000 in Build Emergency Fund."),
+                              PROGRESS, TOM, GOAL)
+    assert template["message"] == "Tomorrow is a good day, {first_name}. Aim for {target_amount} in {goal_title}."
+    rendered = render_nudge(template, {'total_points': 900}, {'name': "Sarah Khan"}, {'title': "Save", 'target_amount': 800})
+    assert rendered["message"] == "Tomorrow is a good day, Sarah. Aim for £800 in Save."
+
+
+def test_nudges_mentioning_persona_details_are_not_learned():
+    assert template_nudge(nudge("As a nurse aged 30, cover matters."), PROGRESS, TOM, GOAL) is None
+    assert template_nudge(nudge("Keep going!", reward="Earn 200 more points"), PROGRESS, TOM, GOAL) is None
+    assert template_nudge(nudge("On £35,000 a year, start small."), PROGRESS, TOM, GOAL) is None
@@ -0,0 +1,19 @@
+import pytest
+
+from gami import PERSONA_DEFAULTS, PersonaCatalog
+
+
+def record(persona_id, **fields):
+    return {'id': persona_id, 'name': f"Customer {persona_id}", **fields}
+
+
+def test_ages_are_parsed_leniently():
+    catalog = PersonaCatalog.from_records([record("C1", age="32.0"), record("C2", age=" 41 "), record("C3", age="n/a")])
+    assert [catalog.get(persona_id)['age'] for persona_id in ("C1", "C2", "C3")] == [32, 41, PERSONA_DEFAULTS['age']]
+
+
+def test_missing_or_duplicate_ids_are_rejected():
+    with pytest.raises(ValueError, match="no customer ID"):
+        PersonaCatalog.from_records([record("C1"), record("")])
+    with pytest.raises(ValueError, match="duplicate customer ID 'C1'"):
+        PersonaCatalog.from_records([record("C1"), record("C2"), record("C1")])
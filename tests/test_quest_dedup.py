@@ -0,0 +1,23 @@
+from gami import QuestPool, dedupe_quests
+
+PERSONA = {'name': "Tom Carter", 'age': 28, 'risk_profile': "Moderate"}
+GOAL = {'id': "goal_1", 'title': "Protect Your Income", 'category': "Income Protection", 'target_amount': 3000}
+QUESTS = [
+    {'title': "Compare income protection insurance quotes", 'description': "Get three quotes and compare cover"},
+    {'title': "Budget for a month", 'description': "Track every purchase for thirty days"},
+    {'title': "Compare income protection insurance quotes today", 'description': "Get three quotes and compare the cover"},
+]
+
+
+def test_batch_is_deduped_within_itself_and_never_emptied():
+    assert [q['title'] for q in dedupe_quests([dict(q) for q in QUESTS])] == [QUESTS[0]['title'], QUESTS[1]['title']]
+    assert len(dedupe_quests([dict(QUESTS[0])])) == 1
+
+
+def test_pool_dedupes_within_a_cohort_only():
+    pool = QuestPool(path=None)
+    pool.add("Income Protection|beginner|25-34|Moderate", [dict(q) for q in QUESTS[:2]], GOAL, PERSONA, save=False)
+    pool.add("Income Protection|beginner|35-49|Moderate", [dict(q) for q in QUESTS[:2]], GOAL, PERSONA, save=False)
+    pool.add("Income Protection|beginner|25-34|Moderate", [dict(q) for q in QUESTS[1:]], GOAL, PERSONA, save=False)
+    assert pool.stats['duplicate_batches'] == 1
+    assert pool.draw("Income Protection|beginner|35-49|Moderate") is not None
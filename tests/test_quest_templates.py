@@ -0,0 +1,19 @@
+from gami import render_quest_template, template_quest, template_text
+
+TOM = {'name': "Tom Smith", 'age': 28}
+TOM_GOAL = {'title': "Build Emergency Fund", 'target_amount': 500}
+SARAH = {'name': "Sarah Khan", 'age': 31}
+SARAH_GOAL = {'title': "Build Emergency Fund", 'target_amount': 20000}
+
+
+def test_only_whole_tokens_are_templated():
+    text = "Tomorrow save £5000, Tom. Tom Smith needs £500, not £500,000 or £500.50."
+    assert template_text(text, TOM_GOAL, TOM) == (
+        "Tomorrow save £5000, {first_name}. {name} needs {target_amount}, not £500,000 or £500.50.")
+
+
+def test_pooled_quest_round_trips_to_another_user():
+    quest = {'id': "q1", 'title': "Tom, start your fund", 'description': "Tomorrow save £5000 towards £500 by Tomás' plan"}
+    rendered = render_quest_template(template_quest(quest, TOM_GOAL, TOM), SARAH_GOAL, SARAH)
+    assert rendered == {'title': "Sarah, start your fund",
+                        'description': "Tomorrow save £5000 towards £20,000 by Tomás' plan"}
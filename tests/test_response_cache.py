@@ -0,0 +1,14 @@
+import time
+
+from gami import RESPONSE_CACHE_NAMESPACE, MemoryStateBackend, ResponseCache
+
+
+def test_promoted_shared_hit_expires_with_the_shared_entry():
+    backend = MemoryStateBackend()
+    backend.put(RESPONSE_CACHE_NAMESPACE, "k", "answer", ttl_seconds=0.2)
+    cache = ResponseCache(backend, ttl_seconds=3600)
+    assert cache.get("k") == "answer"
+    assert cache.stats['shared_hits'] == 1
+    time.sleep(0.25)
+    assert cache.get("k") is None
+    assert cache.stats['misses'] == 1
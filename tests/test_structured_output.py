@@ -0,0 +1,20 @@
+import json
+
+from gami import GOAL_FIELDS, _new_parse_report, parse_structured_output
+
+
+def goal(**fields):
+    return {"t": "Build Emergency Fund", "d": "Save three months of expenses", "c": "Emergency Fund Building", **fields}
+
+
+def test_unparseable_amount_falls_back_to_default():
+    report = _new_parse_report()
+    result = parse_structured_output(json.dumps({"goals": [goal(a="£1.000.000")]}), "goals", report)
+    assert result[0]['target_amount'] == GOAL_FIELDS['a'][2]
+    assert report['fields_repaired'] == 1
+    assert report['parse_failures'] == 0
+
+
+def test_amount_with_currency_and_range_is_repaired():
+    result = parse_structured_output(json.dumps({"goals": [goal(a="£2,000-£3,000")]}), "goals")
+    assert result[0]['target_amount'] == 2000